@@ -0,0 +1,558 @@
+#!/usr/bin/env python3
+
+# benchmark.py
+
+# Timing comparisons for the parts of the workflow that dominate
+# run time. These run on synthetic data, so they don't need access
+# to the original feature files.
+
+# Usage:
+#     python benchmark.py frames [metapath]
+#     python benchmark.py metadata [metapath]
+#     python benchmark.py suite workdir [baselinepath]
+#     python benchmark.py shards workdir
+
+# "frames" compares the old cell-by-cell construction of feature
+# frames in trainamodel with the vectorized version, on a set of
+# synthetic volumes the size of metapath (maintrainingset.csv by
+# default), and confirms that both produce identical frames.
+
+# "metadata" compares the old row-by-row version of
+# implementmodel.get_metadata with the vectorized rules, on real
+# metadata (bzipmeta.csv by default), and confirms that every flag
+# comes out the same. It exits with an error if not, so it can serve
+# as a regression test.
+
+# "suite" generates a synthetic corpus in workdir (feature csvs, and
+# the same volumes as .basic.json.bz2 files in a pairtree), trains a
+# small ensemble on it with export_svm_model, and then times the hot
+# functions of training and classification at several corpus sizes.
+# Timings are saved in workdir/benchmark.json. If baselinepath names
+# a json file saved by an earlier run, each timing is compared with
+# it, and the script exits with an error if anything got markedly
+# slower. The corpus and models are reused if workdir already has them.
+
+# "shards" queues a synthetic corpus with runshards, with settings that
+# ask implementmodel for two worker processes and point it at models
+# that don't exist, and runs the queue. Every shard should be attempted
+# maxattempts times and end up in failed/; the script exits with an
+# error if any doesn't, or if the queue is still running after
+# five minutes.
+
+import bz2, json, os, shutil, signal, subprocess, sys, time
+from collections import Counter
+import numpy as np
+import pandas as pd
+
+import trainamodel
+import implementmodel
+import jsonfeatures
+import runshards
+
+# import utils
+currentdir = os.path.dirname(__file__)
+libpath = os.path.join(currentdir, '../lib')
+sys.path.append(libpath)
+
+import SonicScrewdriver as utils
+
+def synthetic_counts(docids, vocabsize = 20000, tokens = 40000, seed = 0):
+    ''' Returns a dictionary of Counters, one per docid, with words drawn
+    from a Zipfian distribution over vocabsize types.
+    '''
+    rng = np.random.RandomState(seed)
+    ranks = np.arange(1, vocabsize + 1)
+    probs = 1 / ranks ** 1.07
+    probs = probs / probs.sum()
+    words = ['w' + str(x) for x in range(vocabsize)]
+
+    counts = dict()
+    for docid in docids:
+        draws = np.bincount(rng.choice(vocabsize, size = tokens, p = probs), minlength = vocabsize)
+        nonzero = np.nonzero(draws)[0]
+        rng.shuffle(nonzero)
+        counts[docid] = Counter({words[x]: float(draws[x]) for x in nonzero})
+
+    return counts
+
+def vocabulary_for(counts, n):
+    doc_freq = Counter()
+    for docid, doccounts in counts.items():
+        for word in doccounts:
+            doc_freq[word] += 1
+    return [x[0] for x in doc_freq.most_common(n)]
+
+# The functions below are the versions of counts2frame_notscaled and
+# countdict2featureframe that trainamodel used before they were
+# vectorized, kept here as a reference for timing and for checking
+# that the output hasn't changed.
+
+def loop_counts2frame_notscaled(vocabulary, positiveIDs, negativeIDs, counts):
+    df = dict()
+    allIDs = positiveIDs + negativeIDs
+
+    for v in vocabulary:
+        df[v] = pd.Series(np.zeros(len(allIDs)), index = allIDs)
+        for docid in allIDs:
+            if v in counts[docid]:
+                df[v].loc[docid] = counts[docid][v]
+
+    df = pd.DataFrame(df, index = allIDs)
+    df = df[vocabulary]
+
+    return df
+
+def loop_countdict2frame(vocabulary, positiveIDs, negativeIDs, counts):
+    df = dict()
+    vocabset = set(vocabulary)
+    allIDs = positiveIDs + negativeIDs
+
+    for v in vocabulary:
+        df[v] = pd.Series(np.zeros(len(allIDs)), index = allIDs)
+
+    for docid in allIDs:
+        for feature, count in counts[docid].items():
+            if feature in vocabset:
+                df[feature].loc[docid] = count
+
+    df = pd.DataFrame(df, index = allIDs)
+    df = df[vocabulary]
+
+    return df
+
+def loop_get_metadata(metapath):
+    ''' implementmodel.get_metadata as it was before the rules were
+    vectorized.
+    '''
+
+    meta = pd.read_csv(metapath, index_col = 'docid', dtype = 'object')
+
+    newdata = dict()
+    newdata['bio'] = []
+    newdata['fic'] = []
+    newdata['poe'] = []
+    newdata['dra'] = []
+
+    for idx in meta.index:
+        genres = str(meta.loc[idx, 'genres']).split('|')
+        subjects = str(meta.loc[idx, 'subjects']).split('|')
+        title = str(meta.loc[idx, 'title'].lower())
+
+        dra = False
+        fic = False
+        poe = False
+        bio = False
+
+        if 'Biography' in genres or 'Biography' in subjects:
+            bio = True
+
+        if 'Autobiography' in genres or 'Autobiography' in subjects:
+            bio = True
+
+        if 'Description and travel' in subjects:
+            bio = True
+
+        if 'Fiction' in genres:
+            fic = True
+
+        if 'Poetry' in genres or 'poems' in title:
+            poe = True
+
+        if 'Drama' in genres or 'plays' in title:
+            dra = True
+
+        newdata['bio'].append(bio)
+        newdata['dra'].append(dra)
+        newdata['fic'].append(fic)
+        newdata['poe'].append(poe)
+
+    for genre in ['bio', 'dra', 'fic', 'poe']:
+        meta.loc[ :, genre] = pd.Series(newdata[genre], index = meta.index)
+
+    return meta
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+def benchmark_frames(metapath = 'maintrainingset.csv', ftcounts = [250, 580, 1300]):
+    ''' Times the old and new frame builders at several vocabulary sizes,
+    and checks that they agree. Returns a list of result rows.
+    '''
+
+    meta = pd.read_csv(metapath, index_col = 'docid', dtype = 'object')
+    docids = meta.index.tolist()
+    half = len(docids) // 2
+    positiveIDs = docids[0 : half]
+    negativeIDs = docids[half : ]
+
+    print('Generating synthetic counts for ' + str(len(docids)) + ' volumes ...')
+    counts = synthetic_counts(docids)
+    fullvocab = vocabulary_for(counts, max(ftcounts))
+
+    results = []
+
+    for ftcount in ftcounts:
+        vocabulary = fullvocab[0 : ftcount]
+
+        oldframe, oldtime = timed(loop_counts2frame_notscaled, vocabulary, positiveIDs, negativeIDs, counts)
+        newframe, newtime = timed(trainamodel.counts2frame_notscaled, vocabulary, positiveIDs, negativeIDs, counts)
+        pd.testing.assert_frame_equal(oldframe, newframe)
+        results.append(('counts2frame_notscaled', ftcount, oldtime, newtime))
+
+        oldframe, oldtime = timed(loop_countdict2frame, vocabulary, positiveIDs, negativeIDs, counts)
+        newframe, newtime = timed(trainamodel.countdict2matrix, vocabulary, positiveIDs + negativeIDs, counts)
+        pd.testing.assert_frame_equal(oldframe, pd.DataFrame(newframe, index = positiveIDs + negativeIDs, columns = vocabulary))
+        results.append(('countdict2featureframe', ftcount, oldtime, newtime))
+
+    print()
+    print('function', 'features', 'old seconds', 'new seconds', 'speedup', sep = '\t')
+    for name, ftcount, oldtime, newtime in results:
+        print(name, ftcount, round(oldtime, 3), round(newtime, 3), round(oldtime / newtime, 1), sep = '\t')
+
+    return results
+
+def benchmark_metadata(metapath = 'bzipmeta.csv'):
+    ''' Times the old and new versions of get_metadata, and checks that
+    they produce identical frames.
+    '''
+
+    oldmeta, oldtime = timed(loop_get_metadata, metapath)
+    newmeta, newtime = timed(implementmodel.get_metadata, metapath)
+    pd.testing.assert_frame_equal(oldmeta, newmeta)
+
+    flagcounts = ', '.join([genre + ' ' + str(int(newmeta[genre].sum())) for genre in ['bio', 'dra', 'fic', 'poe']])
+    print(str(len(newmeta)) + ' rows; flags identical (' + flagcounts + ').')
+    print('old seconds', 'new seconds', 'speedup', sep = '\t')
+    print(round(oldtime, 3), round(newtime, 3), round(oldtime / newtime, 1), sep = '\t')
+
+    return oldtime, newtime
+
+# The benchmark suite.
+
+suitesizes = [50, 150, 450]
+suitegenres = ['fic', 'poe', 'dra', 'bio', 'non']
+suiteweights = [0.3, 0.15, 0.1, 0.15, 0.3]
+
+# A timing counts as a regression if it is this many times the
+# baseline, and also slower by at least minimumslowdown seconds.
+
+regressionratio = 1.25
+minimumslowdown = 0.05
+
+def synthetic_word(idx):
+    ''' Turns an integer into an alphabetic pseudo-word, so that
+    get_english_percent has something to count.
+    '''
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    word = ''
+    idx += 26
+    while idx > 0:
+        word = letters[idx % 26] + word
+        idx = idx // 26
+    return word
+
+def make_synthetic_corpus(corpusdir, n, vocabsize = 30000, seed = 0):
+    ''' Writes n synthetic volumes to corpusdir, both as feature csvs
+    (in corpusdir/csv) and as extracted-feature json files (in a pairtree
+    under corpusdir/pairtree/). Words are drawn from a Zipfian
+    distribution, which each genre perturbs by boosting a few hundred
+    words of its own; volumes have between 20 and 150 pages. Returns
+    a metadata frame indexed by docid.
+    '''
+
+    rng = np.random.RandomState(seed)
+    words = [synthetic_word(x) for x in range(vocabsize)]
+    ranks = np.arange(1, vocabsize + 1)
+    baseprobs = 1 / ranks ** 1.07
+
+    genreprobs = dict()
+    for genre in suitegenres:
+        probs = baseprobs.copy()
+        boosted = rng.choice(np.arange(100, 5000), size = 300, replace = False)
+        probs[boosted] *= 4
+        genreprobs[genre] = probs / probs.sum()
+
+    csvdir = os.path.join(corpusdir, 'csv')
+    pairtreeroot = os.path.join(corpusdir, 'pairtree') + '/'
+    os.makedirs(csvdir, exist_ok = True)
+
+    rows = []
+    for volnum in range(n):
+        docid = 'bench.v' + str(volnum).zfill(6)
+        genre = suitegenres[rng.choice(len(suitegenres), p = suiteweights)]
+
+        pagecount = rng.randint(20, 150)
+        tokens = pagecount * 200
+        wordids = rng.choice(vocabsize, size = tokens, p = genreprobs[genre])
+        pageids = rng.randint(0, pagecount, size = tokens)
+        headerids = rng.choice(200, size = pagecount * 3, p = genreprobs[genre][0 : 200] / genreprobs[genre][0 : 200].sum())
+
+        pages = []
+        bodytotals = Counter()
+        headertotals = Counter()
+        order = np.lexsort((wordids, pageids))
+        boundaries = np.searchsorted(pageids[order], np.arange(pagecount + 1))
+
+        for pagenum in range(pagecount):
+            pagewords = wordids[order[boundaries[pagenum] : boundaries[pagenum + 1]]]
+            uniquewords, counts = np.unique(pagewords, return_counts = True)
+            body = {words[w]: {'NN': int(c)} for w, c in zip(uniquewords, counts)}
+            header = {words[w].capitalize(): {'NNP': 1} for w in headerids[pagenum * 3 : pagenum * 3 + 3]}
+
+            for w, c in zip(uniquewords, counts):
+                bodytotals[words[w]] += int(c)
+            for w in headerids[pagenum * 3 : pagenum * 3 + 3]:
+                headertotals[words[w]] += 1
+
+            pages.append({'seq': str(pagenum + 1).zfill(8), 'tokenCount': int(len(pagewords)),
+                'header': {'tokenCount': 3, 'tokenPosCount': header},
+                'body': {'tokenCount': int(len(pagewords)), 'tokenPosCount': body},
+                'footer': {'tokenCount': 0, 'tokenPosCount': dict()}})
+
+        with open(os.path.join(csvdir, utils.clean_pairtree(docid) + '.csv'), mode = 'w', encoding = 'utf-8') as f:
+            f.write('feature,count\n')
+            for word, count in bodytotals.items():
+                f.write(word + ',' + str(count) + '\n')
+            for word, count in headertotals.items():
+                f.write('#header' + word + ',' + str(count) + '\n')
+
+        volume = {'id': docid, 'metadata': {'title': 'Volume ' + str(volnum)}, 'features': {'pageCount': pagecount, 'pages': pages}}
+        path, postfix = utils.pairtreepath(docid, pairtreeroot)
+        os.makedirs(path + postfix, exist_ok = True)
+        with open(path + postfix + '/' + postfix + '.json.bz2', mode = 'wb') as f:
+            f.write(bz2.compress(json.dumps(volume).encode('utf-8')))
+
+        row = dict()
+        row['docid'] = docid
+        row['volgenre'] = genre
+        row['genres'] = {'fic': 'Fiction', 'poe': 'Poetry', 'dra': 'Drama', 'bio': 'Biography', 'non': 'NotFiction'}[genre]
+        row['subjects'] = ''
+        row['title'] = 'Volume ' + str(volnum)
+        rows.append(row)
+
+    meta = pd.DataFrame(rows).set_index('docid')
+    meta.to_csv(os.path.join(corpusdir, 'meta.csv'))
+
+    return meta
+
+def suite_spec(name, ftcount = 150, c = 0.01):
+    ''' Translates a model name from implementmodel.allnames into the
+    arguments export_svm_model expects.
+    '''
+    positive = name[0 : 3]
+    negative = name[5 : ]
+    if negative == 'all':
+        negative = '~' + positive
+    return positive, negative, ftcount, c
+
+def benchmark_suite(workdir, baselinepath = None, sizes = suitesizes):
+    ''' Times the hot paths of training and classification on
+    synthetic corpora of several sizes; see the comment at the top
+    of this file. Returns the number of regressions against the
+    baseline (zero if there's no baseline).
+    '''
+
+    corpusdir = os.path.join(workdir, 'corpus')
+    modeldir = os.path.join(workdir, 'models') + '/'
+    csvdir = os.path.join(corpusdir, 'csv')
+    pairtreeroot = os.path.join(corpusdir, 'pairtree') + '/'
+
+    if os.path.isfile(os.path.join(corpusdir, 'meta.csv')):
+        fullmeta = pd.read_csv(os.path.join(corpusdir, 'meta.csv'), index_col = 'docid', dtype = 'object')
+    else:
+        fullmeta = None
+
+    if fullmeta is None or len(fullmeta) < max(sizes):
+        print('Generating ' + str(max(sizes)) + ' synthetic volumes ...')
+        fullmeta = make_synthetic_corpus(corpusdir, max(sizes))
+
+    for size in sizes:
+        fullmeta.iloc[0 : size].to_csv(os.path.join(corpusdir, 'meta' + str(size) + '.csv'))
+
+    # An ensemble is trained once, on the smallest corpus, and then
+    # used for all the classification timings.
+
+    os.makedirs(modeldir, exist_ok = True)
+    smallestmeta = os.path.join(corpusdir, 'meta' + str(min(sizes)) + '.csv')
+    for name in implementmodel.allnames:
+        if not os.path.isfile(modeldir + name + '.p'):
+            positive, negative, ftcount, c = suite_spec(name)
+            trainamodel.export_svm_model(smallestmeta, csvdir, positive, negative, ftcount, c, modeldir + name + '.p')
+
+    models, stack = implementmodel.load_ensemble(modeldir, False)
+
+    timings = dict()
+
+    def record(name, size, seconds):
+        if name not in timings:
+            timings[name] = dict()
+        timings[name][str(size)] = seconds
+
+    for size in sizes:
+        print()
+        print('Timing a corpus of ' + str(size) + ' volumes ...')
+        metapath = os.path.join(corpusdir, 'meta' + str(size) + '.csv')
+        metadata = implementmodel.get_metadata(metapath)
+        docids = metadata.index.tolist()
+
+        start = time.perf_counter()
+        countslist = [implementmodel.counts4file(os.path.join(csvdir, utils.clean_pairtree(x) + '.csv'))[0] for x in docids]
+        record('counts4file', size, time.perf_counter() - start)
+
+        start = time.perf_counter()
+        for docid in docids:
+            implementmodel.counts4json(implementmodel.get_pairtree(pairtreeroot, docid), docid)
+        record('counts4json', size, time.perf_counter() - start)
+
+        reader = jsonfeatures.VolumeReader()
+        start = time.perf_counter()
+        for docid in docids:
+            implementmodel.counts4json(implementmodel.get_pairtree(pairtreeroot, docid), docid, reader)
+        record('counts4json (VolumeReader)', size, time.perf_counter() - start)
+
+        positive, negative, ftcount, c = suite_spec('ficvsall')
+        trainmeta, positiveIDs, negativeIDs = trainamodel.get_metadata(metapath, positive, negative)
+
+        (vocabulary, countdict), seconds = timed(trainamodel.get_vocabulary_and_counts, trainmeta, positiveIDs, negativeIDs, csvdir, ftcount)
+        record('get_vocabulary_and_counts', size, seconds)
+
+        frame, seconds = timed(trainamodel.counts2frame_notscaled, vocabulary, positiveIDs, negativeIDs, countdict)
+        record('counts2frame_notscaled', size, seconds)
+
+        outpath = os.path.join(workdir, 'timedmodel.p')
+        result, seconds = timed(trainamodel.export_svm_model, metapath, csvdir, positive, negative, ftcount, c, outpath)
+        record('export_svm_model', size, seconds)
+
+        start = time.perf_counter()
+        for counts in countslist:
+            implementmodel.prediction_for_file(models['ficvsall'], counts)
+        record('prediction_for_file', size, time.perf_counter() - start)
+
+        genredicts = [implementmodel.make_genredict(metadata, docid) for docid in docids]
+
+        start = time.perf_counter()
+        for counts, genredict in zip(countslist, genredicts):
+            implementmodel.volume_classification(models, counts, dict(genredict))
+        record('volume_classification', size, time.perf_counter() - start)
+
+        space = implementmodel.feature_space(models)
+        start = time.perf_counter()
+        for counts, genredict in zip(countslist, genredicts):
+            implementmodel.volume_classification(models, counts, dict(genredict), space = space)
+        record('volume_classification (feature space)', size, time.perf_counter() - start)
+
+        start = time.perf_counter()
+        for floor in range(0, size, 100):
+            implementmodel.classify_batch(models, docids[floor : floor + 100], genredicts[floor : floor + 100], csvdir, False, stack)
+        record('classify_batch', size, time.perf_counter() - start)
+
+    results = {'sizes': sizes, 'timings': timings}
+    with open(os.path.join(workdir, 'benchmark.json'), mode = 'w', encoding = 'utf-8') as f:
+        json.dump(results, f, indent = 2)
+        f.write('\n')
+
+    if baselinepath is not None:
+        with open(baselinepath, encoding = 'utf-8') as f:
+            baseline = json.load(f)['timings']
+    else:
+        baseline = dict()
+
+    regressions = 0
+    print()
+    print('function', 'volumes', 'seconds', 'baseline', 'ratio', sep = '\t')
+    for name in timings:
+        for size in sizes:
+            seconds = timings[name][str(size)]
+            if name in baseline and str(size) in baseline[name]:
+                before = baseline[name][str(size)]
+                ratio = seconds / before if before > 0 else float('inf')
+                flag = ''
+                if ratio > regressionratio and seconds - before > minimumslowdown:
+                    flag = 'SLOWER'
+                    regressions += 1
+                print(name, size, round(seconds, 3), round(before, 3), round(ratio, 2), flag, sep = '\t')
+            else:
+                print(name, size, round(seconds, 3), '', '', sep = '\t')
+
+    if baselinepath is not None:
+        print(str(regressions) + ' regressions against ' + baselinepath + '.')
+
+    return regressions
+
+def check_failing_shards(workdir, timeout = 300):
+    ''' Runs a queue whose shards can't be classified (see the comment
+    at the top of this file) in a separate process group, so that it
+    can be killed if it hangs. Returns True if every shard failed the
+    expected number of times.
+    '''
+
+    corpusdir = os.path.join(workdir, 'corpus')
+    queuedir = os.path.join(workdir, 'failingqueue')
+    metapath = os.path.join(corpusdir, 'meta.csv')
+
+    if not os.path.isfile(metapath):
+        make_synthetic_corpus(corpusdir, 20)
+
+    if os.path.isdir(queuedir):
+        shutil.rmtree(queuedir)
+
+    settings = dict(runshards.defaultsettings)
+    settings['sourcedir'] = os.path.join(corpusdir, 'pairtree') + '/'
+    settings['modeldir'] = os.path.join(workdir, 'nomodels') + '/'
+    settings['outdir'] = os.path.join(queuedir, 'out')
+    settings['options'] = {'workers': 2}
+
+    shardsize = max(1, len(pd.read_csv(metapath, dtype = 'object')) // 2)
+    shardcount = runshards.split_metadata(metapath, queuedir, shardsize, settings)
+
+    command = [sys.executable, os.path.join(currentdir, 'runshards.py'), 'run', queuedir, '2']
+    process = subprocess.Popen(command, start_new_session = True)
+    try:
+        process.wait(timeout)
+    except subprocess.TimeoutExpired:
+        os.killpg(process.pid, signal.SIGKILL)
+        process.wait()
+        print('The queue was still running after ' + str(timeout) + 's.')
+        return False
+
+    failed = runshards.FileQueue(queuedir).records('failed')
+    attempts = [record['attempts'] for record in failed]
+    print(str(len(failed)) + ' of ' + str(shardcount) + ' shards failed, after ' + str(attempts) + ' attempts.')
+
+    return len(failed) == shardcount and all(x == runshards.maxattempts for x in attempts)
+
+if __name__ == '__main__':
+
+    args = sys.argv
+
+    if len(args) > 1 and args[1] == 'frames':
+        if len(args) > 2:
+            benchmark_frames(args[2])
+        else:
+            benchmark_frames()
+
+    elif len(args) > 1 and args[1] == 'metadata':
+        if len(args) > 2:
+            benchmark_metadata(args[2])
+        else:
+            benchmark_metadata()
+
+    elif len(args) > 2 and args[1] == 'suite':
+        if len(args) > 3:
+            regressions = benchmark_suite(args[2], args[3])
+        else:
+            regressions = benchmark_suite(args[2])
+        if regressions > 0:
+            sys.exit(1)
+
+    elif len(args) > 2 and args[1] == 'shards':
+        if not check_failing_shards(args[2]):
+            sys.exit(1)
+
+    else:
+        print('Usage: python benchmark.py frames [metapath]')
+        print('       python benchmark.py metadata [metapath]')
+        print('       python benchmark.py suite workdir [baselinepath]')
+        print('       python benchmark.py shards workdir')
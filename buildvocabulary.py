@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+
+# buildvocabulary.py
+
+# trainamodel.get_vocabulary ranks words by document frequency with a
+# single Counter of every distinct word in every volume, and
+# get_vocabulary_and_counts also holds each volume's counts in memory.
+# That's fine for the training set, but not for a vocabulary drawn
+# from hundreds of thousands of volumes.
+
+# This module produces the same top-n list in bounded memory. Volumes
+# are divided into chunks, and worker processes count document
+# frequency within each chunk. Each chunk's counts are spilled to disk,
+# split into partitions by a hash of the word, so that all the partial
+# counts for a given word end up in the same partition. Each partition
+# is then merged on its own (again in parallel), and only its n best
+# words are kept; the final list is the n best of those.
+
+# The result is exact, not an estimate. Document frequency is counted
+# as trainamodel counts it, by feature rows, with #header words folded
+# into the body. Counter.most_common breaks ties by the order in which
+# words were first seen, so along with each word's count we keep the
+# position where it first occurred (volume, then row), and break ties
+# the same way.
+
+# Memory use depends on the number of distinct words in one chunk, or
+# one partition, rather than in the whole corpus.
+
+# Usage:
+#     python buildvocabulary.py metapath sourcedir n outpath [workers]
+
+# writes the top n words in metapath's volumes, with their document
+# frequencies, to outpath.
+
+import heapq, os, pickle, shutil, sys, tempfile, zlib
+from collections import Counter
+from multiprocessing import Pool
+import pandas as pd
+
+# import utils
+currentdir = os.path.dirname(__file__)
+libpath = os.path.join(currentdir, '../lib')
+sys.path.append(libpath)
+
+import SonicScrewdriver as utils
+
+import featurecache
+
+# A word's first position is recorded as one integer: the index of its
+# volume times rowstride, plus the index of the row within the volume.
+
+rowstride = 2 ** 32
+
+def partition_for(word, partitions):
+    ''' A hash that, unlike hash(), is the same in every process.
+    '''
+    return zlib.crc32(word.encode('utf-8')) % partitions
+
+def spillpath(spilldir, chunkindex, partition):
+    return os.path.join(spilldir, 'chunk' + str(chunkindex) + '.part' + str(partition) + '.p')
+
+def count_chunk(chunktuple):
+    ''' Counts document frequency (and first position) for one chunk
+    of volumes, and spills the counts to one file per partition.
+    Designed to be mapped across a Pool, so input is packed as a tuple.
+    Returns the number of volumes that were missing.
+    '''
+
+    chunkindex, firstvolume, docids, sourcedir, fromjson, partitions, spilldir = chunktuple
+
+    doc_freq = Counter()
+    firstseen = dict()
+    missing = 0
+
+    for offset, docid in enumerate(docids):
+        if fromjson:
+            path = os.path.join(sourcedir, utils.clean_pairtree(docid) + '.basic.json.bz2')
+        else:
+            path = os.path.join(sourcedir, utils.clean_pairtree(docid) + '.csv')
+
+        if not os.path.isfile(path):
+            missing += 1
+            continue
+
+        if fromjson:
+            rows = featurecache.rows4json(path, docid)
+        else:
+            rows = featurecache.rows4csv(path)
+
+        position = (firstvolume + offset) * rowstride
+        for rowindex, (word, count) in enumerate(rows):
+            if word not in firstseen:
+                firstseen[word] = position + rowindex
+            doc_freq[word] += 1
+
+    spills = [[] for x in range(partitions)]
+    for word, df in doc_freq.items():
+        spills[partition_for(word, partitions)].append((word, df, firstseen[word]))
+
+    for partition, spill in enumerate(spills):
+        with open(spillpath(spilldir, chunkindex, partition), mode = 'wb') as f:
+            pickle.dump(spill, f, protocol = pickle.HIGHEST_PROTOCOL)
+
+    return missing
+
+def merge_partition(mergetuple):
+    ''' Adds up the spilled counts for one partition across all chunks,
+    and returns its n best words as (docfreq, firstposition, word) tuples.
+    '''
+
+    partition, chunkcount, spilldir, n = mergetuple
+
+    doc_freq = Counter()
+    firstseen = dict()
+
+    for chunkindex in range(chunkcount):
+        path = spillpath(spilldir, chunkindex, partition)
+        with open(path, mode = 'rb') as f:
+            spill = pickle.load(f)
+        os.remove(path)
+
+        for word, df, position in spill:
+            doc_freq[word] += df
+            if word not in firstseen or position < firstseen[word]:
+                firstseen[word] = position
+
+    candidates = [(-df, firstseen[word], word) for word, df in doc_freq.items()]
+    best = heapq.nsmallest(n, candidates)
+
+    return [(-negdf, position, word) for negdf, position, word in best]
+
+def build_vocabulary(docids, sourcedir, n, workers = 1, chunksize = 1000, partitions = 64, spilldir = None, fromjson = False):
+    ''' Returns the n words with the highest document frequency in
+    docids, as a list of (word, docfreq) pairs, in the same order as
+    get_vocabulary_and_counts would rank them. Features are read from
+    csvs in sourcedir, or .basic.json.bz2 files if fromjson is True.
+
+    Partial counts are spilled to spilldir (by default, a temporary
+    directory that is removed afterward).
+    '''
+
+    if spilldir is None:
+        workdir = tempfile.mkdtemp(prefix = 'vocabulary')
+    else:
+        workdir = spilldir
+        os.makedirs(workdir, exist_ok = True)
+
+    chunktuples = []
+    for floor in range(0, len(docids), chunksize):
+        chunktuples.append((len(chunktuples), floor, docids[floor : floor + chunksize], sourcedir, fromjson, partitions, workdir))
+
+    mergetuples = [(partition, len(chunktuples), workdir, n) for partition in range(partitions)]
+
+    try:
+        if workers > 1:
+            pool = Pool(processes = workers)
+            missing = sum(pool.imap_unordered(count_chunk, chunktuples))
+            partitionbests = pool.map(merge_partition, mergetuples)
+            pool.close()
+            pool.join()
+        else:
+            missing = sum(map(count_chunk, chunktuples))
+            partitionbests = list(map(merge_partition, mergetuples))
+    finally:
+        if spilldir is None:
+            shutil.rmtree(workdir, ignore_errors = True)
+
+    if missing > 0:
+        print(str(missing) + ' volumes missing from ' + sourcedir)
+
+    best = []
+    for partitionbest in partitionbests:
+        best.extend(partitionbest)
+
+    best.sort(key = lambda x: (-x[0], x[1]))
+
+    return [(word, df) for df, position, word in best[0 : n]]
+
+if __name__ == '__main__':
+
+    args = sys.argv
+
+    if len(args) >= 5:
+        metapath = args[1]
+        sourcedir = args[2]
+        n = int(args[3])
+        outpath = args[4]
+        if len(args) > 5:
+            workers = int(args[5])
+        else:
+            workers = 1
+
+        meta = pd.read_csv(metapath, index_col = 'docid', dtype = 'object')
+        vocabulary = build_vocabulary(meta.index.tolist(), sourcedir, n, workers = workers)
+
+        with open(outpath, mode = 'w', encoding = 'utf-8') as f:
+            f.write('word\tdocfreq\n')
+            for word, df in vocabulary:
+                f.write(word + '\t' + str(df) + '\n')
+
+    else:
+        print('Usage: python buildvocabulary.py metapath sourcedir n outpath [workers]')
@@ -1,7 +1,33 @@
 #!/usr/bin/env python3
 
-import csv, os, sys, glob
+# collate_results.py
+
+# Gathers the volumes predicted to be bio, dra, fic, or poe from every
+# shard of output in ../outmeta/, applies a few metadata rules, and
+# appends them to one csv per genre in ../collatedmeta/.
+
+# Shards are independent, so they're read and filtered by a pool of
+# worker processes; each returns its rows for each genre already
+# rendered as csv text, and the parent appends those to the four
+# output files (which it keeps open) in the same order as the shards,
+# as each shard is finished. Nothing larger than one shard's output
+# is held in memory.
+
+# Shards can also be Parquet or Feather files (see frameio.py); their
+# rows are rendered as the strings a csv would have held, so the rules
+# apply to them in exactly the same way. The collated output can be
+# written in one of those formats instead of csv, in which case each
+# shard's rows are still written as they arrive (see
+# frameio.ColumnarWriter), but the file replaces any existing one
+# rather than being appended to it.
+
+# Usage:
+#     python collate_results.py [workers] [csv|parquet|feather]
+
+import csv, io, os, sys, glob
 from collections import Counter
+from multiprocessing import Pool
+import pandas as pd
 
 # import utils
 currentdir = os.path.dirname(__file__)
@@ -10,130 +36,183 @@ sys.path.append(libpath)
 
 import SonicScrewdriver as utils
 
-filepaths = glob.glob('../outmeta/*.csv')
-genrestoget = {'bio', 'dra', 'fic', 'poe'}
+import frameio
 
-def write_genres(rows, firstflag):
-    global genrestoget
-    fieldnames = ['docid', 'recordid', 'oclc', 'locnum', 'author', 'authordate', 'imprint', 'inferreddate', 'datetype', 'startdate', 'enddate', 'imprintdate', 'place', 'enumcron', 'subjects', 'genres', 'geographics', 'contents', 'title', 'metadatalikely', 'metadatasuspicious', 'rawprobability', 'englishtop1000pct']
+genrestoget = {'bio', 'dra', 'fic', 'poe'}
+fieldnames = ['docid', 'recordid', 'oclc', 'locnum', 'author', 'authordate', 'imprint', 'inferreddate', 'datetype', 'startdate', 'enddate', 'imprintdate', 'place', 'enumcron', 'subjects', 'genres', 'geographics', 'contents', 'title', 'metadatalikely', 'metadatasuspicious', 'rawprobability', 'englishtop1000pct']
 
-    for g in genrestoget:
-        outpath = '../collatedmeta/' + g + 'post1922.csv'
-        with open(outpath, mode = 'a', encoding = 'utf-8') as f:
-            writer = csv.DictWriter(f, fieldnames = fieldnames, extrasaction = 'ignore')
-            if firstflag:
-                writer.writeheader()
-            for row in rows[g]:
-                writer.writerow(row)
+outputbuffer = 1024 * 1024
 
+def collate_row(row):
+    ''' Applies the collation rules to one row of implementmodel output.
+    Returns the genre it should be filed under and the row, rewritten
+    for output, or (None, None) if it should be left out.
+    '''
 
-def initialize_rows():
     global genrestoget
-    rows = dict()
-
-    for g in genrestoget:
-        rows[g] = []
-    return rows
-
-firstfile = True
-
-for path in filepaths:
-    rows = initialize_rows()
-    print(path)
-
-    # gather all the rows assigned to target genres
-    # in this file
-
-    with open(path, encoding = 'utf-8') as f:
-        reader = csv.DictReader(f)
-        fieldnames = reader.fieldnames
-        for row in reader:
-            pgenre = row['predictedgenre']
-            if pgenre not in genrestoget:
-                continue
-                # that will get rid of a lot of 'non'
-            english = float(row['englishpct'])
-            if english < 0.21:
-                continue
-                # these volumes are an odd lot
-                # around 0.22 you start getting
-                # early english texts, so we'll
-                # allow them in
-
-            for g in genrestoget:
-                if g != pgenre:
-                    row.pop(g)
-                    # There are columns in these rows for a Boolean flag
-                    # that report whether there is any reason to identify
-                    # this volume as bio, dra, fic, or poe. Pop the
-                    # columns not related to our genre.
-                else:
-                    row['metadatalikely'] = row.pop(pgenre)
-
-            row.pop('materialtype')
-            row.pop('language')
-            # we just don't need those; they're all "monograph - eng"
-
-            genres = set(row['genres'].split('|'))
-            subjects = set(row['subjects'].split('|'))
-            title = set(row['title'].lower().split())
-
-            if pgenre == 'fic' and ("Novel" in genres or "novel" in title):
-                row['metadatalikely'] = True
-            if pgenre == 'fic' and ("Fiction" in genres):
-                row['metadatalikely'] = True
-            if pgenre == 'poe' and ("poems" in title):
-                row['metadatalikely'] = True
-
-            if row['metadatalikely'] == True:
-                likely = True
-            else:
-                likely = False
-                row['metadatalikely'] = ''
-
-
-            suspicious = False
-
-            if pgenre != 'bio' and 'Directories' in subjects or 'Directories' in genres:
-                suspicious = True
-                # these are almost always errors;
-                # personal names get
-            if pgenre != 'bio' and 'Dictionary' in subjects or 'Dictionary' in genres:
-                suspicious = True
-                # these are almost always errors;
-                # personal names get
-
-            if pgenre != 'bio' and not likely and ("Biography" in genres or "Autobiography" in genres):
-                suspicious = True
-            if pgenre != 'bio' and  not likely and ("Biography" in subjects or "Autobiography" in subjects):
-                suspicious = True
-            elif pgenre != 'bio' and not likely and ("Description and travel" in genres or "Description and travel" in subjects):
-                suspicious = True
-            elif english < 0.45:
-                suspicious = True
-
-            if suspicious:
-                row['metadatasuspicious'] = True
-            else:
-                row['metadatasuspicious'] = ''
-
-            row['inferreddate'] = utils.date_row(row)
-            row['rawprobability'] = row.pop('probability')
-            row['englishtop1000pct'] = row.pop('englishpct')
-
-            rows[pgenre].append(row)
-
-    # now we have all the bio, dra, fic, and poe
-    # write them to file
-
-    write_genres(rows, firstfile)
-    firstfile = False
 
+    pgenre = row['predictedgenre']
+    if pgenre not in genrestoget:
+        return None, None
+        # that will get rid of a lot of 'non'
+    english = float(row['englishpct'])
+    if english < 0.21:
+        return None, None
+        # these volumes are an odd lot
+        # around 0.22 you start getting
+        # early english texts, so we'll
+        # allow them in
 
+    for g in genrestoget:
+        if g != pgenre:
+            row.pop(g)
+            # There are columns in these rows for a Boolean flag
+            # that report whether there is any reason to identify
+            # this volume as bio, dra, fic, or poe. Pop the
+            # columns not related to our genre.
+        else:
+            row['metadatalikely'] = row.pop(pgenre)
+
+    row.pop('materialtype')
+    row.pop('language')
+    # we just don't need those; they're all "monograph - eng"
+
+    genres = set(row['genres'].split('|'))
+    subjects = set(row['subjects'].split('|'))
+    title = set(row['title'].lower().split())
+
+    if pgenre == 'fic' and ("Novel" in genres or "novel" in title):
+        row['metadatalikely'] = True
+    if pgenre == 'fic' and ("Fiction" in genres):
+        row['metadatalikely'] = True
+    if pgenre == 'poe' and ("poems" in title):
+        row['metadatalikely'] = True
+
+    if row['metadatalikely'] == True:
+        likely = True
+    else:
+        likely = False
+        row['metadatalikely'] = ''
+
+
+    suspicious = False
+
+    if pgenre != 'bio' and 'Directories' in subjects or 'Directories' in genres:
+        suspicious = True
+        # these are almost always errors;
+        # personal names get
+    if pgenre != 'bio' and 'Dictionary' in subjects or 'Dictionary' in genres:
+        suspicious = True
+        # these are almost always errors;
+        # personal names get
+
+    if pgenre != 'bio' and not likely and ("Biography" in genres or "Autobiography" in genres):
+        suspicious = True
+    if pgenre != 'bio' and  not likely and ("Biography" in subjects or "Autobiography" in subjects):
+        suspicious = True
+    elif pgenre != 'bio' and not likely and ("Description and travel" in genres or "Description and travel" in subjects):
+        suspicious = True
+    elif english < 0.45:
+        suspicious = True
+
+    if suspicious:
+        row['metadatasuspicious'] = True
+    else:
+        row['metadatasuspicious'] = ''
+
+    row['inferreddate'] = utils.date_row(row)
+    row['rawprobability'] = row.pop('probability')
+    row['englishtop1000pct'] = row.pop('englishpct')
+
+    return pgenre, row
+
+def collate_file(path):
+    ''' Gathers all the rows assigned to target genres in one shard.
+    Returns a dictionary mapping each genre to its rows, rendered as
+    csv text. Designed to be mapped across a Pool.
+    '''
+
+    global genrestoget, fieldnames
+
+    buffers = dict()
+    writers = dict()
+    for g in genrestoget:
+        buffers[g] = io.StringIO()
+        writers[g] = csv.DictWriter(buffers[g], fieldnames = fieldnames, extrasaction = 'ignore')
 
+    for row in frameio.string_rows(path):
+        pgenre, row = collate_row(row)
+        if pgenre is not None:
+            writers[pgenre].writerow(row)
 
+    return {g: buffers[g].getvalue() for g in genrestoget}
 
+def collate(filepaths, outdir, workers = 1, outformat = 'csv'):
+    ''' Collates the shards in filepaths, appending the rows for each
+    genre to outdir/genrepost1922.csv in the order of filepaths. If
+    outformat is 'parquet' or 'feather', each genre is instead written
+    to a typed file in that format, still shard by shard as the rows
+    arrive, which replaces any existing file rather than being
+    appended to.
+    '''
 
+    global genrestoget, fieldnames
 
+    if len(filepaths) < 1:
+        return
 
+    # Now we have all the bio, dra, fic, and poe;
+    # write them to file.
 
+    outfiles = dict()
+    for g in genrestoget:
+        outpath = os.path.join(outdir, g + 'post1922.' + outformat)
+        if outformat == 'csv':
+            outfiles[g] = open(outpath, mode = 'a', encoding = 'utf-8', buffering = outputbuffer)
+            writer = csv.DictWriter(outfiles[g], fieldnames = fieldnames, extrasaction = 'ignore')
+            writer.writeheader()
+        else:
+            outfiles[g] = frameio.ColumnarWriter(outpath, fieldnames)
+
+    if workers > 1:
+        pool = Pool(processes = workers)
+        allcollated = pool.imap(collate_file, filepaths)
+    else:
+        allcollated = map(collate_file, filepaths)
+
+    try:
+        for path, collated in zip(filepaths, allcollated):
+            print(path)
+            for g in genrestoget:
+                if outformat == 'csv':
+                    outfiles[g].write(collated[g])
+                elif len(collated[g]) > 0:
+                    frame = pd.read_csv(io.StringIO(collated[g]), names = fieldnames, index_col = 'docid', dtype = 'object', keep_default_na = False, na_values = [''])
+                    outfiles[g].write(frame)
+    finally:
+        for g in genrestoget:
+            outfiles[g].close()
+
+        if workers > 1:
+            pool.close()
+            pool.join()
+
+if __name__ == '__main__':
+
+    args = sys.argv
+
+    if len(args) > 1:
+        workers = int(args[1])
+    else:
+        workers = 1
+
+    if len(args) > 2:
+        outformat = args[2]
+    else:
+        outformat = 'csv'
+
+    filepaths = glob.glob('../outmeta/*.csv')
+    for fileformat in frameio.columnarformats:
+        filepaths.extend(glob.glob('../outmeta/*.' + fileformat))
+
+    collate(filepaths, '../collatedmeta/', workers, outformat)
@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+
+# compilemodels.py
+
+# Every model exported by trainamodel.export_svm_model is a linear
+# svm.SVC (with probability = True) wrapped around a StandardScaler.
+# Asking sklearn for predict_proba therefore means scaling the features,
+# evaluating the kernel against every support vector, and then running
+# libsvm's Platt scaling.
+
+# Because the kernel is linear, all of that can be folded together.
+# If the scaler maps x to (x - mean) / scale, and the svm's primal
+# weights are w with intercept b, then the decision value is simply
+
+#     (w / scale) . x  +  (b - w . (mean / scale))
+
+# so each model compiles to one weight vector and one bias, plus
+# the Platt coefficients A and B that turn a decision value into
+# a probability. Several compiled models can also be stacked into a
+# single matrix over the union of their vocabularies, so that a whole
+# ensemble is applied with one matrix multiply.
+
+# Run this script as
+#     python compilemodels.py modeldir metapath sourcedir
+# to confirm that compiled models reproduce predict_proba on the
+# volumes in metapath.
+
+import os, sys, pickle, glob
+import numpy as np
+
+# libsvm clips pairwise probabilities to this range, and stops
+# its coupling iterations once the error is below eps / nr_class.
+
+min_prob = 1e-7
+coupling_eps = 0.005 / 2
+coupling_max_iter = 100
+
+def compile_model(model):
+    ''' Accepts a model dictionary of the kind exported by trainamodel,
+    and returns a dictionary with the vocabulary, a folded weight vector,
+    a bias, the Platt coefficients, and the class labels.
+    '''
+
+    scaler = model['scaler']
+    supportvector = model['svm']
+
+    primal = np.asarray(supportvector.coef_, dtype = np.float64).ravel()
+    intercept = float(np.ravel(supportvector.intercept_)[0])
+    mean = np.asarray(scaler.mean_, dtype = np.float64)
+    scale = np.asarray(scaler.scale_, dtype = np.float64)
+
+    compiled = dict()
+    compiled['vocabulary'] = list(model['vocabulary'])
+    compiled['weights'] = primal / scale
+    compiled['bias'] = intercept - np.dot(primal, mean / scale)
+    compiled['probA'] = float(np.ravel(supportvector.probA_)[0])
+    compiled['probB'] = float(np.ravel(supportvector.probB_)[0])
+    compiled['classes'] = np.asarray(supportvector.classes_)
+    compiled['positivelabel'] = model['positivelabel']
+    compiled['negativelabel'] = model['negativelabel']
+
+    return compiled
+
+def sigmoid_predict(decisions, probA, probB):
+    ''' Vectorized version of libsvm's sigmoid_predict, written the same
+    way so that large values of fApB don't overflow.
+    '''
+
+    fApB = decisions * probA + probB
+    positive = fApB >= 0
+
+    with np.errstate(over = 'ignore'):
+        aspositive = np.exp(-fApB) / (1.0 + np.exp(-fApB))
+        asnegative = 1.0 / (1 + np.exp(fApB))
+
+    return np.where(positive, aspositive, asnegative)
+
+def couple_binary(pairwise):
+    ''' libsvm doesn't report the Platt probability directly, even for
+    two classes; it passes the pairwise probability through an iterative
+    coupling procedure (multiclass_probability) that stops as soon as
+    it is within eps. To match predict_proba closely we replicate that
+    procedure here for k = 2, vectorized across volumes.
+
+    pairwise is the probability of the first class; returns the coupled
+    probability of the second class.
+    '''
+
+    r01 = np.asarray(pairwise, dtype = np.float64)
+    r10 = 1 - r01
+
+    Q = [[r10 * r10, -r10 * r01], [-r10 * r01, r01 * r01]]
+    p = [np.full(r01.shape, 0.5), np.full(r01.shape, 0.5)]
+    active = np.ones(r01.shape, dtype = bool)
+
+    for iteration in range(coupling_max_iter):
+        Qp = [Q[t][0] * p[0] + Q[t][1] * p[1] for t in range(2)]
+        pQp = p[0] * Qp[0] + p[1] * Qp[1]
+
+        maxerror = np.maximum(np.abs(Qp[0] - pQp), np.abs(Qp[1] - pQp))
+        active = active & ~(maxerror < coupling_eps)
+        if not active.any():
+            break
+
+        newp = list(p)
+        for t in range(2):
+            diff = (-Qp[t] + pQp) / Q[t][t]
+            newp[t] = newp[t] + diff
+            pQp = (pQp + diff * (diff * Q[t][t] + 2 * Qp[t])) / (1 + diff) / (1 + diff)
+            Qp = [(Qp[j] + diff * Q[t][j]) / (1 + diff) for j in range(2)]
+            newp = [newp[j] / (1 + diff) for j in range(2)]
+
+        # Rows that have already converged are left untouched, exactly
+        # as they would be if libsvm had broken out of its loop.
+
+        p = [np.where(active, newp[j], p[j]) for j in range(2)]
+
+    return p[1]
+
+def platt_probabilities(decisions, probA, probB):
+    ''' Converts sklearn decision values into predict_proba's probability
+    for the second (positive) class. sklearn flips the sign of libsvm's
+    decision values for binary problems, so we flip it back here.
+    '''
+
+    pairwise = sigmoid_predict(-decisions, probA, probB)
+    pairwise = np.clip(pairwise, min_prob, 1 - min_prob)
+
+    return couple_binary(pairwise)
+
+def compiled_predictions(compiled, matrix):
+    ''' Applies a compiled model to a matrix of raw (unscaled) counts,
+    with one row per volume and columns in the model's vocabulary order.
+    Returns predictions and positive-class probabilities, like
+    implementmodel.predictions_for_batch.
+    '''
+
+    matrix = np.atleast_2d(np.asarray(matrix, dtype = np.float64))
+    decisions = np.dot(matrix, compiled['weights']) + compiled['bias']
+
+    classes = compiled['classes']
+    predictions = np.where(decisions > 0, classes[1], classes[0])
+    probabilities = platt_probabilities(decisions, compiled['probA'], compiled['probB'])
+
+    return predictions, probabilities
+
+def union_columns(vocabularies):
+    ''' Accepts a dictionary mapping names to vocabularies, and returns
+    the union of the vocabularies (in order of first appearance) along
+    with a dictionary mapping each name to an integer array of the
+    positions of its words in the union.
+    '''
+
+    vocabulary = []
+    vocabindex = dict()
+    for name, words in vocabularies.items():
+        for word in words:
+            if word not in vocabindex:
+                vocabindex[word] = len(vocabulary)
+                vocabulary.append(word)
+
+    columns = dict()
+    for name, words in vocabularies.items():
+        columns[name] = np.array([vocabindex[word] for word in words], dtype = np.intp)
+
+    return vocabulary, columns
+
+def stack_models(compiledmodels):
+    ''' Stacks a dictionary of compiled models into one weight matrix
+    over the union of their vocabularies. Returns a dictionary with
+    the names (column order), the union vocabulary, the weight matrix
+    (vocabulary x models), and arrays of biases and Platt coefficients.
+    '''
+
+    names = list(compiledmodels.keys())
+    vocabulary, columns = union_columns({name: compiledmodels[name]['vocabulary'] for name in names})
+
+    weights = np.zeros((len(vocabulary), len(names)))
+    for col, name in enumerate(names):
+        weights[columns[name], col] = compiledmodels[name]['weights']
+
+    stack = dict()
+    stack['names'] = names
+    stack['vocabulary'] = vocabulary
+    stack['weights'] = weights
+    stack['bias'] = np.array([compiledmodels[x]['bias'] for x in names])
+    stack['probA'] = np.array([compiledmodels[x]['probA'] for x in names])
+    stack['probB'] = np.array([compiledmodels[x]['probB'] for x in names])
+    stack['classes'] = [compiledmodels[x]['classes'] for x in names]
+
+    return stack
+
+def stacked_predictions(stack, matrix):
+    ''' Applies every model in a stack to a matrix of raw counts whose
+    columns follow stack['vocabulary']. Returns a dictionary mapping
+    model name to (predictions, probabilities) arrays.
+    '''
+
+    matrix = np.atleast_2d(np.asarray(matrix, dtype = np.float64))
+    decisions = np.dot(matrix, stack['weights']) + stack['bias']
+
+    results = dict()
+    for col, name in enumerate(stack['names']):
+        classes = stack['classes'][col]
+        predictions = np.where(decisions[ : , col] > 0, classes[1], classes[0])
+        probabilities = platt_probabilities(decisions[ : , col], stack['probA'][col], stack['probB'][col])
+        results[name] = (predictions, probabilities)
+
+    return results
+
+def verify(modeldir, metapath, sourcedir, tolerance = 1e-6):
+    ''' Loads every pickled model in modeldir, applies it both through
+    sklearn and in compiled form to all the volumes listed in metapath,
+    and reports the largest difference in probability, along with any
+    disagreement in predicted class. Returns True if every model is
+    within tolerance.
+    '''
+
+    import pandas as pd
+    import implementmodel
+
+    meta = pd.read_csv(metapath, index_col = 'docid', dtype = 'object')
+
+    countslist = []
+    for docid in meta.index:
+        counts, error, wordcount = implementmodel.get_counts(sourcedir, docid, False)
+        if error == 'success':
+            countslist.append(counts)
+
+    print(str(len(countslist)) + ' volumes read.')
+
+    allgood = True
+    compiledmodels = dict()
+
+    for modelpath in sorted(glob.glob(os.path.join(modeldir, '*.p'))):
+        with open(modelpath, mode = 'rb') as f:
+            model = pickle.load(f)
+
+        name = os.path.basename(modelpath).replace('.p', '')
+        compiled = compile_model(model)
+        compiledmodels[name] = compiled
+
+        matrix = implementmodel.counts2matrix(model['vocabulary'], countslist)
+        scaledmatrix = model['scaler'].transform(matrix)
+        realpredictions = model['svm'].predict(scaledmatrix)
+        realprobs = model['svm'].predict_proba(scaledmatrix)[ : , 1]
+
+        predictions, probabilities = compiled_predictions(compiled, matrix)
+
+        maxdiff = np.max(np.abs(probabilities - realprobs))
+        disagreements = int(np.sum(predictions != realpredictions))
+        ok = maxdiff <= tolerance and disagreements == 0
+        allgood = allgood and ok
+
+        print(name, 'max probability difference:', maxdiff, 'prediction disagreements:', disagreements, 'OK' if ok else 'FAILED')
+
+    # And then check that stacking the whole ensemble gives the same
+    # answers as applying the compiled models one at a time.
+
+    stack = stack_models(compiledmodels)
+    matrix = implementmodel.counts2matrix(stack['vocabulary'], countslist)
+    stacked = stacked_predictions(stack, matrix)
+
+    for name, compiled in compiledmodels.items():
+        submatrix = implementmodel.counts2matrix(compiled['vocabulary'], countslist)
+        predictions, probabilities = compiled_predictions(compiled, submatrix)
+        maxdiff = np.max(np.abs(stacked[name][1] - probabilities))
+        if maxdiff > tolerance or np.any(stacked[name][0] != predictions):
+            print(name, 'stacked model disagrees with compiled model.')
+            allgood = False
+
+    if allgood:
+        print('All compiled models agree with predict_proba within ' + str(tolerance) + '.')
+
+    return allgood
+
+if __name__ == '__main__':
+
+    args = sys.argv
+
+    if len(args) >= 4:
+        modeldir = args[1]
+        metapath = args[2]
+        sourcedir = args[3]
+    else:
+        modeldir = 'models/'
+        metapath = 'maintrainingset.csv'
+        sourcedir = '/Volumes/TARDIS/work/train20'
+
+    ok = verify(modeldir, metapath, sourcedir)
+    if not ok:
+        sys.exit(1)
@@ -25,21 +25,32 @@ import SonicScrewdriver as utils
 import trainamodel
 import implementmodel
 
-def train_ensemble(trainingpath):
-
-    trainamodel.export_svm_model(trainingpath, '/Volumes/TARDIS/work/train20', 'fic', 'bio', 570, 0.009, 'crossmodels/ficvsbio.p')
-    trainamodel.export_svm_model(trainingpath, '/Volumes/TARDIS/work/train20', 'fic', '~fic', 850, 0.015, 'crossmodels/ficvsall.p')
-    trainamodel.export_svm_model(trainingpath, '/Volumes/TARDIS/work/train20', 'poe', '~poe', 260, 0.025, 'crossmodels/poevsall.p')
-    trainamodel.export_svm_model(trainingpath, '/Volumes/TARDIS/work/train20', 'dra', '~dra', 960, 0.01, 'crossmodels/dravsall.p')
-    trainamodel.export_svm_model(trainingpath, '/Volumes/TARDIS/work/train20', 'dra', 'poe', 1300, 0.015, 'crossmodels/dravspoe.p')
-    trainamodel.export_svm_model(trainingpath, '/Volumes/TARDIS/work/train20', 'fic', 'nonbio', 830, 0.002, 'crossmodels/ficvsnonbio.p')
-    trainamodel.export_svm_model(trainingpath, '/Volumes/TARDIS/work/train20', 'fic', 'dra', 1000, 0.01, 'crossmodels/ficvsdra.p')
-    trainamodel.export_svm_model(trainingpath, '/Volumes/TARDIS/work/train20', 'poe', 'nonbio', 550, 0.01, 'crossmodels/poevsnonbio.p')
-    trainamodel.export_svm_model(trainingpath, '/Volumes/TARDIS/work/train20', 'fic', 'poe', 60, 0.037, 'crossmodels/ficvspoe.p')
-    trainamodel.export_svm_model(trainingpath, '/Volumes/TARDIS/work/train20', 'poe', 'bio', 700, 0.009, 'crossmodels/poevsbio.p')
-    trainamodel.export_svm_model(trainingpath, '/Volumes/TARDIS/work/train20', 'dra', 'bio', 250, 0.007, 'crossmodels/dravsbio.p')
+# Each spec is (positivelabel, negativelabel, ftcount, c, outpath4model).
+
+ensemblespecs = [('fic', 'bio', 570, 0.009, 'crossmodels/ficvsbio.p'),
+    ('fic', '~fic', 850, 0.015, 'crossmodels/ficvsall.p'),
+    ('poe', '~poe', 260, 0.025, 'crossmodels/poevsall.p'),
+    ('dra', '~dra', 960, 0.01, 'crossmodels/dravsall.p'),
+    ('dra', 'poe', 1300, 0.015, 'crossmodels/dravspoe.p'),
+    ('fic', 'nonbio', 830, 0.002, 'crossmodels/ficvsnonbio.p'),
+    ('fic', 'dra', 1000, 0.01, 'crossmodels/ficvsdra.p'),
+    ('poe', 'nonbio', 550, 0.01, 'crossmodels/poevsnonbio.p'),
+    ('fic', 'poe', 60, 0.037, 'crossmodels/ficvspoe.p'),
+    ('poe', 'bio', 700, 0.009, 'crossmodels/poevsbio.p'),
+    ('dra', 'bio', 250, 0.007, 'crossmodels/dravsbio.p')]
+
+def train_ensemble(trainingpath, workers = 11):
+    # Counts for the training set are read once and shared by all
+    # eleven models, which are fit in parallel.
+
+    trainamodel.export_svm_models(trainingpath, '/Volumes/TARDIS/work/train20', ensemblespecs, workers = workers)
 
 def check_ensemble(testpath, outpath):
+    # Each run trains new models on new folds, so predictions left
+    # over from a previous run must not be kept.
+    if os.path.isfile(outpath):
+        os.remove(outpath)
+
     implementmodel.main(sourcedir = '/Volumes/TARDIS/work/train20', metapath = testpath, modeldir = 'crossmodels/', outpath = outpath)
 
 # MAIN SCRIPT BEGINS HERE
@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+
+# featurecache.py
+
+# Training a single model means reading every volume's feature csv
+# (in train20) through csv.DictReader, and an ensemble of eleven models,
+# or a grid search, reads the same files over and over. This module
+# converts those files, once, into a cache that can be memory-mapped:
+
+#     vocabulary.txt    one feature per line; line number is the term id
+#     docids.txt        one docid per line; line number is the row
+#     indptr.npy        row i occupies indices[indptr[i] : indptr[i + 1]]
+#     indices.npy       term ids
+#     data.npy          counts
+#     rows.npy          number of csv rows that contributed to each count
+#     featurecache.txt  a marker identifying the directory as a cache
+
+# In other words, a compressed sparse row matrix of volumes x features.
+# Header features (#headerword) are folded into body features, as in
+# trainamodel.get_vocabulary_and_counts. We record how many rows were
+# folded together because document frequency, as trainamodel calculates
+# it, counts rows rather than distinct words. Within each volume, terms
+# are stored in the order they first appear in its csv, so vocabularies
+# drawn from the cache break ties exactly as Counter.most_common does.
+
+# Anywhere trainamodel or implementmodel accept a "sourcedir" of csvs,
+# they will also accept the directory of a cache.
+
+# Usage:
+#     python featurecache.py metapath sourcedir cachedir [json]
+
+# With the "json" flag, features are read from .basic.json.bz2 files
+# in sourcedir instead of from csvs.
+
+import csv, os, sys
+from collections import Counter
+import numpy as np
+import pandas as pd
+
+# import utils
+currentdir = os.path.dirname(__file__)
+libpath = os.path.join(currentdir, '../lib')
+sys.path.append(libpath)
+
+import SonicScrewdriver as utils
+
+markerfile = 'featurecache.txt'
+
+# Remember which directories are caches, so that code calling is_cache
+# once per volume doesn't stat the marker file once per volume.
+
+cachechecks = dict()
+
+def is_cache(sourcedir):
+    ''' True if sourcedir is a directory created by build_cache.
+    '''
+    global cachechecks
+
+    if sourcedir not in cachechecks:
+        cachechecks[sourcedir] = os.path.isfile(os.path.join(sourcedir, markerfile))
+
+    return cachechecks[sourcedir]
+
+def fold_header(word):
+    if word.startswith('#header'):
+        word = word.replace('#header', '')
+    return word
+
+def rows4csv(path):
+    ''' Reads a feature csv and returns a list of (word, count) pairs,
+    with header features folded into the body, in file order.
+    '''
+    rows = []
+    with open(path, encoding = 'utf-8') as f:
+        reader = csv.DictReader(f)
+        for row in reader:
+            word = row['feature']
+            if len(word) < 1:
+                continue
+
+            rows.append((fold_header(word), float(row['count'])))
+
+    return rows
+
+def rows4json(path, docid):
+    ''' Reads a .basic.json.bz2 file and returns a list of (word, count)
+    pairs, with header features folded into the body.
+    '''
+    import parsefeaturejsons as parser
+
+    volume = parser.VolumeFromJson(path, docid)
+    counts, totalwords = volume.get_volume_features()
+
+    rows = []
+    for word, count in counts.items():
+        if len(word) < 1:
+            continue
+        rows.append((fold_header(word), float(count)))
+
+    return rows
+
+def build_cache(metapath, sourcedir, cachedir, fromjson = False):
+    ''' Reads features for every docid in metapath from sourcedir and
+    writes them to a cache in cachedir. Volumes whose files are missing
+    are reported and left out of the cache.
+    '''
+
+    meta = pd.read_csv(metapath, index_col = 'docid', dtype = 'object')
+
+    vocabindex = dict()
+    vocabulary = []
+    docids = []
+    seen = set()
+    indptr = [0]
+    allindices = []
+    alldata = []
+    allrows = []
+
+    missing = 0
+
+    for docid in meta.index:
+        if docid in seen:
+            continue
+        seen.add(docid)
+
+        if fromjson:
+            path = os.path.join(sourcedir, utils.clean_pairtree(docid) + '.basic.json.bz2')
+        else:
+            path = os.path.join(sourcedir, utils.clean_pairtree(docid) + '.csv')
+
+        if not os.path.isfile(path):
+            print('Missing: ' + path)
+            missing += 1
+            continue
+
+        if fromjson:
+            rows = rows4json(path, docid)
+        else:
+            rows = rows4csv(path)
+
+        # Sum the counts for each word, keeping the order in which
+        # words first appear.
+
+        counts = Counter()
+        rowcounts = Counter()
+        for word, count in rows:
+            counts[word] += count
+            rowcounts[word] += 1
+
+        for word in counts:
+            if word not in vocabindex:
+                vocabindex[word] = len(vocabulary)
+                vocabulary.append(word)
+
+        allindices.append(np.array([vocabindex[x] for x in counts], dtype = np.int32))
+        alldata.append(np.array(list(counts.values()), dtype = np.float64))
+        allrows.append(np.array(list(rowcounts.values()), dtype = np.int32))
+        indptr.append(indptr[-1] + len(counts))
+        docids.append(docid)
+
+        if len(docids) % 1000 == 0:
+            print(len(docids))
+
+    if not os.path.isdir(cachedir):
+        os.makedirs(cachedir)
+
+    def concatenated(arrays, dtype):
+        if len(arrays) > 0:
+            return np.concatenate(arrays)
+        else:
+            return np.zeros(0, dtype = dtype)
+
+    np.save(os.path.join(cachedir, 'indptr.npy'), np.array(indptr, dtype = np.int64))
+    np.save(os.path.join(cachedir, 'indices.npy'), concatenated(allindices, np.int32))
+    np.save(os.path.join(cachedir, 'data.npy'), concatenated(alldata, np.float64))
+    np.save(os.path.join(cachedir, 'rows.npy'), concatenated(allrows, np.int32))
+
+    with open(os.path.join(cachedir, 'vocabulary.txt'), mode = 'w', encoding = 'utf-8', newline = '\n') as f:
+        for word in vocabulary:
+            f.write(word + '\n')
+
+    with open(os.path.join(cachedir, 'docids.txt'), mode = 'w', encoding = 'utf-8') as f:
+        for docid in docids:
+            f.write(docid + '\n')
+
+    # The marker goes last, so a half-written cache is never mistaken
+    # for a complete one.
+
+    with open(os.path.join(cachedir, markerfile), mode = 'w', encoding = 'utf-8') as f:
+        f.write('volumes\t' + str(len(docids)) + '\n')
+        f.write('features\t' + str(len(vocabulary)) + '\n')
+        f.write('source\t' + os.path.abspath(sourcedir) + '\n')
+
+    print('Cached ' + str(len(docids)) + ' volumes and ' + str(len(vocabulary)) + ' features; ' + str(missing) + ' missing.')
+
+class FeatureCache:
+    ''' Read-only access to a cache written by build_cache. The arrays
+    are memory-mapped, so processes that open the same cache share
+    one copy of the pages.
+    '''
+
+    def __init__(self, cachedir):
+        self.cachedir = cachedir
+
+        with open(os.path.join(cachedir, 'vocabulary.txt'), encoding = 'utf-8', newline = '\n') as f:
+            self.vocabulary = [x.rstrip('\n') for x in f]
+        self.vocabindex = {word: idx for idx, word in enumerate(self.vocabulary)}
+
+        with open(os.path.join(cachedir, 'docids.txt'), encoding = 'utf-8') as f:
+            self.docids = [x.rstrip('\n') for x in f]
+        self.rowindex = {docid: idx for idx, docid in enumerate(self.docids)}
+
+        self.indptr = np.load(os.path.join(cachedir, 'indptr.npy'), mmap_mode = 'r')
+        self.indices = np.load(os.path.join(cachedir, 'indices.npy'), mmap_mode = 'r')
+        self.data = np.load(os.path.join(cachedir, 'data.npy'), mmap_mode = 'r')
+        self.rows = np.load(os.path.join(cachedir, 'rows.npy'), mmap_mode = 'r')
+
+    def __contains__(self, docid):
+        return docid in self.rowindex
+
+    def span(self, docid):
+        row = self.rowindex[docid]
+        return self.indptr[row], self.indptr[row + 1]
+
+    def counts(self, docid):
+        ''' Returns a Counter of features for docid, like the counts that
+        trainamodel.get_vocabulary_and_counts builds from a csv.
+        '''
+        start, end = self.span(docid)
+        words = [self.vocabulary[x] for x in self.indices[start : end]]
+        return Counter(dict(zip(words, self.data[start : end].tolist())))
+
+    def top_features(self, docids, n):
+        ''' Returns the n features with highest document frequency in
+        docids, in the same order trainamodel.get_vocabulary_and_counts
+        would produce (ties broken by order of first appearance).
+        '''
+
+        spans = [self.span(docid) for docid in docids]
+        terms = np.concatenate([np.asarray(self.indices[s : e]) for s, e in spans] + [np.zeros(0, dtype = np.int32)])
+        rowcounts = np.concatenate([np.asarray(self.rows[s : e]) for s, e in spans] + [np.zeros(0, dtype = np.int32)])
+
+        docfreq = np.bincount(terms, weights = rowcounts, minlength = len(self.vocabulary))
+        uniqueterms, firstseen = np.unique(terms, return_index = True)
+
+        order = np.lexsort((firstseen, -docfreq[uniqueterms]))
+        return [self.vocabulary[x] for x in uniqueterms[order[0 : n]]]
+
+    def matrix(self, docids, vocabulary):
+        ''' Returns a dense numpy array with a row for each docid and
+        a column for each feature in vocabulary.
+        '''
+
+        columns = np.full(len(self.vocabulary), -1, dtype = np.int64)
+        for col, word in enumerate(vocabulary):
+            if word in self.vocabindex:
+                columns[self.vocabindex[word]] = col
+
+        matrix = np.zeros((len(docids), len(vocabulary)))
+
+        for row, docid in enumerate(docids):
+            start, end = self.span(docid)
+            cols = columns[self.indices[start : end]]
+            present = cols >= 0
+            matrix[row, cols[present]] = self.data[start : end][present]
+
+        return matrix
+
+# Caches are opened once per process and then reused.
+
+opencaches = dict()
+
+def open_cache(cachedir):
+    global opencaches
+
+    key = os.path.abspath(cachedir)
+    if key not in opencaches:
+        opencaches[key] = FeatureCache(cachedir)
+
+    return opencaches[key]
+
+if __name__ == '__main__':
+
+    args = sys.argv
+
+    if len(args) >= 4:
+        metapath = args[1]
+        sourcedir = args[2]
+        cachedir = args[3]
+        fromjson = len(args) > 4 and args[4] == 'json'
+        build_cache(metapath, sourcedir, cachedir, fromjson)
+
+    else:
+        build_cache('maintrainingset.csv', '/Volumes/TARDIS/work/train20', '/Volumes/TARDIS/work/train20cache')
@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+
+# frameio.py
+
+# Every stage of the pipeline hands the next one a csv: implementmodel
+# writes predicted metadata, collate_results writes the post1922 files,
+# subfiction/concatframes.py gathers fic*.csv into annotatedfiction.csv,
+# and subfiction/filterframes.py splits that into the final filtered
+# sets. Each stage reads its input back with dtype = 'object' and then
+# coerces columns with pd.to_numeric, which for files of several
+# gigabytes is slow and uses a great deal of memory.
+
+# With this module, any of those stages can write and read a typed
+# columnar file (Parquet or Feather) instead. The format is chosen by
+# the file's extension (.parquet, .feather, or anything else for csv),
+# so a stage switches format when it's given a different path. Before
+# a frame is written in a columnar format, probabilities and other
+# measurements are made float, word counts integer, and genre flags
+# boolean (with a missing value where a csv would have an empty field).
+
+# Columnar formats need pyarrow, which is optional; without it only
+# csv can be read or written. The last stage still writes csv, and
+# any intermediate file can be exported as csv with
+
+#     python frameio.py inpath outpath
+
+# which converts between any two formats.
+
+import csv, os, sys
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+floatcolumns = ['probability', 'englishpct', 'rawprobability', 'englishtop1000pct', 'nonficprob', 'juvenileprob']
+integercolumns = ['wordcount']
+booleancolumns = ['bio', 'dra', 'fic', 'poe', 'metadatalikely', 'metadatasuspicious']
+
+columnarformats = ['parquet', 'feather']
+
+def frame_format(path):
+    ''' Returns 'parquet', 'feather', or 'csv' for a path, by its
+    extension. A trailing .partial (see runshards.py) is ignored.
+    '''
+
+    if path.endswith('.partial'):
+        path = path[0 : -len('.partial')]
+
+    extension = os.path.splitext(path)[1].lstrip('.').lower()
+    if extension in columnarformats:
+        return extension
+    else:
+        return 'csv'
+
+def require_pyarrow(path):
+    if pyarrow is None:
+        raise ImportError('Reading or writing ' + path + ' requires pyarrow.')
+
+def is_true(series):
+    ''' True where a flag is set, whether the column holds booleans
+    (from a columnar file) or the strings 'True' and 'False' (from a csv).
+    '''
+    return series.astype(str) == 'True'
+
+def as_float(x):
+    ''' Parses one value as a float, or NaN if it isn't a number.
+    pd.to_numeric would be faster, but it rounds some strings to a
+    neighbouring float, so values wouldn't survive a round trip.
+    '''
+    try:
+        return float(x)
+    except (TypeError, ValueError):
+        return np.nan
+
+def typed(frame):
+    ''' Returns a copy of frame with the columns we know about converted
+    to float, integer, and boolean types. Anything that isn't a number,
+    or isn't True or False, becomes a missing value.
+    '''
+
+    frame = frame.copy()
+
+    for col in floatcolumns:
+        if col in frame.columns and frame[col].dtype != np.float64:
+            frame[col] = frame[col].map(as_float).astype(np.float64)
+
+    for col in integercolumns:
+        if col in frame.columns and frame[col].dtype.kind not in 'iuf':
+            values = frame[col].map(as_float).astype(np.float64)
+            if (values.dropna() % 1 == 0).all():
+                frame[col] = values.astype('Int64')
+            else:
+                frame[col] = values.astype(np.float64)
+
+    flags = {True: True, False: False, 'True': True, 'False': False}
+    for col in booleancolumns:
+        if col in frame.columns and frame[col].dtype != 'boolean':
+            frame[col] = frame[col].map(lambda x: flags.get(x, pd.NA) if isinstance(x, (bool, str)) else pd.NA).astype('boolean')
+
+    return frame
+
+def read_frame(path, index_col = 'docid', exact = False):
+    ''' Reads a frame in whatever format path's extension names. A csv
+    is read exactly as the pipeline always has, with every column as
+    strings; a columnar file comes back with its types.
+
+    By default pandas reads strings like 'NA' in a csv as missing values.
+    If exact is True, only empty fields are missing, so that a frame
+    converted to another format keeps what the csv actually says (the
+    genre 'NA', for instance).
+    '''
+
+    fileformat = frame_format(path)
+
+    if fileformat == 'csv' and exact:
+        return pd.read_csv(path, index_col = index_col, dtype = 'object', keep_default_na = False, na_values = [''])
+    elif fileformat == 'csv':
+        return pd.read_csv(path, index_col = index_col, dtype = 'object')
+
+    require_pyarrow(path)
+
+    if fileformat == 'parquet':
+        frame = pd.read_parquet(path)
+    else:
+        frame = pd.read_feather(path)
+
+    if index_col is not None and index_col in frame.columns:
+        frame = frame.set_index(index_col)
+
+    # A file written a chunk at a time by a ColumnarWriter has no pandas
+    # metadata, so flags with missing values come back as objects.
+    return typed(frame)
+
+def write_frame(frame, path):
+    ''' Writes a frame (with its index) in the format path's extension
+    names; columnar formats are typed first.
+    '''
+
+    fileformat = frame_format(path)
+
+    if fileformat == 'csv':
+        frame.to_csv(path)
+        return
+
+    require_pyarrow(path)
+    frame = typed(frame)
+
+    if fileformat == 'parquet':
+        frame.to_parquet(path)
+    else:
+        # Feather doesn't store an index.
+        frame.reset_index().to_feather(path)
+
+def arrow_type(col):
+    if col in floatcolumns:
+        return pyarrow.float64()
+    elif col in integercolumns:
+        return pyarrow.int64()
+    elif col in booleancolumns:
+        return pyarrow.bool_()
+    else:
+        return pyarrow.string()
+
+class ColumnarWriter:
+    ''' Writes a Parquet or Feather file a chunk at a time, so that the
+    whole frame is never held in memory. columns lists every column
+    to be written, including the index (which is written as a column).
+    Every chunk must have the same columns.
+    '''
+
+    def __init__(self, path, columns):
+        require_pyarrow(path)
+        self.schema = pyarrow.schema([(col, arrow_type(col)) for col in columns])
+
+        if frame_format(path) == 'parquet':
+            self.writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+        else:
+            # Feather (version 2) is the Arrow IPC file format.
+            self.writer = pyarrow.ipc.new_file(path, self.schema)
+
+    def write(self, frame):
+        if len(frame) < 1:
+            return
+        frame = typed(frame).reset_index()
+        self.writer.write_table(pyarrow.Table.from_pandas(frame, schema = self.schema, preserve_index = False))
+
+    def close(self):
+        self.writer.close()
+
+def csv_strings(series):
+    ''' Renders a column as the strings to_csv would have written and
+    csv.DictReader would have read back.
+    '''
+
+    def render(x):
+        if x is None or x is pd.NA or (isinstance(x, float) and np.isnan(x)):
+            return ''
+        else:
+            return str(x)
+
+    return [render(x) for x in series.tolist()]
+
+def string_rows(path):
+    ''' Yields the rows of a file as dictionaries of strings, as
+    csv.DictReader would read them from the csv version of the file,
+    whatever format it's actually in.
+    '''
+
+    if frame_format(path) == 'csv':
+        with open(path, encoding = 'utf-8') as f:
+            for row in csv.DictReader(f):
+                yield row
+        return
+
+    frame = read_frame(path, index_col = None)
+    if frame.index.name is not None:
+        frame = frame.reset_index()
+
+    columns = [csv_strings(frame[col]) for col in frame.columns]
+    for values in zip(*columns):
+        yield dict(zip(frame.columns, values))
+
+def streaming_path(outpath):
+    ''' implementmodel and implementsubfic append their output to a csv
+    a chunk at a time (see streamwriter.py). If outpath is columnar,
+    returns the csv to stream to instead; it's converted at the end
+    by finish_stream. Only that csv (and its checkpoint) says whether
+    there is a run to resume, so a finished columnar output is replaced
+    by a rerun, like a finished csv.
+    '''
+
+    if frame_format(outpath) == 'csv':
+        return outpath
+    else:
+        require_pyarrow(outpath)
+        return outpath + '.stream'
+
+def finish_stream(streampath, outpath):
+    if streampath != outpath:
+        write_frame(read_frame(streampath, exact = True), outpath)
+        os.remove(streampath)
+
+if __name__ == '__main__':
+
+    args = sys.argv
+
+    if len(args) >= 3:
+        write_frame(read_frame(args[1], exact = True), args[2])
+
+    else:
+        print('Usage: python frameio.py inpath outpath')
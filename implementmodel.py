@@ -51,8 +51,10 @@
 # the peculiarities of the training set.
 
 
-import csv, os, sys, pickle
+import csv, io, os, sys, pickle, time
 from collections import Counter
+from itertools import chain
+from multiprocessing import Pool
 import numpy as np
 import pandas as pd
 
@@ -70,6 +72,16 @@ sys.path.append(libpath)
 import SonicScrewdriver as utils
 import parsefeaturejsons as parser
 
+import compilemodels
+import featurecache
+import jsonfeatures
+import frameio
+import modelbundle
+import pairtreeindex
+import pipelinetimer
+import prefetcher
+import streamwriter
+
 # Establish some global variables:
 
 onevsallnames = ['ficvsall', 'poevsall', 'dravsall']
@@ -86,54 +98,50 @@ with open(dictionarypath, encoding = 'utf-8') as f:
     for line in f:
         top1000words.add(line.strip())
 
-def get_metadata(metapath):
-    ''' Returns the metadata as a pandas dataframe, translating strings
-    to simpler boolean flags.
+# Metadata flags are set by simple rules about the genres, subjects,
+# and title of each volume. A flag is True if any of its rules match.
+# Each rule is (column, kind, value), where kind is either
+#     'element'     value is one of the |-separated items in the column
+#     'substring'   value occurs somewhere in the lowercased column
+
+flagrules = dict()
+flagrules['bio'] = [('genres', 'element', 'Biography'), ('subjects', 'element', 'Biography'),
+    ('genres', 'element', 'Autobiography'), ('subjects', 'element', 'Autobiography'),
+    ('subjects', 'element', 'Description and travel')]
+flagrules['dra'] = [('genres', 'element', 'Drama'), ('title', 'substring', 'plays')]
+flagrules['fic'] = [('genres', 'element', 'Fiction')]
+flagrules['poe'] = [('genres', 'element', 'Poetry'), ('title', 'substring', 'poems')]
+
+def rule_matches(meta, column, kind, value):
+    ''' Evaluates one rule for every row of meta at once, returning
+    a boolean numpy array.
     '''
 
-    meta = pd.read_csv(metapath, index_col = 'docid', dtype = 'object')
-
-    newdata = dict()
-    newdata['bio'] = []
-    newdata['fic'] = []
-    newdata['poe'] = []
-    newdata['dra'] = []
-
-    for idx in meta.index:
-        genres = str(meta.loc[idx, 'genres']).split('|')
-        subjects = str(meta.loc[idx, 'subjects']).split('|')
-        title = str(meta.loc[idx, 'title'].lower())
-
-        dra = False
-        fic = False
-        poe = False
-        bio = False
+    # missing values are treated as the string 'nan', as str() would
+    strings = meta[column].fillna('nan').astype(str)
 
-        if 'Biography' in genres or 'Biography' in subjects:
-            bio = True
-
-        if 'Autobiography' in genres or 'Autobiography' in subjects:
-            bio = True
-
-        if 'Description and travel' in subjects:
-            bio = True
-
-        if 'Fiction' in genres:
-            fic = True
+    if kind == 'element':
+        # padding with separators lets us match whole items only
+        padded = '|' + strings + '|'
+        matches = padded.str.contains('|' + value + '|', regex = False)
+    else:
+        matches = strings.str.lower().str.contains(value, regex = False)
 
-        if 'Poetry' in genres or 'poems' in title:
-            poe = True
+    return matches.to_numpy(dtype = bool)
 
-        if 'Drama' in genres or 'plays' in title:
-            dra = True
+def get_metadata(metapath):
+    ''' Returns the metadata as a pandas dataframe, translating strings
+    to simpler boolean flags.
+    '''
 
-        newdata['bio'].append(bio)
-        newdata['dra'].append(dra)
-        newdata['fic'].append(fic)
-        newdata['poe'].append(poe)
+    meta = pd.read_csv(metapath, index_col = 'docid', dtype = 'object')
 
     for genre in ['bio', 'dra', 'fic', 'poe']:
-        meta.loc[ :, genre] = pd.Series(newdata[genre], index = meta.index)
+        flag = np.zeros(len(meta), dtype = bool)
+        for column, kind, value in flagrules[genre]:
+            flag = flag | rule_matches(meta, column, kind, value)
+
+        meta.loc[ :, genre] = pd.Series(flag, index = meta.index)
 
     return meta
 
@@ -159,14 +167,62 @@ def loadamodel(modelname):
 
     return model
 
-def counts4file(filepath):
+# Whether a word is alphabetic, and whether it's one of top1000words,
+# is worked out once per distinct word and remembered across volumes;
+# like jsonfeatures' token caches, this is cleared if it grows too big.
+
+tokenclasses = dict()
+
+def token_class(word):
+    '''
+    Returns (isalpha, isenglish) for a word, as get_english_percent
+    would classify it.
+    '''
+
+    global tokenclasses, top1000words
+
+    entry = tokenclasses.get(word)
+    if entry is None:
+        if len(tokenclasses) > jsonfeatures.maxcached:
+            tokenclasses.clear()
+        isalpha = word.isalpha()
+        entry = (isalpha, isalpha and word in top1000words)
+        tokenclasses[word] = entry
+
+    return entry
+
+class ParsedCounts(Counter):
+    '''
+    A volume's counts, along with the total counts of alphabetic words
+    and of top1000words, which are accumulated as the volume is parsed
+    so that get_english_percent needn't walk the counts again.
+    '''
+
+    alphatotal = 0
+    englishtotal = 0
+
+class RestrictedCounts(ParsedCounts):
+    '''
+    Counts for the words in an inference vocabulary only (see
+    inference_vocabulary); the totals still cover every word in the
+    volume.
+    '''
+
+def counts4file(filepath, keep = None):
     '''
     Gets counts for a single file.
     Importantly, this is exactly the same
     script used in trainamodel.
+
+    If keep is a set of words, only those words are counted; the
+    result is then a RestrictedCounts. Otherwise it's a ParsedCounts.
     '''
 
-    counts = Counter()
+    if keep is None:
+        counts = ParsedCounts()
+    else:
+        counts = RestrictedCounts()
+
     try:
         with open(filepath, encoding = 'utf-8') as f:
             reader = csv.DictReader(f)
@@ -187,7 +243,14 @@ def counts4file(filepath):
                 # Otherwise header words are in practice just discarded, because
                 # e.g. #headeract won't be one of the top 250 words.
 
-                counts[word] += ct
+                isalpha, isenglish = token_class(word)
+                if isalpha:
+                    counts.alphatotal += ct
+                    if isenglish:
+                        counts.englishtotal += ct
+
+                if keep is None or word in keep:
+                    counts[word] += ct
 
         return counts, 'success', 0
 
@@ -224,19 +287,137 @@ def onevolume2frame(vocabulary, counts):
 
 def prediction_for_file(model, counts):
     vocabulary = model['vocabulary']
-    df = onevolume2frame(vocabulary, counts)
-    scaler = model['scaler']
-    scaleddf = scaler.transform(df)
+
+    if 'compiled' in model:
+        # one dot product instead of scaler + svm
+        predictions, probabilities = compilemodels.compiled_predictions(model['compiled'], counts2matrix(vocabulary, [counts]))
+        return predictions[0], probabilities[0]
+
+    with pipelinetimer.stage('feature matrix'):
+        df = onevolume2frame(vocabulary, counts)
+    with pipelinetimer.stage('scaler'):
+        scaler = model['scaler']
+        scaleddf = scaler.transform(df)
     supportvector = model['svm']
 
     # The [0][1] at the end of the next two lines select the
     # prediction for the first volume [0] and positive class [1].
 
-    prediction = supportvector.predict(scaleddf)[0]
-    probability = supportvector.predict_proba(scaleddf)[0][1]
+    with pipelinetimer.stage('svm'):
+        prediction = supportvector.predict(scaleddf)[0]
+        probability = supportvector.predict_proba(scaleddf)[0][1]
 
     return prediction, probability
 
+def counts2matrix(vocabulary, countslist):
+    '''
+    Batched version of onevolume2frame. Accepts a list of count
+    dictionaries, one per volume, and returns a numpy array with
+    a row for each volume and columns in vocabulary order.
+    '''
+
+    matrix = np.zeros((len(countslist), len(vocabulary)))
+
+    for row, counts in enumerate(countslist):
+        matrix[row, : ] = [counts.get(v, 0) for v in vocabulary]
+
+    return matrix
+
+def feature_space(models):
+    '''
+    Returns a dictionary with the union of the models' vocabularies
+    ('vocabulary'), and for each model an array of the positions of
+    its own vocabulary in the union ('columns'). The top words in
+    different models overlap heavily, so it's cheaper to build one
+    matrix of counts over the union and let each model gather its
+    columns from that than to look up every model's words separately.
+    '''
+
+    vocabularies = {name: model['vocabulary'] for name, model in models.items()}
+    vocabulary, columns = compilemodels.union_columns(vocabularies)
+
+    return {'vocabulary': vocabulary, 'columns': columns}
+
+def predictions_for_batch(model, countslist):
+    '''
+    Scores a whole batch of volumes with a single model, so that
+    the scaler and svm are each called once per batch instead of
+    once per volume. Returns arrays of predictions and of probabilities
+    for the positive class.
+    '''
+
+    with pipelinetimer.stage('feature matrix'):
+        matrix = counts2matrix(model['vocabulary'], countslist)
+
+    return predictions_for_matrix(model, matrix)
+
+def predictions_for_matrix(model, matrix):
+    '''
+    Applies a single model to a matrix of counts whose columns are in
+    the model's vocabulary order, as counts2matrix would build it, or as
+    gathered from a matrix over a feature_space.
+    '''
+
+    if 'compiled' in model:
+        return compilemodels.compiled_predictions(model['compiled'], matrix)
+
+    with pipelinetimer.stage('scaler'):
+        scaledmatrix = model['scaler'].transform(matrix)
+    supportvector = model['svm']
+
+    with pipelinetimer.stage('svm'):
+        predictions = supportvector.predict(scaledmatrix)
+        probabilities = supportvector.predict_proba(scaledmatrix)[ : , 1]
+
+    return predictions, probabilities
+
+def score_batch(models, countslist, stack = None):
+    '''
+    Runs every model in the ensemble once over a batch of volumes.
+    Returns a list with one dictionary per volume, mapping model name
+    to the (prediction, probability) pair that prediction_for_file
+    would have produced for that volume.
+
+    If stack is supplied (see compilemodels.stack_models), the whole
+    ensemble is applied with a single matrix multiply.
+    '''
+
+    scores = [dict() for counts in countslist]
+
+    if len(countslist) < 1:
+        return scores
+
+    if stack is not None:
+        with pipelinetimer.stage('feature matrix'):
+            matrix = counts2matrix(stack['vocabulary'], countslist)
+        with pipelinetimer.stage('stacked ensemble'):
+            modelresults = compilemodels.stacked_predictions(stack, matrix)
+    else:
+        modelresults = dict()
+        for name, model in models.items():
+            with pipelinetimer.stage('model ' + name):
+                modelresults[name] = predictions_for_batch(model, countslist)
+
+    for name, (predictions, probabilities) in modelresults.items():
+        for idx, volumescores in enumerate(scores):
+            volumescores[name] = (predictions[idx], probabilities[idx])
+
+    return scores
+
+def get_prediction(models, name, counts4volume, scores = None):
+    '''
+    Returns (prediction, probability) for the model called name, either
+    from scores precomputed by score_batch, or by applying the model
+    to this volume directly.
+    '''
+
+    pipelinetimer.count_model(name)
+
+    if scores is not None:
+        return scores[name]
+    else:
+        return prediction_for_file(models[name], counts4volume)
+
 def make_genredict(metadata, docid):
     ''' This converts a row of a pandas dataframe into a
     simpler dictionary representation. We expect all of
@@ -252,9 +433,67 @@ def make_genredict(metadata, docid):
     return genres
 
 
-def volume_classification(models, counts4volume, genredict):
+def volume_classification(models, counts4volume, genredict, scores = None, space = None):
+    ''' Applies the ensemble to a single volume. If scores is supplied,
+    it should be this volume's dictionary from score_batch, and model
+    outputs will be looked up there instead of computed.
+
+    Models are evaluated lazily, as the rules in classification_cascade
+    ask for them, and each at most once. If space (from feature_space)
+    is supplied, the volume's counts are looked up once, over the whole
+    union vocabulary, and each model gathers its columns from that.
+    '''
+
+    memo = dict()
+    unionvector = []
+
+    def predict(name):
+        if name in memo:
+            return memo[name]
+
+        if scores is None and space is not None:
+            if len(unionvector) < 1:
+                with pipelinetimer.stage('feature matrix'):
+                    unionvector.append(counts2matrix(space['vocabulary'], [counts4volume]))
+            pipelinetimer.count_model(name)
+            predictions, probabilities = predictions_for_matrix(models[name], unionvector[0][ : , space['columns'][name]])
+            memo[name] = (predictions[0], probabilities[0])
+        else:
+            memo[name] = get_prediction(models, name, counts4volume, scores)
+
+        return memo[name]
+
+    return classification_cascade(models, genredict, predict)
+
+class MissingScores(Exception):
+    '''
+    Raised by the predict function classify_batch hands to
+    classification_cascade, when the cascade asks for models that
+    haven't yet been scored for this volume.
+    '''
+
+    def __init__(self, names):
+        Exception.__init__(self, ', '.join(names))
+        self.names = names
+
+def classification_cascade(models, genredict, predict, prefetch = None):
+    ''' The ad-hoc rules that turn model outputs into a genre for one
+    volume. predict(name) should return (prediction, probability) for
+    the named model. If prefetch is supplied, it's called with a list
+    of model names just before the cascade needs all of them, so that
+    a caller scoring volumes in batches can request them together.
+
+    Models are only consulted when their output can change the result.
+    In particular, a one-vs-all model for a genre the metadata already
+    flags can't change which genres are attested, so it only runs if
+    that genre is the one we end up checking.
+    '''
+
     global onevsallnames, onevsonenames, gauntletnames
 
+    if prefetch is None:
+        prefetch = lambda names: None
+
     allgenres = ['bio', 'dra', 'fic', 'poe']
 
     # Basically, the purpose of onevsall classification is
@@ -267,12 +506,30 @@ def volume_classification(models, counts4volume, genredict):
     onevsall_probs = dict()
     explanation = 'no competition'
 
+    onevsall_byclass = dict()
+    for m in onevsallnames:
+        onevsall_byclass[models[m]['positivelabel']] = m
+
+    def onevsall_probability(genre):
+        # Deferred one-vs-all models are run here, when first needed.
+        if genre not in onevsall_probs:
+            prediction, probability = predict(onevsall_byclass[genre])
+            onevsall_probs[genre] = probability
+        return onevsall_probs[genre]
+
+    prefetch([m for m in onevsallnames if genredict.get(models[m]['positivelabel']) != True])
+
     for m in onevsallnames:
 
         model = models[m]
         positiveclass = model['positivelabel']
 
-        prediction, probability = prediction_for_file(model, counts4volume)
+        if genredict.get(positiveclass) == True:
+            # Already flagged by metadata, so attested whatever the
+            # model says; see onevsall_probability.
+            continue
+
+        prediction, probability = predict(m)
 
         if probability > 0.5:
             genredict[positiveclass] = True
@@ -309,6 +566,24 @@ def volume_classification(models, counts4volume, genredict):
         for g in allgenres:
             onevsone_probs[g] = []
 
+        # Each pair of genres comes up in both orders, and uses the same
+        # model both times; predict() evaluates it once.
+
+        pairnames = []
+        for g1 in attested:
+            for g2 in attested:
+                if g1 == g2:
+                    continue
+                elif g1 + 'vs' + g2 in models:
+                    name = g1 + 'vs' + g2
+                elif g2 + 'vs' + g1 in models:
+                    name = g2 + 'vs' + g1
+                else:
+                    continue
+                if name not in pairnames:
+                    pairnames.append(name)
+        prefetch(pairnames)
+
         for g1 in attested:
             for g2 in attested:
                 if g1 == g2:
@@ -322,16 +597,17 @@ def volume_classification(models, counts4volume, genredict):
                 secondorder = g2 + 'vs' + g1
 
                 if firstorder in models:
-                    model2use = models[firstorder]
+                    name2use = firstorder
                 elif secondorder in models:
-                    model2use = models[secondorder]
+                    name2use = secondorder
                 else:
                     # we have no model for this conflict
                     continue
 
+                model2use = models[name2use]
                 positiveclass = model2use['positivelabel']
                 negativeclass = model2use['negativelabel']
-                prediction, probability = prediction_for_file(model2use, counts4volume)
+                prediction, probability = predict(name2use)
 
                 onevsone_probs[positiveclass].append(probability)
                 onevsone_probs[negativeclass].append(1 - probability)
@@ -355,26 +631,26 @@ def volume_classification(models, counts4volume, genredict):
         print('after other genres were attested.')
 
     elif tocheck == 'dra':
-        return 'dra', (maxprob + onevsall_probs['dra']) / 2, explanation
+        return 'dra', (maxprob + onevsall_probability('dra')) / 2, explanation
 
     elif tocheck == 'bio':
         return 'bio', maxprob, explanation
 
     else:
         assert (tocheck == 'fic' or tocheck == 'poe')
-        assert tocheck in onevsall_probs
+        assert tocheck in onevsall_byclass
 
-        previousprob = onevsall_probs[tocheck]
+        previousprob = onevsall_probability(tocheck)
 
         if previousprob < 0.70 and tocheck == 'poe' or previousprob < 0.85 and tocheck == 'fic':
             # we need to confirm this
 
             if tocheck == 'fic':
-                confirmationmodel = models['ficvsnonbio']
+                confirmationname = 'ficvsnonbio'
             elif tocheck == 'poe':
-                confirmationmodel = models['poevsnonbio']
+                confirmationname = 'poevsnonbio'
 
-            prediction, confirmation_probability = prediction_for_file(confirmationmodel, counts4volume)
+            prediction, confirmation_probability = predict(confirmationname)
 
             # this is now an up-or-down vote, based on the prediction,
             # but we do use the probability to calculate an overall
@@ -395,16 +671,28 @@ def get_english_percent(counts, top1000englishwords):
     Percent of words in a volume that are contained in the set
     top1000words; to be used later to weed out non-English books.
     '''
+    global top1000words
+
     allalpha = 0
     allenglish = 0
 
-    for word, count in counts.items():
-        if not word.isalpha():
-            continue
-        else:
-            allalpha += count
-            if word in top1000englishwords:
-                allenglish += count
+    if isinstance(counts, ParsedCounts) and top1000englishwords is top1000words:
+        # both totals were accumulated in parsing
+        allalpha = counts.alphatotal
+        allenglish = counts.englishtotal
+
+    else:
+        for word, count in counts.items():
+            if not word.isalpha():
+                continue
+            else:
+                allalpha += count
+                if word in top1000englishwords:
+                    allenglish += count
+
+        if isinstance(counts, RestrictedCounts):
+            # words outside the vocabulary were dropped, but totaled, in parsing
+            allalpha = counts.alphatotal
 
     if allalpha == 0:
         return 0
@@ -419,102 +707,617 @@ def get_pairtree(pairtreeroot, htid):
 
     return wholepath
 
-def counts4json(path, docid):
-    if os.path.isfile(path):
+def counts4json(path, docid, reader = None, data = None, exists = None):
+    '''
+    Reads a volume's extracted-feature file. If a jsonfeatures.VolumeReader
+    is supplied, it does the parsing; the counts are the same either way.
+    data, if supplied, is the file's contents, already read by a
+    prefetcher.Prefetcher; whichever parser is used reads that from
+    memory instead of opening the file again.
+    exists, if known (from a prefetcher or a pairtreeindex), saves
+    checking whether the file is there.
+    '''
+    if exists is None:
+        exists = data is not None or os.path.isfile(path)
+
+    if exists:
+        source = path if data is None else data
         try:
-            volume = parser.VolumeFromJson(path, docid)
+            if reader is not None and reader.vocabulary is not None:
+                vector, totalwords, alphatotal, englishtotal = reader.vector(source)
+                flatcounts = RestrictedCounts({reader.vocabulary[x]: int(vector[x]) for x in np.nonzero(vector)[0]})
+                flatcounts.alphatotal = alphatotal
+                flatcounts.englishtotal = englishtotal
+                return flatcounts, 'success', totalwords
+
+            elif reader is not None:
+                flatcounts, totalwords, alphatotal, englishtotal = reader.counts(source, ParsedCounts())
+                flatcounts.alphatotal = alphatotal
+                flatcounts.englishtotal = englishtotal
+                return flatcounts, 'success', totalwords
+
+            # bz2.open, inside VolumeFromJson, accepts a file object
+            # as well as a path.
+            volume = parser.VolumeFromJson(path if data is None else io.BytesIO(data), docid)
             counts, totalwords = volume.get_volume_features()
-            flatcounts = Counter()
+            flatcounts = ParsedCounts()
             for key, value in counts.items():
                 if key.startswith('#header'):
                     newkey = key.replace('#header', '')
-                    flatcounts[newkey] += value
                 else:
-                    flatcounts[key] += value
+                    newkey = key
+                flatcounts[newkey] += value
+
+                isalpha, isenglish = token_class(newkey)
+                if isalpha:
+                    flatcounts.alphatotal += value
+                    if isenglish:
+                        flatcounts.englishtotal += value
 
             return flatcounts, 'success', totalwords
 
+        except FileNotFoundError:
+            # a pairtreeindex can list a volume deleted since it was built
+            return Counter(), 'file not found', 0
         except:
             return Counter(), 'parsing failure', 0
     else:
         return Counter(), 'file not found', 0
 
 
-def main(sourcedir, metapath, modeldir, outpath, pairtree = False):
+def get_counts(sourcedir, docid, pairtree, reader = None, keep = None, fetched = None):
+    '''
+    Reads the features for one volume, from a pairtree of json files,
+    a featurecache, or a flat directory of csvs. keep, if given, is
+    the set of words to retain from csvs; for json, the reader's own
+    vocabulary decides. fetched, if given, is the (path, data) pair a
+    prefetcher.Prefetcher returned for this volume's json, or (path,
+    None) from a pairtreeindex; a path of None means it wasn't found.
     '''
-    This function can be called from outside the module; it accepts
-    path information and then iterates through all the files it
-    finds in the metadata at "metapath."
 
-    If the pairtree flag is True, we assume sourcedir is the root
-    of a pairtree structure. Otherwise we assume it's a flat list.
+    if pairtree and fetched is not None:
+        path, data = fetched
+        if path is None:
+            counts, error, wordcount = Counter(), 'file not found', 0
+        else:
+            with pipelinetimer.stage('read json'):
+                counts, error, wordcount = counts4json(path, docid, reader, data, exists = True)
+    elif pairtree:
+        with pipelinetimer.stage('resolve path'):
+            path = get_pairtree(sourcedir, docid)
+        with pipelinetimer.stage('read json'):
+            counts, error, wordcount = counts4json(path, docid, reader)
+    elif featurecache.is_cache(sourcedir):
+        with pipelinetimer.stage('read cache'):
+            cache = featurecache.open_cache(sourcedir)
+            if docid in cache:
+                counts, error, wordcount = cache.counts(docid), 'success', 0
+            else:
+                counts, error, wordcount = Counter(), 'file not found', 0
+    else:
+        with pipelinetimer.stage('resolve path'):
+            path = os.path.join(sourcedir, utils.clean_pairtree(docid) + '.csv')
+        with pipelinetimer.stage('read csv'):
+            counts, error, wordcount = counts4file(path, keep)
+
+    return counts, error, wordcount
+
+def demand_functions(volumescores):
+    '''
+    Returns predict and prefetch functions for classification_cascade
+    that look up scores already computed for a volume, and raise
+    MissingScores for any that haven't been.
     '''
 
-    global allnames, top1000words
+    def predict(name):
+        if name not in volumescores:
+            raise MissingScores([name])
+        return volumescores[name]
 
-    # We're going to store all the models, by name, in a dictionary:
+    def prefetch(names):
+        missing = [x for x in names if x not in volumescores]
+        if len(missing) > 0:
+            raise MissingScores(missing)
 
-    models = dict()
+    return predict, prefetch
 
-    for name in allnames:
-        models[name] = loadamodel(modeldir + name)
+def classify_on_demand(models, countslist, genredicts, space = None):
+    '''
+    Applies classification_cascade to a batch of volumes, scoring each
+    model only for the volumes that need it. This proceeds in rounds:
+    each unfinished volume runs through the cascade as far as it can
+    with the scores computed so far, and reports the models it needs
+    next; then each of those models is applied, once, to all the
+    volumes that asked for it. No volume needs more than four rounds.
+
+    Counts are read into one matrix over the union vocabulary of space
+    (built from models if it isn't supplied), and each model gathers
+    its rows and columns from that matrix.
+
+    Returns a list of (genre, probability, explanation) tuples, the
+    same ones volume_classification would return.
+    '''
 
-    # Now get metadata.
+    if space is None:
+        space = feature_space(models)
 
-    metadata = get_metadata(metapath)
+    with pipelinetimer.stage('feature matrix'):
+        matrix = counts2matrix(space['vocabulary'], countslist)
 
-    predictedgenres = []
-    predictedprobs = []
-    explanations = []
-    wordcounts = []
-    englishpcts = []
+    scores = [dict() for counts in countslist]
+    outcomes = [None] * len(countslist)
+    pending = list(range(len(countslist)))
 
-    c = 0
-    for docid in metadata.index:
-        print(c)
-        c += 1
+    while len(pending) > 0:
+        needs = dict()
+        stillpending = []
 
-        if pairtree:
-            path = get_pairtree(sourcedir, docid)
-            counts, error, wordcount = counts4json(path, docid)
+        with pipelinetimer.stage('volume classification'):
+            for idx in pending:
+                predict, prefetch = demand_functions(scores[idx])
+
+                # The cascade flags genres in genredict as it goes, so an
+                # unfinished attempt works on a copy.
+
+                trial = dict(genredicts[idx])
+                try:
+                    outcomes[idx] = classification_cascade(models, trial, predict, prefetch)
+                except MissingScores as missing:
+                    stillpending.append(idx)
+                    for name in missing.names:
+                        needs.setdefault(name, []).append(idx)
+                else:
+                    genredicts[idx].update(trial)
+
+        for name, idxs in needs.items():
+            with pipelinetimer.stage('model ' + name):
+                submatrix = matrix[np.ix_(idxs, space['columns'][name])]
+                predictions, probabilities = predictions_for_matrix(models[name], submatrix)
+            for row, idx in enumerate(idxs):
+                scores[idx][name] = (predictions[row], probabilities[row])
+                pipelinetimer.count_model(name)
+
+        pending = stillpending
+
+    return outcomes
+
+def json_candidates(sourcedir, docid, index = None):
+    '''
+    Returns a list of the paths where docid's json might be: the one
+    in index, if an index (see pairtreeindex.py) is supplied and has
+    it, or else the one get_pairtree builds.
+    '''
+
+    if index is None:
+        return [get_pairtree(sourcedir, docid)]
+    elif docid in index:
+        return [index.path_for(docid)]
+    else:
+        return []
+
+def fetch_all(fetcher, chunks, sourcedir, pairtree, index = None):
+    '''
+    Starts reading the json for every volume in chunks, a list of
+    (docids, genredicts), on fetcher's threads, and returns the stream
+    of results that classify_batch takes each batch's volumes from; or
+    None if there's no fetcher or no pairtree.
+    '''
+    if pairtree and fetcher is not None:
+        requests = ((docid, json_candidates(sourcedir, docid, index)) for docids, genredicts in chunks for docid in docids)
+        return fetcher.fetch(requests)
+    else:
+        return None
+
+def classify_batch(models, docids, genredicts, sourcedir, pairtree, stack = None, reader = None, keep = None, space = None, fetches = None, index = None):
+    '''
+    Reads and classifies a batch of volumes. The volumes that were
+    successfully read are scored together: with a stack of compiled
+    models, by applying the whole ensemble at once (score_batch);
+    otherwise by classify_on_demand, which applies each model only
+    to the volumes whose cascade needs it. genredicts should be a list
+    of dictionaries from make_genredict, parallel to docids.
+
+    Returns a list of (genre, probability, explanation, wordcount,
+    englishpct) tuples, in the same order as docids.
+
+    reader, if supplied, is the jsonfeatures.VolumeReader used to
+    parse a pairtree, and keep the set of words to retain from csvs.
+    space is the feature_space passed on to classify_on_demand. If
+    fetches (a stream from fetch_all) is supplied, the json files for
+    this batch are the next ones in it, read ahead on a prefetcher's
+    threads while earlier volumes are parsed and scored. If index (a pairtreeindex.PairtreeIndex) is supplied, paths
+    are looked up there instead of checked on disk.
+    '''
+
+    global top1000words
+
+    # If a pipelinetimer is running, each volume's latency is the time
+    # spent reading and classifying it, plus an equal share of the time
+    # spent scoring its batch.
+
+    profiling = pipelinetimer.running()
+    readtimes = []
+
+    if pairtree and fetches is not None:
+        sources = prefetcher.take(fetches, docids)
+    elif pairtree and index is not None:
+        sources = [(index.path_for(docid), None) for docid in docids]
+    else:
+        sources = [None] * len(docids)
+
+    volumes = []
+    for docid, genredict, fetched in zip(docids, genredicts, sources):
+        if profiling:
+            begun = time.perf_counter()
+        counts, error, wordcount = get_counts(sourcedir, docid, pairtree, reader, keep, fetched)
+        volumes.append((genredict, counts, error, wordcount))
+        if profiling:
+            readtimes.append(time.perf_counter() - begun)
+
+    goodcounts = [counts for genredict, counts, error, wordcount in volumes if error == 'success']
+    goodgenredicts = [genredict for genredict, counts, error, wordcount in volumes if error == 'success']
+
+    with pipelinetimer.stage('score batch') as scoring:
+        if stack is not None:
+            allscores = score_batch(models, goodcounts, stack)
+            outcomes = None
         else:
-            path = os.path.join(sourcedir, utils.clean_pairtree(docid) + '.csv')
-            counts, error, wordcount = counts4file(path)
+            outcomes = classify_on_demand(models, goodcounts, goodgenredicts, space)
+    if profiling and len(goodcounts) > 0:
+        scoreshare = (time.perf_counter() - scoring.begun) / len(goodcounts)
+
+    results = []
+    scoreidx = 0
+
+    for volidx, (genredict, counts, error, wordcount) in enumerate(volumes):
+        if profiling:
+            begun = time.perf_counter()
 
         if error == 'success':
-            genredict = make_genredict(metadata, docid)
-            englishpct = get_english_percent(counts, top1000words)
-            genre, probability, explanation = volume_classification(models, counts, genredict)
+            with pipelinetimer.stage('english percent'):
+                englishpct = get_english_percent(counts, top1000words)
+            if outcomes is None:
+                with pipelinetimer.stage('volume classification'):
+                    genre, probability, explanation = volume_classification(models, counts, genredict, allscores[scoreidx])
+            else:
+                genre, probability, explanation = outcomes[scoreidx]
+            scoreidx += 1
         else:
             englishpct = 0
             genre = 'NA'
             probability = 0
             explanation = error
 
-        predictedgenres.append(genre)
-        predictedprobs.append(probability)
-        explanations.append(explanation)
-        wordcounts.append(wordcount)
-        englishpcts.append(englishpct)
+        results.append((genre, probability, explanation, wordcount, englishpct))
+
+        if profiling:
+            latency = readtimes[volidx] + time.perf_counter() - begun
+            if error == 'success':
+                latency += scoreshare
+            pipelinetimer.add_volume(latency)
+
+    return results
+
+def load_ensemble(modeldir, compiled):
+    '''
+    Loads all the models in allnames from modeldir. If compiled is True,
+    also folds them into linear kernels and stacks them. Returns the
+    dictionary of models, and the stack (or None).
+
+    modeldir can also be the path to a bundle (see modelbundle.py),
+    whose models are already compiled and stacked.
+    '''
+
+    global allnames
 
-    metadata.loc[ : , 'predictedgenre'] = pd.Series(predictedgenres, index = metadata.index)
-    metadata.loc[ : , 'probability'] = pd.Series(predictedprobs, index = metadata.index)
-    metadata.loc[ : , 'wordcount'] = pd.Series(wordcounts, index = metadata.index)
-    metadata.loc[ : , 'englishpct'] = pd.Series(englishpcts, index = metadata.index)
-    metadata.loc[ : , 'explanation'] = pd.Series(explanations, index = metadata.index)
+    if modelbundle.is_bundle(modeldir):
+        with pipelinetimer.stage('load models'):
+            bundled, stack = modelbundle.load_bundle(modeldir)
+        models = {name: bundled[name] for name in allnames}
 
-    metadata.to_csv(outpath)
+        # The order of the stack's columns affects the order in which
+        # the union vocabulary is summed, and so the last bits of each
+        # probability; restack unless the bundle's order already matches
+        # what compiled = True would produce from the pickles.
+
+        if stack['names'] != allnames:
+            stack = compilemodels.stack_models({name: model['compiled'] for name, model in models.items()})
+
+        return models, stack
+
+    models = dict()
+
+    with pipelinetimer.stage('load models'):
+        for name in allnames:
+            models[name] = loadamodel(modeldir + name)
+
+    if compiled:
+        for name, model in models.items():
+            model['compiled'] = compilemodels.compile_model(model)
+        stack = compilemodels.stack_models({name: model['compiled'] for name, model in models.items()})
+    else:
+        stack = None
+
+    return models, stack
+
+def inference_vocabulary(models):
+    '''
+    Returns a list of every word classify_batch will ever look up: the
+    union of the models' vocabularies, plus top1000words for
+    get_english_percent. Everything else can be discarded in parsing.
+    '''
+
+    global allnames, top1000words
+
+    vocabulary = []
+    seen = set()
+
+    for name in allnames:
+        for word in models[name]['vocabulary']:
+            if word not in seen:
+                seen.add(word)
+                vocabulary.append(word)
+
+    for word in sorted(top1000words):
+        if word not in seen:
+            seen.add(word)
+            vocabulary.append(word)
+
+    return vocabulary
+
+def make_reader(fastjson, keep = None):
+    global top1000words
+
+    if keep is not None:
+        return jsonfeatures.VolumeReader(keep, top1000words)
+    elif fastjson:
+        return jsonfeatures.VolumeReader(english = top1000words)
+    else:
+        return None
+
+def make_keepset(models, restrict):
+    if restrict:
+        return inference_vocabulary(models)
+    else:
+        return None
+
+# When main runs with more than one worker, each process in the pool
+# loads the ensemble once, into this dictionary, and then classifies
+# whatever chunks of the metadata it is handed.
+
+workerstate = dict()
+
+def initialize_worker(modeldir, compiled, sourcedir, pairtree, fastjson, restrict, profile, prefetch, indexpath):
+    global workerstate
+
+    # If an initializer raises, Pool replaces the worker with another
+    # that fails the same way, forever. So an error here is kept, and
+    # raised by classify_group instead, where it reaches main.
+
+    try:
+        start_worker(modeldir, compiled, sourcedir, pairtree, fastjson, restrict, profile, prefetch, indexpath)
+    except Exception as error:
+        workerstate['error'] = error
+
+def start_worker(modeldir, compiled, sourcedir, pairtree, fastjson, restrict, profile, prefetch, indexpath):
+    global workerstate
+
+    if profile:
+        pipelinetimer.start()
+
+    models, stack = load_ensemble(modeldir, compiled)
+    keep = make_keepset(models, restrict)
+    workerstate['models'] = models
+    workerstate['stack'] = stack
+    workerstate['space'] = feature_space(models) if stack is None else None
+    workerstate['sourcedir'] = sourcedir
+    workerstate['pairtree'] = pairtree
+    workerstate['reader'] = make_reader(fastjson, keep)
+    workerstate['keep'] = None if keep is None else set(keep)
+    workerstate['fetcher'] = prefetcher.make_prefetcher(prefetch)
+    workerstate['index'] = None if indexpath is None else pairtreeindex.open_index(indexpath)
+
+def classify_group(group):
+    '''
+    Classifies a group of consecutive chunks of (docids, genredicts)
+    inside a worker process, prefetching across all of them (see
+    prefetcher.task_groups). Designed to be mapped across a Pool.
+    Returns, for each chunk, the results and this worker's timings for
+    the chunk (or None if it isn't profiling).
+    '''
+
+    global workerstate
+
+    if 'error' in workerstate:
+        raise workerstate['error']
+
+    fetches = fetch_all(workerstate['fetcher'], group, workerstate['sourcedir'], workerstate['pairtree'], workerstate['index'])
+
+    allresults = []
+    for docids, genredicts in group:
+        results = classify_batch(workerstate['models'], docids, genredicts, workerstate['sourcedir'], workerstate['pairtree'], workerstate['stack'], workerstate['reader'], workerstate['keep'], workerstate['space'], fetches, workerstate['index'])
+        allresults.append((results, pipelinetimer.snapshot()))
+
+    return allresults
+
+def main(sourcedir, metapath, modeldir, outpath, pairtree = False, batchsize = 100, compiled = False, workers = 1, fastjson = False, restrict = False, profilepath = None, profileevery = None, prefetch = 0, indexpath = None):
+    '''
+    This function can be called from outside the module; it accepts
+    path information and then iterates through all the files it
+    finds in the metadata at "metapath."
+
+    If the pairtree flag is True, we assume sourcedir is the root
+    of a pairtree structure. Otherwise we assume it's a flat list.
+
+    Volumes are read and scored in batches of batchsize; each model
+    is applied once per batch rather than once per volume.
+
+    If compiled is True, the pickled svms are folded into linear
+    weights (see compilemodels.py) and the ensemble is applied as
+    one matrix multiply per batch. Probabilities then match
+    predict_proba to within floating-point error, rather than exactly.
+    If modeldir is a bundle (see modelbundle.py), models are always
+    compiled, and the bundle is shared between workers through a
+    memory map.
+
+    If workers is more than 1, batches are handed out to a pool
+    of that many processes, each of which loads the models once.
+    Results are collected in metadata order either way.
+
+    If fastjson is True, json files in a pairtree are parsed by
+    jsonfeatures.VolumeReader rather than parsefeaturejsons.
+
+    If restrict is True, parsing keeps only the words in
+    inference_vocabulary(models) and discards the rest as it goes,
+    which saves memory and hashing. Output is unchanged.
+
+    If prefetch is more than 0, that many threads in each process read
+    json files from the pairtree ahead of the volume being parsed (see
+    prefetcher.py), so that filesystem latency overlaps with parsing
+    and classification. Reads run on across batches: with one process
+    over the whole run, and with several over each group of chunks a
+    worker is handed.
+
+    If indexpath names an index built by pairtreeindex.py for sourcedir,
+    paths are looked up there rather than checked on disk, and volumes
+    missing from the index are counted before the run begins.
+
+    If profilepath is given, time spent in each stage of the pipeline,
+    calls to each model, and per-volume latencies are recorded (see
+    pipelinetimer.py) and written there as json at the end of the run,
+    and also every profileevery volumes if that is set.
+
+    Rows are appended to outpath as each batch is finished, with a
+    checkpoint (see streamwriter.py). If a run is interrupted, calling
+    main again with the same outpath picks up where it left off. An
+    output left by a run that finished is replaced, not added to.
+
+    If outpath ends in .parquet or .feather, rows are streamed to a csv
+    beside it (outpath plus '.stream') and written out in that typed
+    columnar format when the run is complete (see frameio.py). It's the
+    .stream file that an interrupted run resumes from; a finished
+    columnar output is replaced by a rerun, just as a finished csv is.
+    '''
+
+    # Get metadata, skip any volumes already classified in a previous
+    # run, and divide the rest into chunks.
+
+    metadata = get_metadata(metapath)
+
+    streampath = frameio.streaming_path(outpath)
+    writer = streamwriter.StreamingWriter(streampath)
+    done = writer.completed()
+    if len(done) > 0:
+        print('Resuming: ' + str(len(done)) + ' volumes already classified.')
+
+    profile = profilepath is not None
+    if profile:
+        timer = pipelinetimer.start()
+
+    try:
+        positions = [idx for idx, docid in enumerate(metadata.index) if docid not in done]
+
+        if pairtree and indexpath is not None:
+            index = pairtreeindex.open_index(indexpath)
+            missing = index.missing(metadata.index[positions])
+            if len(missing) > 0:
+                print(str(len(missing)) + ' volumes are missing from ' + indexpath)
+        else:
+            index = None
+
+        chunks = []
+        for floor in range(0, len(positions), batchsize):
+            chunkframe = metadata.iloc[positions[floor : floor + batchsize]]
+            docids = chunkframe.index.tolist()
+            genredicts = [make_genredict(chunkframe, docid) for docid in docids]
+            chunks.append((docids, genredicts))
+
+        if workers > 1:
+            pool = Pool(processes = workers, initializer = initialize_worker, initargs = (modeldir, compiled, sourcedir, pairtree, fastjson, restrict, profile, prefetch, None if index is None else indexpath))
+            groups = prefetcher.task_groups(chunks, workers, prefetch)
+            allresults = chain.from_iterable(pool.imap(classify_group, groups))
+        else:
+            # We're going to store all the models, by name, in a dictionary:
+            models, stack = load_ensemble(modeldir, compiled)
+            keep = make_keepset(models, restrict)
+            reader = make_reader(fastjson, keep)
+            keepset = None if keep is None else set(keep)
+            space = feature_space(models) if stack is None else None
+            fetcher = prefetcher.make_prefetcher(prefetch)
+            fetches = fetch_all(fetcher, chunks, sourcedir, pairtree, index)
+            allresults = ((classify_batch(models, docids, genredicts, sourcedir, pairtree, stack, reader, keepset, space, fetches, index), None) for docids, genredicts in chunks)
+
+        # imap, like the generator above, yields results in the order
+        # of chunks (flattened out of their groups), so rows stay
+        # aligned with the metadata.
+
+        c = len(done)
+        finished = False
+        try:
+            for chunkidx, (results, timings) in enumerate(allresults):
+                print(c)
+                previous = c
+                c += len(results)
+
+                if profile and timings is not None:
+                    timer.merge(timings)
+
+                chunkframe = metadata.iloc[positions[chunkidx * batchsize : (chunkidx + 1) * batchsize]].copy()
+                genres, probabilities, explanations, wordcounts, englishpcts = zip(*results)
+
+                # Probabilities and englishpct are declared float so that a chunk
+                # containing only whole numbers is written the same way as it
+                # would be in a single frame for the whole run.
+
+                chunkframe.loc[ : , 'predictedgenre'] = pd.Series(genres, index = chunkframe.index)
+                chunkframe.loc[ : , 'probability'] = pd.Series(probabilities, index = chunkframe.index, dtype = 'float64')
+                chunkframe.loc[ : , 'wordcount'] = pd.Series(wordcounts, index = chunkframe.index)
+                chunkframe.loc[ : , 'englishpct'] = pd.Series(englishpcts, index = chunkframe.index, dtype = 'float64')
+                chunkframe.loc[ : , 'explanation'] = pd.Series(explanations, index = chunkframe.index)
+
+                with pipelinetimer.stage('write output'):
+                    writer.append(chunkframe)
+
+                if profile and profileevery and c // profileevery > previous // profileevery:
+                    timer.write(profilepath)
+
+            finished = True
+
+        finally:
+            # After an error, don't leave workers classifying chunks
+            # that will never be written.
+            if workers > 1 and finished:
+                pool.close()
+                pool.join()
+            elif workers > 1:
+                pool.terminate()
+                pool.join()
+            elif fetcher is not None:
+                fetcher.close()
+
+        writer.finish()
+        frameio.finish_stream(streampath, outpath)
+
+        if profile:
+            timer.write(profilepath)
+    finally:
+        pipelinetimer.stop()
 
 if __name__ == '__main__':
 
     args = sys.argv
 
-    if len(args) == 3:
+    if len(args) == 3 or len(args) == 4:
+        # optional third argument is the number of worker processes
+        if len(args) == 4:
+            workers = int(args[3])
+        else:
+            workers = 1
         sourcedir = '/projects/ichass/usesofscale/post23/englishmonographs1920-79/'
         metapath = args[1]
         modeldir = '../models/'
         outpath = args[2]
-        main(sourcedir, metapath, modeldir, outpath, pairtree = True)
+        main(sourcedir, metapath, modeldir, outpath, pairtree = True, workers = workers)
 
     else:
         main(sourcedir = '/Volumes/TARDIS/work/train20', metapath = 'maintrainingset.csv', modeldir = 'models/', outpath = 'predicted_metadata.csv', pairtree = False)
@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+
+# jsonfeatures.py
+
+# A faster way to get volume-level token counts out of the HathiTrust
+# extracted-feature files (.json.bz2) in a pairtree.
+
+# implementmodel.counts4json goes through parsefeaturejsons.VolumeFromJson,
+# which decompresses the whole file into one string, parses all of it
+# (metadata, line counts, character counts, everything) into nested
+# dictionaries, and builds a Counter with separate #header keys that
+# counts4json then has to fold back into the body. For classification
+# we only need the summed tokenPosCount for each word.
+
+# The reader below decompresses the file a block at a time, and parses
+# the page list incrementally, one page object at a time, so the whole
+# document is never held in memory. Counts are accumulated as they are
+# parsed, with #header tokens folded in exactly as counts4json folds them.
+# Normalization of each distinct token is cached, so a word that occurs
+# on four hundred pages is lowercased and folded once.
+
+# A VolumeReader can be created with a fixed vocabulary, in which case
+# counts go straight into a flat array over that vocabulary and every
+# other token is dropped; or without one, in which case it returns a
+# Counter of every token, identical to the one counts4json returns.
+# Either way it also totals alphabetic tokens, and tokens in a set of
+# common English words if it's given one, so that implementmodel.
+# get_english_percent needn't walk the counts again afterward. Whether
+# a token is alphabetic and English is cached along with its folded
+# form.
+
+# Usage:
+#     python jsonfeatures.py pairtreeroot metapath
+
+# reads every volume in metapath both ways, confirms that the counts
+# agree, and reports the time taken by each.
+
+import bz2, codecs, json, os, re, sys, time
+from collections import Counter
+import numpy as np
+import pandas as pd
+
+import pipelinetimer
+
+blocksize = 256 * 1024
+
+# Token normalizations are cached per reader; if the cache for a section
+# grows beyond this many entries (OCR junk, over millions of volumes),
+# it's simply cleared.
+
+maxcached = 2000000
+
+pagesre = re.compile(r'"pages"\s*:\s*\[')
+separatorre = re.compile(r'[\s,]*')
+
+def normalize_token(token):
+    ''' The same normalization get_volume_features applies.
+    '''
+    return token.lower()
+
+def fold_token(token, prefix):
+    ''' Returns the word counts4json would file this token under, after
+    prefixing it as get_volume_features does and folding #header keys
+    back into the body.
+    '''
+    word = prefix + normalize_token(token)
+    if word.startswith('#header'):
+        word = word.replace('#header', '')
+    return word
+
+def compressed_blocks(path):
+    with open(path, mode = 'rb') as f:
+        while True:
+            block = f.read(blocksize)
+            if not block:
+                break
+            yield block
+
+def decompressed_text(blocks):
+    ''' Decompresses an iterable of bz2 blocks, yielding pieces of
+    decoded text. Handles files made of several concatenated streams,
+    as bz2.open does.
+    '''
+    decompressor = bz2.BZ2Decompressor()
+    decoder = codecs.getincrementaldecoder('utf-8')()
+
+    for block in blocks:
+        while block:
+            with pipelinetimer.stage('decompress'):
+                data = decompressor.decompress(block)
+                text = decoder.decode(data)
+            if text:
+                yield text
+
+            if decompressor.eof:
+                block = decompressor.unused_data
+                decompressor = bz2.BZ2Decompressor()
+            else:
+                block = b''
+
+    yield decoder.decode(b'', final = True)
+
+def iterate_pages(pieces):
+    ''' Accepts an iterable of pieces of json text, and yields the page
+    objects in ['features']['pages'] one at a time, without parsing
+    the rest of the document.
+    '''
+
+    decode = json.JSONDecoder().raw_decode
+    pieces = iter(pieces)
+    text = ''
+
+    # Read until we find the start of the page list.
+
+    while True:
+        features = text.find('"features"')
+        match = None
+        if features >= 0:
+            match = pagesre.search(text, features)
+        if match is not None:
+            break
+
+        piece = next(pieces, None)
+        if piece is None:
+            # An unexpected layout: fall back to parsing the whole thing.
+            for page in json.loads(text)['features']['pages']:
+                yield page
+            return
+
+        text += piece
+
+    pos = match.end()
+
+    while True:
+        pos = separatorre.match(text, pos).end()
+        if pos < len(text) and text[pos] == ']':
+            return
+
+        try:
+            page, end = decode(text, pos)
+        except ValueError:
+            # The next page hasn't been fully decompressed yet.
+            piece = next(pieces, None)
+            if piece is None:
+                raise ValueError('Page list ends prematurely.')
+            text = text[pos : ] + piece
+            pos = 0
+            continue
+
+        yield page
+        pos = end
+
+class VolumeReader:
+    ''' Reads extracted-feature files. If vocabulary is supplied, vector()
+    returns counts as an array aligned with it; counts() always returns
+    a Counter. english is the set of words whose occurrences are totaled
+    for get_english_percent.
+    '''
+
+    sections = [('header', '#header'), ('body', '')]
+
+    def __init__(self, vocabulary = None, english = None):
+        if vocabulary is None:
+            self.vocabulary = None
+        else:
+            self.vocabulary = list(vocabulary)
+            self.vocabindex = {word: idx for idx, word in enumerate(self.vocabulary)}
+
+        if english is None:
+            self.english = frozenset()
+        else:
+            self.english = english
+
+        self.tokencaches = {section: dict() for section, prefix in self.sections}
+
+    def pages(self, source):
+        ''' source is either the path to a .json.bz2 file or its
+        contents, as bytes.
+        '''
+        if isinstance(source, bytes):
+            blocks = [source]
+        else:
+            blocks = compressed_blocks(source)
+
+        return iterate_pages(decompressed_text(blocks))
+
+    def cache_for(self, section):
+        cache = self.tokencaches[section]
+        if len(cache) > maxcached:
+            cache.clear()
+        return cache
+
+    def vector(self, source):
+        ''' Returns an integer array of counts for the words in
+        self.vocabulary, the total number of body tokens, and the total
+        counts of alphabetic words and of English words (in the
+        vocabulary or not).
+        '''
+
+        vocabindex = self.vocabindex
+        english = self.english
+        counts = [0] * len(self.vocabulary)
+        totalwords = 0
+        alphatotal = 0
+        englishtotal = 0
+
+        for page in self.pages(source):
+            for section, prefix in self.sections:
+                cache = self.cache_for(section)
+                for token, poscounts in page[section]['tokenPosCount'].items():
+                    n = sum(poscounts.values())
+                    if section == 'body':
+                        totalwords += n
+
+                    entry = cache.get(token)
+                    if entry is None:
+                        word = fold_token(token, prefix)
+                        isalpha = word.isalpha()
+                        entry = (vocabindex.get(word, -1), isalpha, isalpha and word in english)
+                        cache[token] = entry
+
+                    idx, isalpha, isenglish = entry
+                    if idx >= 0:
+                        counts[idx] += n
+                    if isalpha:
+                        alphatotal += n
+                        if isenglish:
+                            englishtotal += n
+
+        return np.array(counts, dtype = np.int64), totalwords, alphatotal, englishtotal
+
+    def counts(self, source, counts = None):
+        ''' Returns a Counter of (folded) words, the total number of
+        body tokens, like implementmodel.counts4json, and the totals of
+        alphabetic and English words. If counts is supplied (an empty
+        Counter, or a subclass of one) it's filled and returned.
+        '''
+
+        if counts is None:
+            counts = Counter()
+
+        if self.vocabulary is not None:
+            vector, totalwords, alphatotal, englishtotal = self.vector(source)
+            nonzero = np.nonzero(vector)[0]
+            counts.update({self.vocabulary[x]: int(vector[x]) for x in nonzero})
+            return counts, totalwords, alphatotal, englishtotal
+
+        english = self.english
+        totalwords = 0
+        alphatotal = 0
+        englishtotal = 0
+
+        for page in self.pages(source):
+            for section, prefix in self.sections:
+                cache = self.cache_for(section)
+                for token, poscounts in page[section]['tokenPosCount'].items():
+                    n = sum(poscounts.values())
+                    if section == 'body':
+                        totalwords += n
+
+                    entry = cache.get(token)
+                    if entry is None:
+                        word = fold_token(token, prefix)
+                        isalpha = word.isalpha()
+                        entry = (word, isalpha, isalpha and word in english)
+                        cache[token] = entry
+
+                    word, isalpha, isenglish = entry
+                    counts[word] += n
+                    if isalpha:
+                        alphatotal += n
+                        if isenglish:
+                            englishtotal += n
+
+        return counts, totalwords, alphatotal, englishtotal
+
+def verify(pairtreeroot, metapath):
+    ''' Reads every volume in metapath with parsefeaturejsons and with
+    a VolumeReader, and checks that the folded counts, word totals,
+    errors, and English percentages (accumulated in parsing, and counted
+    afresh from the counts) are identical. Returns True if they all are.
+    '''
+
+    import implementmodel
+
+    meta = pd.read_csv(metapath, index_col = 'docid', dtype = 'object')
+    reader = VolumeReader(english = implementmodel.top1000words)
+
+    oldtime = 0
+    newtime = 0
+    checked = 0
+    mismatches = 0
+
+    for docid in meta.index:
+        path = implementmodel.get_pairtree(pairtreeroot, docid)
+        if not os.path.isfile(path):
+            continue
+
+        start = time.perf_counter()
+        oldcounts, error, oldtotal = implementmodel.counts4json(path, docid)
+        oldtime += time.perf_counter() - start
+
+        start = time.perf_counter()
+        newcounts, newerror, newtotal = implementmodel.counts4json(path, docid, reader)
+        newtime += time.perf_counter() - start
+
+        english = implementmodel.top1000words
+        percents = [implementmodel.get_english_percent(x, english) for x in [oldcounts, newcounts, Counter(newcounts)]]
+
+        checked += 1
+        if error != newerror or oldcounts != newcounts or oldtotal != newtotal or len(set(percents)) > 1:
+            print('Mismatch: ' + docid)
+            mismatches += 1
+
+    print(str(checked) + ' volumes checked; ' + str(mismatches) + ' mismatches.')
+    if newtime > 0:
+        print('parsefeaturejsons: ' + str(round(oldtime, 2)) + 's; VolumeReader: ' + str(round(newtime, 2)) + 's')
+
+    return mismatches == 0
+
+if __name__ == '__main__':
+
+    args = sys.argv
+
+    if len(args) >= 3:
+        ok = verify(args[1], args[2])
+        if not ok:
+            sys.exit(1)
+
+    else:
+        print('Usage: python jsonfeatures.py pairtreeroot metapath')
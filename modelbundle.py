@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+
+# modelbundle.py
+
+# Each model trainamodel exports is a separate pickle holding a whole
+# sklearn SVC, support vectors and all, and every process that
+# classifies volumes unpickles all of them. But once a model is
+# compiled (see compilemodels.py), all we need is a vocabulary, a
+# weight vector, a bias, and Platt coefficients.
+
+# A bundle stores an ensemble of compiled models in one file:
+
+#     8 bytes     the magic string MDLBNDL1
+#     8 bytes     length of the header, as a little-endian integer
+#     header      json describing each model: its labels, vocabulary,
+#                 scalar parameters, and where its arrays are
+#     arrays      raw little-endian arrays, each aligned to 64 bytes
+
+# The arrays for each model are its folded weights, the scaler's means
+# and scales, and the svm's primal coefficients and intercept. The
+# bundle also stores the ensemble already stacked over the union of
+# the models' vocabularies, as compilemodels.stack_models would build
+# it. Arrays are memory-mapped when a bundle is loaded, so worker
+# processes that load the same bundle share a single copy. Models are
+# stacked in the order they're given to write_bundle; implementmodel
+# restacks them if its own order differs, since the order of summation
+# affects the last bits of each probability.
+
+# implementmodel and implementsubfic accept the path to a bundle
+# anywhere they accept a directory of models; bundled models are
+# always applied in compiled form.
+
+# Usage:
+#     python modelbundle.py modeldir outpath
+
+# bundles every .p file in modeldir, checks that the bundle loads and
+# matches the pickles, and writes it to outpath.
+
+import glob, json, os, pickle, struct, sys
+import numpy as np
+
+import compilemodels
+
+magic = b'MDLBNDL1'
+alignment = 64
+
+def is_bundle(path):
+    ''' True if path is a file that starts with the bundle's magic string.
+    '''
+    if not os.path.isfile(path):
+        return False
+
+    with open(path, mode = 'rb') as f:
+        return f.read(len(magic)) == magic
+
+def aligned(position):
+    return (position + alignment - 1) // alignment * alignment
+
+def load_pickles(modeldir):
+    ''' Returns a dictionary of every pickled model in modeldir,
+    keyed by file name without the .p.
+    '''
+
+    models = dict()
+    for modelpath in sorted(glob.glob(os.path.join(modeldir, '*.p'))):
+        name = os.path.basename(modelpath).replace('.p', '')
+        with open(modelpath, mode = 'rb') as f:
+            models[name] = pickle.load(f)
+
+    return models
+
+def write_bundle(models, outpath):
+    ''' Writes a dictionary of models, as exported by trainamodel, to
+    a bundle at outpath.
+    '''
+
+    arrays = []
+    dataposition = 0
+
+    def place(array):
+        # records an array to be written, and returns its description
+        nonlocal dataposition
+        array = np.ascontiguousarray(array, dtype = np.float64)
+        offset = aligned(dataposition)
+        arrays.append((offset, array))
+        dataposition = offset + array.nbytes
+        return {'offset': offset, 'shape': list(array.shape), 'dtype': '<f8'}
+
+    compiledmodels = dict()
+    header = {'models': dict()}
+
+    for name, model in models.items():
+        compiled = compilemodels.compile_model(model)
+        compiledmodels[name] = compiled
+        supportvector = model['svm']
+
+        entry = dict()
+        entry['positivelabel'] = model['positivelabel']
+        entry['negativelabel'] = model['negativelabel']
+        entry['vocabulary'] = compiled['vocabulary']
+        entry['bias'] = compiled['bias']
+        entry['probA'] = compiled['probA']
+        entry['probB'] = compiled['probB']
+        entry['classes'] = compiled['classes'].tolist()
+        entry['classdtype'] = compiled['classes'].dtype.str
+        entry['intercept'] = float(np.ravel(supportvector.intercept_)[0])
+        for key in ['ftcount', 'c', 'n', 'name']:
+            if key in model:
+                entry[key] = model[key]
+
+        entry['arrays'] = dict()
+        entry['arrays']['weights'] = place(compiled['weights'])
+        entry['arrays']['mean'] = place(model['scaler'].mean_)
+        entry['arrays']['scale'] = place(model['scaler'].scale_)
+        entry['arrays']['coef'] = place(np.ravel(supportvector.coef_))
+
+        header['models'][name] = entry
+
+    stack = compilemodels.stack_models(compiledmodels)
+    header['stack'] = dict()
+    header['stack']['names'] = stack['names']
+    header['stack']['vocabulary'] = stack['vocabulary']
+    header['stack']['arrays'] = dict()
+    for key in ['weights', 'bias', 'probA', 'probB']:
+        header['stack']['arrays'][key] = place(stack[key])
+
+    headerbytes = json.dumps(header).encode('utf-8')
+    datastart = aligned(len(magic) + 8 + len(headerbytes))
+
+    with open(outpath, mode = 'wb') as f:
+        f.write(magic)
+        f.write(struct.pack('<Q', len(headerbytes)))
+        f.write(headerbytes)
+        for offset, array in arrays:
+            f.write(b'\x00' * (datastart + offset - f.tell()))
+            f.write(array.astype('<f8').tobytes())
+
+def load_bundle(path):
+    ''' Loads a bundle, returning a dictionary of models and a stack.
+    Each model is a dictionary with 'vocabulary', 'positivelabel',
+    'negativelabel', and 'compiled' (in the form compilemodels.
+    compile_model returns) but no scaler or svm; the stack is in the
+    form compilemodels.stack_models returns. All arrays are read-only
+    views of one memory map.
+    '''
+
+    with open(path, mode = 'rb') as f:
+        if f.read(len(magic)) != magic:
+            raise ValueError(path + ' is not a model bundle.')
+        headerlength = struct.unpack('<Q', f.read(8))[0]
+        header = json.loads(f.read(headerlength).decode('utf-8'))
+
+    datastart = aligned(len(magic) + 8 + headerlength)
+    buffer = np.memmap(path, dtype = np.uint8, mode = 'r')
+
+    def view(description):
+        start = datastart + description['offset']
+        count = int(np.prod(description['shape']))
+        array = buffer[start : start + count * 8].view(description['dtype'])
+        return array.reshape(description['shape'])
+
+    models = dict()
+    for name, entry in header['models'].items():
+        compiled = dict()
+        compiled['vocabulary'] = entry['vocabulary']
+        compiled['weights'] = view(entry['arrays']['weights'])
+        compiled['bias'] = entry['bias']
+        compiled['probA'] = entry['probA']
+        compiled['probB'] = entry['probB']
+        compiled['classes'] = np.array(entry['classes'], dtype = entry['classdtype'])
+        compiled['positivelabel'] = entry['positivelabel']
+        compiled['negativelabel'] = entry['negativelabel']
+
+        model = dict()
+        model['vocabulary'] = entry['vocabulary']
+        model['positivelabel'] = entry['positivelabel']
+        model['negativelabel'] = entry['negativelabel']
+        model['mean'] = view(entry['arrays']['mean'])
+        model['scale'] = view(entry['arrays']['scale'])
+        model['coef'] = view(entry['arrays']['coef'])
+        model['intercept'] = entry['intercept']
+        for key in ['ftcount', 'c', 'n', 'name']:
+            if key in entry:
+                model[key] = entry[key]
+        model['compiled'] = compiled
+
+        models[name] = model
+
+    stack = dict()
+    stack['names'] = header['stack']['names']
+    stack['vocabulary'] = header['stack']['vocabulary']
+    for key in ['weights', 'bias', 'probA', 'probB']:
+        stack[key] = view(header['stack']['arrays'][key])
+    stack['classes'] = [models[name]['compiled']['classes'] for name in stack['names']]
+
+    return models, stack
+
+def export_bundle(modeldir, outpath):
+    ''' Bundles every pickled model in modeldir into outpath, and checks
+    that the bundle reproduces compile_model and stack_models exactly.
+    Returns True if it does.
+    '''
+
+    models = load_pickles(modeldir)
+    write_bundle(models, outpath)
+
+    bundled, stack = load_bundle(outpath)
+
+    ok = True
+    compiledmodels = dict()
+    for name, model in models.items():
+        compiled = compilemodels.compile_model(model)
+        compiledmodels[name] = compiled
+        loaded = bundled[name]['compiled']
+        same = compiled['vocabulary'] == loaded['vocabulary'] and np.array_equal(compiled['weights'], loaded['weights'])
+        same = same and compiled['bias'] == loaded['bias'] and compiled['probA'] == loaded['probA'] and compiled['probB'] == loaded['probB']
+        same = same and np.array_equal(compiled['classes'], loaded['classes'])
+        if not same:
+            print(name + ' differs in the bundle.')
+            ok = False
+
+    expected = compilemodels.stack_models(compiledmodels)
+    if expected['vocabulary'] != stack['vocabulary'] or not np.array_equal(expected['weights'], stack['weights']):
+        print('The stacked ensemble differs in the bundle.')
+        ok = False
+
+    print('Bundled ' + str(len(models)) + ' models, ' + str(os.path.getsize(outpath)) + ' bytes, in ' + outpath)
+
+    return ok
+
+if __name__ == '__main__':
+
+    args = sys.argv
+
+    if len(args) >= 3:
+        ok = export_bundle(args[1], args[2])
+        if not ok:
+            sys.exit(1)
+
+    else:
+        print('Usage: python modelbundle.py modeldir outpath')
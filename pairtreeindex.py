@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+
+# pairtreeindex.py
+
+# To find a volume in a pairtree, implementmodel and implementsubfic
+# build its path with utils.pairtreepath and then stat it (implementsubfic
+# stats two pairtrees), before opening it. On network storage a stat
+# can take milliseconds, and over millions of volumes that adds up to
+# hours spent asking whether files exist.
+
+# This module walks one or more pairtree roots once, with a pool of
+# threads each walking its own part of the tree, and writes an index
+# of every extracted-feature file it finds:
+
+#     docid   path   size   mtime
+
+# as tab-separated text, sorted by docid. Paths are recorded exactly as
+# get_pairtree would build them from the root, so that output doesn't
+# change, and a file is only indexed if its location agrees with the
+# path get_pairtree would compute for its docid. If a docid is found
+# under more than one root, the first root wins, as it does when
+# implementsubfic looks in sourcedir before alternatesource.
+
+# A classification run given an index resolves paths from it without
+# touching the filesystem, and can count the missing volumes before it
+# starts. Sizes and modification times are recorded so that an index
+# can be checked against the tree later.
+
+# Usage:
+#     python pairtreeindex.py indexpath pairtreeroot [pairtreeroot ...]
+
+# indexes the given roots and writes the index to indexpath.
+
+#     python pairtreeindex.py check indexpath
+
+# stats every file in the index and reports any that have changed or
+# disappeared since it was built.
+
+import os, sys
+from concurrent.futures import ThreadPoolExecutor
+
+# import utils
+currentdir = os.path.dirname(__file__)
+libpath = os.path.join(currentdir, '../lib')
+sys.path.append(libpath)
+
+import SonicScrewdriver as utils
+
+suffix = '.json.bz2'
+defaultworkers = 16
+
+def get_pairtree(pairtreeroot, htid):
+    ''' The path implementmodel.get_pairtree builds for a volume.
+    '''
+    path, postfix = utils.pairtreepath(htid, pairtreeroot)
+    return path + postfix + '/' + postfix + suffix
+
+def docid_for(prefix, filename):
+    ''' Inverts pairtreepath for a file named postfix.json.bz2 under the
+    directory for prefix (the part of the docid before the first period).
+    '''
+    postfix = filename[0 : -len(suffix)]
+    return prefix + '.' + utils.dirty_pairtree(postfix.replace(',', '.'))
+
+def walk_subtree(walktuple):
+    ''' Walks one directory of a pairtree and returns a list of
+    (docid, path, size, mtime) for the feature files under it.
+    '''
+
+    pairtreeroot, prefix, subtree = walktuple
+    found = []
+
+    for dirpath, dirnames, filenames in os.walk(subtree):
+        for filename in filenames:
+            if not filename.endswith(suffix):
+                continue
+            if filename[0 : -len(suffix)] != os.path.basename(dirpath):
+                continue
+
+            docid = docid_for(prefix, filename)
+            path = get_pairtree(pairtreeroot, docid)
+            if os.path.normpath(path) != os.path.normpath(os.path.join(dirpath, filename)):
+                continue
+
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            found.append((docid, path, stat.st_size, int(stat.st_mtime)))
+
+    return found
+
+def subtrees(pairtreeroot):
+    ''' Divides a pairtree into the directories one level beneath each
+    prefix's pairtree_root, so they can be walked in parallel.
+    '''
+
+    walktuples = []
+
+    for prefix in sorted(os.listdir(pairtreeroot)):
+        treeroot = os.path.join(pairtreeroot, prefix, 'pairtree_root')
+        if not os.path.isdir(treeroot):
+            continue
+        for entry in sorted(os.listdir(treeroot)):
+            walktuples.append((pairtreeroot, prefix, os.path.join(treeroot, entry)))
+
+    return walktuples
+
+def build_index(roots, indexpath, workers = defaultworkers):
+    ''' Indexes every feature file in the pairtrees listed in roots,
+    and writes the index to indexpath. Returns the number of volumes
+    indexed.
+    '''
+
+    entries = dict()
+
+    for pairtreeroot in roots:
+        if not pairtreeroot.endswith('/'):
+            pairtreeroot = pairtreeroot + '/'
+
+        with ThreadPoolExecutor(max_workers = workers) as executor:
+            for found in executor.map(walk_subtree, subtrees(pairtreeroot)):
+                for docid, path, size, mtime in found:
+                    if docid not in entries:
+                        entries[docid] = (path, size, mtime)
+
+    with open(indexpath, mode = 'w', encoding = 'utf-8') as f:
+        f.write('docid\tpath\tsize\tmtime\n')
+        for docid in sorted(entries):
+            path, size, mtime = entries[docid]
+            f.write(docid + '\t' + path + '\t' + str(size) + '\t' + str(mtime) + '\n')
+
+    return len(entries)
+
+class PairtreeIndex:
+    ''' Read-only access to an index written by build_index.
+    '''
+
+    def __init__(self, indexpath):
+        self.indexpath = indexpath
+        self.entries = dict()
+
+        with open(indexpath, encoding = 'utf-8') as f:
+            f.readline()
+            for line in f:
+                docid, path, size, mtime = line.rstrip('\n').split('\t')
+                self.entries[docid] = (path, int(size), int(mtime))
+
+    def __contains__(self, docid):
+        return docid in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def path_for(self, docid):
+        ''' Returns the path of docid's feature file, or None if the
+        index doesn't have it.
+        '''
+        if docid in self.entries:
+            return self.entries[docid][0]
+        else:
+            return None
+
+    def missing(self, docids):
+        return [x for x in docids if x not in self.entries]
+
+def check_entry(entry):
+    path, size, mtime = entry
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return 'missing'
+
+    if stat.st_size != size or int(stat.st_mtime) != mtime:
+        return 'changed'
+    else:
+        return 'ok'
+
+def check_index(indexpath, workers = defaultworkers):
+    ''' Stats every file in an index, and returns the docids of those
+    that have changed and of those that have disappeared.
+    '''
+
+    index = PairtreeIndex(indexpath)
+    docids = sorted(index.entries)
+
+    with ThreadPoolExecutor(max_workers = workers) as executor:
+        statuses = list(executor.map(check_entry, [index.entries[x] for x in docids]))
+
+    changed = [docid for docid, status in zip(docids, statuses) if status == 'changed']
+    missing = [docid for docid, status in zip(docids, statuses) if status == 'missing']
+
+    return changed, missing
+
+# Indexes are loaded once per process and then reused.
+
+openindexes = dict()
+
+def open_index(indexpath):
+    global openindexes
+
+    key = os.path.abspath(indexpath)
+    if key not in openindexes:
+        openindexes[key] = PairtreeIndex(indexpath)
+
+    return openindexes[key]
+
+if __name__ == '__main__':
+
+    args = sys.argv
+
+    if len(args) == 3 and args[1] == 'check':
+        changed, missing = check_index(args[2])
+        for docid in changed:
+            print('changed: ' + docid)
+        for docid in missing:
+            print('missing: ' + docid)
+        print(str(len(changed)) + ' changed and ' + str(len(missing)) + ' missing.')
+        if len(changed) > 0 or len(missing) > 0:
+            sys.exit(1)
+
+    elif len(args) >= 3:
+        count = build_index(args[2 : ], args[1])
+        print('Indexed ' + str(count) + ' volumes in ' + args[1])
+
+    else:
+        print('Usage: python pairtreeindex.py indexpath pairtreeroot [pairtreeroot ...]')
+        print('       python pairtreeindex.py check indexpath')
@@ -3,18 +3,90 @@
 # Script designed to parallelize trainamodel.py, especially for
 # purposes of grid search to optimize parameters.
 
-import csv
+import csv, os, shutil, tempfile
 from multiprocessing import Pool
 import matplotlib.pyplot as plt
 import trainamodel as tmod
 import numpy as np
+import pandas as pd
+
+# Every cell in the grid uses a prefix of the same vocabulary, and
+# StandardScaler scales each column independently, so the scaled
+# matrix for any cell is just the first featurecount columns of the
+# scaled matrix for the whole vocabulary. We build that matrix once,
+# save it to disk, and let each worker memory-map it, instead of
+# pickling the whole countdict into every grid tuple.
+
+gridstate = dict()
+
+def initialize_grid(matrixpath, metadata, positiveIDs, negativeIDs):
+    global gridstate
+
+    gridstate['matrix'] = np.load(matrixpath, mmap_mode = 'r')
+    gridstate['metadata'] = metadata
+    gridstate['positiveIDs'] = positiveIDs
+    gridstate['negativeIDs'] = negativeIDs
+
+def model_gridcell(cell):
+    ''' Cross-validates a single cell in a grid search, slicing its
+    features from the shared matrix. Returns the same tuple as
+    trainamodel.model_gridtuple.
+    '''
+
+    global gridstate
+
+    k, c, featurecount = cell
+    print(featurecount, c)
+
+    positiveIDs = gridstate['positiveIDs']
+    negativeIDs = gridstate['negativeIDs']
+    scaleddf = pd.DataFrame(np.array(gridstate['matrix'][ : , 0 : featurecount]), index = positiveIDs + negativeIDs)
+
+    accuracy, precision, recall, predictions, reallabels = tmod.cross_validate_svm(gridstate['metadata'], positiveIDs, negativeIDs, scaleddf, c, k, featurecount)
+
+    return k, c, featurecount, accuracy, precision, recall, predictions, reallabels
+
+def model_pathcell(cell):
+    ''' Sweeps every c value for one fold and one feature count, using
+    warm-started fits. Returns the predictions for each c, along with
+    the fold's real labels.
+    '''
+
+    global gridstate
+
+    k, foldindex, featurecount, cs = cell
+    print(featurecount, 'fold', foldindex)
+
+    positiveIDs = gridstate['positiveIDs']
+    negativeIDs = gridstate['negativeIDs']
+    fold = tmod.break_into_folds(positiveIDs, negativeIDs, k)[foldindex]
+    scaleddf = pd.DataFrame(np.array(gridstate['matrix'][ : , 0 : featurecount]), index = positiveIDs + negativeIDs)
+
+    predictionsforc, realyvals = tmod.warm_path_one_fold(gridstate['metadata'], fold, scaleddf, cs, featurecount)
+
+    return featurecount, foldindex, fold, predictionsforc, realyvals
+
+def share_scaled_matrix(metapath, sourcedir, positivelabel, negativelabel, feature_end):
+    ''' Loads the data for a grid search, scales the matrix for the whole
+    vocabulary, and saves it where pool workers can memory-map it.
+    Returns metadata, ID lists, and the temporary directory and path.
+    '''
 
-def gridsearch(metapath, sourcedir, positivelabel, negativelabel, k, feature_start, feature_end, feature_inc, c_start, c_end, c_num, outpath):
     metadata, positiveIDs, negativeIDs = tmod.get_metadata(metapath, positivelabel, negativelabel)
     vocabulary, countdict = tmod.get_vocabulary_and_counts(metadata, positiveIDs, negativeIDs, sourcedir, feature_end)
 
     print(vocabulary[0:100])
 
+    scaledmatrix = tmod.countdict2featureframe(vocabulary, positiveIDs, negativeIDs, countdict).values
+    tempdir = tempfile.mkdtemp()
+    matrixpath = os.path.join(tempdir, 'gridmatrix.npy')
+    np.save(matrixpath, scaledmatrix)
+
+    return metadata, positiveIDs, negativeIDs, tempdir, matrixpath
+
+def gridsearch(metapath, sourcedir, positivelabel, negativelabel, k, feature_start, feature_end, feature_inc, c_start, c_end, c_num, outpath, workers = 16):
+    metadata, positiveIDs, negativeIDs, tempdir, matrixpath = share_scaled_matrix(metapath, sourcedir, positivelabel, negativelabel, feature_end)
+
     grid = []
 
     xaxis = []
@@ -27,9 +99,8 @@ def gridsearch(metapath, sourcedir, positivelabel, negativelabel, k, feature_sta
             if not ymade:
                 yaxis.append(c)
 
-            vocab_subset = vocabulary[0 : featurecount]
-            gridtuple = (vocab_subset, positiveIDs, negativeIDs, countdict, k, c, featurecount, metadata)
-            grid.append(gridtuple)
+            gridcell = (k, c, featurecount)
+            grid.append(gridcell)
 
         ymade = True
 
@@ -37,16 +108,95 @@ def gridsearch(metapath, sourcedir, positivelabel, negativelabel, k, feature_sta
     print(yaxis)
     print(xaxis)
 
-    pool = Pool(processes = 16)
-    res = pool.map_async(tmod.model_gridtuple, grid)
+    pool = Pool(processes = workers, initializer = initialize_grid, initargs = (matrixpath, metadata, positiveIDs, negativeIDs))
+
+    # However the pool work ends, don't leave a copy of the matrix behind.
+    try:
+        res = pool.map_async(model_gridcell, grid)
+
+        res.wait()
+        resultlist = res.get()
+    finally:
+        pool.close()
+        pool.join()
 
-    res.wait()
-    resultlist = res.get()
+        shutil.rmtree(tempdir)
 
     assert len(resultlist) == len(grid)
 
-    pool.close()
-    pool.join()
+    report_grid(resultlist, xaxis, yaxis, outpath)
+
+def pathsearch(metapath, sourcedir, positivelabel, negativelabel, k, feature_start, feature_end, feature_inc, c_start, c_end, c_num, outpath, workers = 16):
+    ''' A faster alternative to gridsearch. Rather than fitting a fresh SVC
+    for every combination of featurecount, c, and fold, it sweeps all
+    the c values for each fold and featurecount with warm-started fits
+    of a linear logistic regression (see trainamodel.warm_path_one_fold),
+    so the cost is close to one fit per fold and featurecount.
+
+    Accepts the same arguments, and writes the same rows to outpath,
+    as gridsearch. Since the loss is logistic rather than hinge, the
+    best c may differ somewhat from the best c for an SVC; this is best
+    used to narrow the range before a final gridsearch.
+    '''
+
+    metadata, positiveIDs, negativeIDs, tempdir, matrixpath = share_scaled_matrix(metapath, sourcedir, positivelabel, negativelabel, feature_end)
+
+    xaxis = list(range(feature_start, feature_end, feature_inc))
+    yaxis = list(np.linspace(c_start, c_end, c_num))
+
+    cells = []
+    for featurecount in xaxis:
+        for foldindex in range(k):
+            cells.append((k, foldindex, featurecount, yaxis))
+
+    print(len(cells))
+    print(yaxis)
+    print(xaxis)
+
+    pool = Pool(processes = workers, initializer = initialize_grid, initargs = (matrixpath, metadata, positiveIDs, negativeIDs))
+
+    try:
+        res = pool.map_async(model_pathcell, cells)
+
+        res.wait()
+        pathlist = res.get()
+    finally:
+        pool.close()
+        pool.join()
+
+        shutil.rmtree(tempdir)
+
+    assert len(pathlist) == len(cells)
+
+    # Now reassemble the folds for each cell of the grid, in the same way
+    # trainamodel.cross_validate_svm does, and score them.
+
+    resultlist = []
+
+    for featurecount in xaxis:
+        folds = sorted([x for x in pathlist if x[0] == featurecount], key = lambda x: x[1])
+        for cidx, c in enumerate(yaxis):
+            allrealclasslabels = []
+            allpredictions = []
+            allfolds = []
+
+            for thisfeaturecount, foldindex, fold, predictionsforc, realyvals in folds:
+                allrealclasslabels.extend(realyvals)
+                allpredictions.extend(predictionsforc[cidx])
+                allfolds.extend(fold)
+
+            allpredictions = pd.Series(allpredictions, index = allfolds)
+            allrealclasslabels = pd.Series(allrealclasslabels, index = allfolds)
+            accuracy, precision, recall = tmod.calculate_accuracy(allpredictions, allrealclasslabels)
+
+            resultlist.append((k, c, featurecount, accuracy, precision, recall, allpredictions, allrealclasslabels))
+
+    report_grid(resultlist, xaxis, yaxis, outpath)
+
+def report_grid(resultlist, xaxis, yaxis, outpath):
+    ''' Appends a row for each grid cell to outpath, and plots accuracy
+    across the grid.
+    '''
 
     xlen = len(xaxis)
     ylen = len(yaxis)
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+
+# pipelinetimer.py
+
+# Records where the time goes in a classification run. Code that
+# wants to be measured wraps each stage in
+
+#     with pipelinetimer.stage('read json'):
+#         ...
+
+# which does nothing at all unless a timer has been started in this
+# process with pipelinetimer.start(), and does nothing again once it's
+# been stopped with pipelinetimer.stop(). While a timer is running it
+# accumulates, for each named stage, the total seconds and the number
+# of calls; it also counts how often each model is consulted, and keeps
+# the latency of every volume so that percentiles can be reported.
+
+# Stages can be nested (reading a json file includes decompressing it,
+# scoring a model includes scaling the features), so stage totals
+# overlap and shouldn't be summed. When a run uses several worker
+# processes, each keeps its own timer and sends snapshot() back to the
+# parent, which merge()s them; stage totals are then summed across
+# processes, while "elapsed" is wall-clock time in the parent.
+
+import json, time
+from array import array
+from collections import Counter
+import numpy as np
+
+class StageTimer:
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.reset()
+
+    def reset(self):
+        self.seconds = Counter()
+        self.calls = Counter()
+        self.modelcalls = Counter()
+        self.latencies = array('d')
+
+    def add(self, name, seconds, calls = 1):
+        self.seconds[name] += seconds
+        self.calls[name] += calls
+
+    def count_model(self, name):
+        self.modelcalls[name] += 1
+
+    def add_volume(self, seconds):
+        self.latencies.append(seconds)
+
+    def snapshot(self):
+        ''' Returns everything recorded since the last snapshot, in a
+        form that can be pickled back from a worker, and starts afresh.
+        '''
+        snap = (dict(self.seconds), dict(self.calls), dict(self.modelcalls), self.latencies.tobytes())
+        self.reset()
+        return snap
+
+    def merge(self, snap):
+        seconds, calls, modelcalls, latencies = snap
+        self.seconds.update(seconds)
+        self.calls.update(calls)
+        self.modelcalls.update(modelcalls)
+        self.latencies.frombytes(latencies)
+
+    def summary(self):
+        ''' Returns a dictionary suitable for writing as json.
+        '''
+
+        elapsed = time.perf_counter() - self.started
+        volumes = len(self.latencies)
+
+        result = dict()
+        result['volumes'] = volumes
+        result['elapsed'] = elapsed
+        result['volumespersecond'] = volumes / elapsed if elapsed > 0 else 0
+
+        result['stages'] = dict()
+        for name in sorted(self.seconds):
+            result['stages'][name] = {'seconds': self.seconds[name], 'calls': self.calls[name]}
+
+        result['modelcalls'] = {name: self.modelcalls[name] for name in sorted(self.modelcalls)}
+
+        if volumes > 0:
+            latencies = np.frombuffer(self.latencies, dtype = np.float64)
+            p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+            result['latency'] = {'mean': float(np.mean(latencies)), 'p50': float(p50), 'p95': float(p95), 'p99': float(p99)}
+        else:
+            result['latency'] = dict()
+
+        return result
+
+    def write(self, outpath):
+        with open(outpath, mode = 'w', encoding = 'utf-8') as f:
+            json.dump(self.summary(), f, indent = 2)
+            f.write('\n')
+
+# The timer for this process, if any.
+
+activetimer = None
+
+def start():
+    global activetimer
+    activetimer = StageTimer()
+    return activetimer
+
+def stop():
+    ''' Clears the timer for this process, so that it doesn't outlive
+    the run it was started for (or pass to processes forked later).
+    '''
+    global activetimer
+    activetimer = None
+
+def running():
+    return activetimer is not None
+
+class stage:
+    ''' Context manager that adds the time spent inside it to the named
+    stage of the active timer, if there is one.
+    '''
+
+    __slots__ = ['name', 'begun']
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        if activetimer is not None:
+            self.begun = time.perf_counter()
+        return self
+
+    def __exit__(self, exctype, excvalue, traceback):
+        if activetimer is not None:
+            activetimer.add(self.name, time.perf_counter() - self.begun)
+        return False
+
+def count_model(name):
+    if activetimer is not None:
+        activetimer.count_model(name)
+
+def add_volume(seconds):
+    if activetimer is not None:
+        activetimer.add_volume(seconds)
+
+def snapshot():
+    if activetimer is not None:
+        return activetimer.snapshot()
+    else:
+        return None
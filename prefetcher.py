@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+
+# prefetcher.py
+
+# Reading a volume from a pairtree means a stat to find out whether
+# its file exists, then an open and a read of the compressed bytes.
+# On a shared cluster filesystem the latency of those calls can exceed
+# the time it takes to decompress, parse, and classify the volume, and
+# while a process waits for them its CPU sits idle.
+
+# A Prefetcher hands the stats and reads for upcoming volumes to a
+# small pool of threads, so the calling thread can parse and classify
+# one volume while the next few are being fetched. At most lookahead
+# volumes are in flight (or read and waiting) at any moment, so memory
+# stays bounded however long the list of volumes is, and results come
+# back in the order they were requested.
+
+# Each request lists one or more candidate paths (implementsubfic
+# looks in two pairtrees, and a request lists none if a pairtreeindex
+# says the volume is missing); the first that exists is read. Threads
+# only do I/O. The bytes are then parsed straight from memory, whether
+# by jsonfeatures.VolumeReader or by parsefeaturejsons, so each file is
+# read once.
+
+# A run makes one call to fetch for all its volumes, and each batch
+# takes its share of the results with take(), so reads for the next
+# batch go on while the current one is scored. Worker processes only
+# know the chunks they're handed, so a run with several workers hands
+# each of them groups of consecutive chunks (see task_groups), and the
+# lookahead only runs dry between groups.
+
+import math
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import pipelinetimer
+
+def read_first(candidates):
+    ''' Returns the first of candidates that is a file, and its contents
+    as bytes, or (None, None) if none of them exist. If a file exists
+    but can't be read, its contents are None, so that the caller can
+    open it itself and handle the error as it normally would.
+
+    Each candidate is simply opened, rather than stat'ed first, to save
+    a round trip to the filesystem.
+    '''
+
+    for path in candidates:
+        try:
+            with open(path, mode = 'rb') as f:
+                return path, f.read()
+        except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
+            continue
+        except OSError:
+            return path, None
+
+    return None, None
+
+class Prefetcher:
+
+    def __init__(self, threads = 8, lookahead = 32):
+        self.threads = threads
+        self.lookahead = max(lookahead, threads)
+        self.executor = ThreadPoolExecutor(max_workers = threads)
+
+    def fetch(self, requests):
+        ''' Accepts an iterable of (key, candidatepaths) pairs, and yields
+        (key, path, data) for each, in the same order, where path is the
+        first candidate that exists and data its contents. Requests are
+        consumed only as fast as results are, plus the lookahead.
+        '''
+
+        requests = iter(requests)
+        pending = deque()
+
+        try:
+            while True:
+                while len(pending) < self.lookahead:
+                    request = next(requests, None)
+                    if request is None:
+                        break
+                    key, candidates = request
+                    pending.append((key, self.executor.submit(read_first, list(candidates))))
+
+                if len(pending) < 1:
+                    return
+
+                key, future = pending.popleft()
+                with pipelinetimer.stage('wait for io'):
+                    path, data = future.result()
+
+                yield key, path, data
+
+        finally:
+            # If the caller stops early, don't leave reads queued.
+            for key, future in pending:
+                future.cancel()
+
+    def close(self):
+        self.executor.shutdown()
+
+def take(fetches, keys):
+    ''' Yields (path, data) for each of keys, in order, from a generator
+    returned by fetch, which must have been asked for those keys next.
+    '''
+    for key in keys:
+        fetchedkey, path, data = next(fetches)
+        if fetchedkey != key:
+            raise ValueError('Expected ' + str(key) + ' from the prefetcher, but got ' + str(fetchedkey))
+        yield path, data
+
+def task_groups(chunks, workers, prefetch):
+    ''' Divides chunks into groups of consecutive chunks, about four
+    per worker, so that a worker can prefetch across all the chunks in
+    each group. Without prefetching, each chunk is a group by itself.
+    '''
+    if prefetch > 0:
+        groupsize = max(1, math.ceil(len(chunks) / (workers * 4)))
+    else:
+        groupsize = 1
+
+    return [chunks[floor : floor + groupsize] for floor in range(0, len(chunks), groupsize)]
+
+def make_prefetcher(threads):
+    ''' Returns a Prefetcher with that many threads, or None if threads
+    is zero, which means volumes are read synchronously.
+    '''
+    if threads > 0:
+        return Prefetcher(threads, lookahead = threads * 4)
+    else:
+        return None
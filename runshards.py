@@ -0,0 +1,433 @@
+#!/usr/bin/env python3
+
+# runshards.py
+
+# implementmodel's __main__ block classifies one metadata csv into one
+# output csv, and collate_results.py later gathers up every csv in
+# ../outmeta/. Spreading a few million volumes across cluster nodes
+# has meant cutting up the metadata and starting each piece by hand.
+
+# This module does that bookkeeping. "split" divides a metadata file
+# into shards and creates a queue for them; any number of workers, on
+# any hosts that can see the queue directory, then claim shards one at
+# a time, classify them with implementmodel.main, and write the results
+# to outdir (by default ../outmeta/, where collate_results expects them).
+
+# The queue is a directory of small json "tokens," one per shard, that
+# move between subdirectories:
+
+#     todo/      waiting to be claimed
+#     running/   claimed; renamed shardname@worker, touched every minute
+#     done/      finished
+#     failed/    failed maxattempts times
+
+# A worker claims a shard by renaming its token out of todo/, which is
+# atomic, so two workers can't claim the same shard. If classification
+# raises an exception, the shard goes back to todo/ to be retried, or to
+# failed/ once it has been attempted maxattempts times. A worker that
+# dies outright leaves its token in running/; the local coordinator
+# notices when one of its own processes dies, and "requeue" returns
+# tokens that haven't been touched for a while. Anything else that can
+# claim, complete, and fail shards (a socket server, say) can stand in
+# for FileQueue.
+
+# Each shard's output is written to shardname.csv.partial (with
+# streamwriter's checkpoint, so a retried shard resumes where it
+# stopped) and renamed to shardname.csv only when the shard is
+# complete, so collate_results never sees half a shard.
+
+# Usage:
+#     python runshards.py split metapath queuedir [shardsize]
+# divides metapath into shards of shardsize volumes (default 10000) and
+# writes settings.json in queuedir; edit that to change the source
+# directory, models, output directory, output format ('csv', or
+# 'parquet' or 'feather'; see frameio.py), or options for
+# implementmodel.main.
+
+#     python runshards.py run queuedir [processes]
+# runs a local coordinator: starts that many worker processes on this
+# host, replaces any that die, and reports progress and an ETA until
+# the queue is empty.
+
+#     python runshards.py work queuedir
+# runs a single worker, e.g. as a job on another node.
+
+#     python runshards.py status queuedir
+#     python runshards.py requeue queuedir [staleminutes]
+# report progress, and return shards whose workers have stopped
+# touching them to todo/. A shard in failed/ can be given one more
+# attempt by moving its token back to todo/.
+
+import json, os, socket, sys, threading, time, traceback
+from multiprocessing import Process
+import pandas as pd
+
+import implementmodel
+
+defaultshardsize = 10000
+maxattempts = 3
+heartbeatseconds = 60
+staleminutes = 30
+reportseconds = 60
+
+defaultsettings = dict()
+defaultsettings['sourcedir'] = '/projects/ichass/usesofscale/post23/englishmonographs1920-79/'
+defaultsettings['modeldir'] = '../models/'
+defaultsettings['outdir'] = '../outmeta/'
+defaultsettings['pairtree'] = True
+defaultsettings['format'] = 'csv'
+defaultsettings['options'] = dict()
+
+def worker_id():
+    return socket.gethostname() + '.' + str(os.getpid())
+
+class FileQueue:
+    ''' A queue of shards kept as token files in a directory that every
+    worker can see. Token names are shard names.
+    '''
+
+    states = ['todo', 'running', 'done', 'failed']
+
+    def __init__(self, queuedir, maxattempts = maxattempts):
+        self.queuedir = queuedir
+        self.maxattempts = maxattempts
+
+    def statedir(self, state):
+        return os.path.join(self.queuedir, state)
+
+    def shardpath(self, name):
+        return os.path.join(self.queuedir, 'shards', name + '.csv')
+
+    def read_token(self, path):
+        with open(path, encoding = 'utf-8') as f:
+            return json.load(f)
+
+    def write_token(self, path, record):
+        # write beside the token and replace it, so a token is never
+        # seen half-written
+        temppath = path + '.tmp'
+        with open(temppath, mode = 'w', encoding = 'utf-8') as f:
+            json.dump(record, f)
+        os.replace(temppath, path)
+
+    def create(self, shards):
+        ''' shards is a list of (name, number of volumes).
+        '''
+        for state in self.states:
+            os.makedirs(self.statedir(state), exist_ok = True)
+
+        for name, volumes in shards:
+            record = {'volumes': volumes, 'attempts': 0, 'errors': []}
+            self.write_token(os.path.join(self.statedir('todo'), name), record)
+
+    def tokens(self, state):
+        return sorted(x for x in os.listdir(self.statedir(state)) if not x.endswith('.tmp'))
+
+    def claim(self, workerid):
+        ''' Claims the next shard waiting in todo/, and returns its name,
+        or None if there are none left.
+        '''
+
+        for name in self.tokens('todo'):
+            runningpath = os.path.join(self.statedir('running'), name + '@' + workerid)
+            try:
+                os.rename(os.path.join(self.statedir('todo'), name), runningpath)
+            except FileNotFoundError:
+                # another worker got there first
+                continue
+
+            record = self.read_token(runningpath)
+            record['attempts'] += 1
+            record['worker'] = workerid
+            record['claimed'] = time.time()
+            self.write_token(runningpath, record)
+
+            return name
+
+        return None
+
+    def heartbeat(self, name, workerid):
+        os.utime(os.path.join(self.statedir('running'), name + '@' + workerid))
+
+    def complete(self, name, workerid):
+        runningpath = os.path.join(self.statedir('running'), name + '@' + workerid)
+        record = self.read_token(runningpath)
+        record['finished'] = time.time()
+        self.write_token(runningpath, record)
+        os.rename(runningpath, os.path.join(self.statedir('done'), name))
+
+    def fail(self, name, workerid, error):
+        ''' Returns a shard to todo/ to be retried, or moves it to
+        failed/ if it has used up its attempts.
+        '''
+
+        runningpath = os.path.join(self.statedir('running'), name + '@' + workerid)
+        record = self.read_token(runningpath)
+        record['errors'].append(error)
+        self.write_token(runningpath, record)
+
+        if record['attempts'] < self.maxattempts:
+            destination = 'todo'
+        else:
+            destination = 'failed'
+        os.rename(runningpath, os.path.join(self.statedir(destination), name))
+
+        return destination
+
+    def running(self):
+        ''' Returns (name, workerid, seconds since last heartbeat) for each
+        shard that has been claimed and not finished.
+        '''
+        now = time.time()
+        running = []
+        for token in self.tokens('running'):
+            name, workerid = token.split('@', 1)
+            try:
+                age = now - os.path.getmtime(os.path.join(self.statedir('running'), token))
+            except FileNotFoundError:
+                continue
+            running.append((name, workerid, age))
+
+        return running
+
+    def release(self, workerid, error):
+        ''' Fails every shard held by workerid; used when a worker is
+        known to have died.
+        '''
+        for name, holder, age in self.running():
+            if holder == workerid:
+                self.fail(name, holder, error)
+
+    def requeue_stale(self, seconds):
+        ''' Fails every shard whose worker hasn't touched it for the given
+        number of seconds. Returns their names.
+        '''
+        stale = []
+        for name, workerid, age in self.running():
+            if age > seconds:
+                try:
+                    self.fail(name, workerid, 'no heartbeat from ' + workerid + ' for ' + str(int(age)) + 's')
+                except FileNotFoundError:
+                    continue
+                stale.append(name)
+
+        return stale
+
+    def records(self, state):
+        records = []
+        for token in self.tokens(state):
+            try:
+                records.append(self.read_token(os.path.join(self.statedir(state), token)))
+            except (FileNotFoundError, ValueError):
+                continue
+        return records
+
+def load_settings(queuedir):
+    with open(os.path.join(queuedir, 'settings.json'), encoding = 'utf-8') as f:
+        return json.load(f)
+
+def split_metadata(metapath, queuedir, shardsize = defaultshardsize, settings = None):
+    ''' Divides metapath into shards of shardsize rows, saves them in
+    queuedir/shards, and queues them. settings (see defaultsettings)
+    are saved for workers to read. Returns the number of shards.
+    '''
+
+    if settings is None:
+        settings = defaultsettings
+
+    os.makedirs(os.path.join(queuedir, 'shards'), exist_ok = True)
+    with open(os.path.join(queuedir, 'settings.json'), mode = 'w', encoding = 'utf-8') as f:
+        json.dump(settings, f, indent = 2)
+        f.write('\n')
+
+    queue = FileQueue(queuedir)
+    shards = []
+
+    for chunk in pd.read_csv(metapath, dtype = 'object', chunksize = shardsize):
+        name = 'shard' + str(len(shards)).zfill(5)
+        chunk.to_csv(queue.shardpath(name), index = False)
+        shards.append((name, len(chunk)))
+
+    queue.create(shards)
+
+    return len(shards)
+
+def run_shard(queue, name, settings):
+    ''' Classifies one shard with implementmodel.main, and moves the
+    finished output into place.
+    '''
+
+    outdir = settings['outdir']
+    os.makedirs(outdir, exist_ok = True)
+    outpath = os.path.join(outdir, name + '.' + settings.get('format', 'csv'))
+    partialpath = outpath + '.partial'
+
+    if os.path.isfile(outpath):
+        return
+
+    implementmodel.main(settings['sourcedir'], queue.shardpath(name), settings['modeldir'], partialpath, pairtree = settings['pairtree'], **settings['options'])
+    os.replace(partialpath, outpath)
+
+def work(queuedir):
+    ''' Claims and classifies shards until the queue is empty. Returns
+    the number of shards this worker completed.
+    '''
+
+    queue = FileQueue(queuedir)
+    settings = load_settings(queuedir)
+    workerid = worker_id()
+    completed = 0
+
+    while True:
+        name = queue.claim(workerid)
+        if name is None:
+            break
+
+        print(workerid + ' claimed ' + name)
+
+        # Touch the token regularly while the shard runs, so that
+        # requeue can tell a slow shard from an abandoned one.
+
+        finished = threading.Event()
+
+        def beat():
+            while not finished.wait(heartbeatseconds):
+                try:
+                    queue.heartbeat(name, workerid)
+                except FileNotFoundError:
+                    break
+
+        heart = threading.Thread(target = beat, daemon = True)
+        heart.start()
+
+        try:
+            run_shard(queue, name, settings)
+            error = None
+        except Exception:
+            error = traceback.format_exc()
+
+        finished.set()
+        heart.join()
+
+        try:
+            if error is None:
+                queue.complete(name, workerid)
+                completed += 1
+            else:
+                destination = queue.fail(name, workerid, error)
+                print(workerid + ' failed ' + name + '; moved to ' + destination)
+        except FileNotFoundError:
+            # The shard was requeued while it ran (see requeue_stale). If
+            # it finished, its output is in place and the next worker to
+            # claim it will simply mark it done.
+            print(workerid + ' lost its claim on ' + name)
+
+    return completed
+
+def format_seconds(seconds):
+    seconds = int(seconds)
+    return str(seconds // 3600) + 'h' + str((seconds % 3600) // 60).zfill(2) + 'm' + str(seconds % 60).zfill(2) + 's'
+
+def progress(queue, since = None):
+    ''' Returns a one-line report of the queue's progress. Throughput
+    counts volumes in finished shards, over the time since "since" (or,
+    if that isn't given, since the first of them was claimed).
+    '''
+
+    counts = {state: len(queue.tokens(state)) for state in queue.states}
+    done = queue.records('done')
+    volumes = {state: sum(x['volumes'] for x in queue.records(state)) for state in ['todo', 'running']}
+    volumesdone = sum(x['volumes'] for x in done)
+
+    report = str(counts['done']) + ' shards done, ' + str(counts['running']) + ' running, ' + str(counts['todo']) + ' waiting, ' + str(counts['failed']) + ' failed; '
+    report += str(volumesdone) + ' volumes done'
+
+    if len(done) > 0:
+        if since is None:
+            since = min(x['claimed'] for x in done)
+        elapsed = max(x['finished'] for x in done) - since
+        if elapsed > 0:
+            rate = volumesdone / elapsed
+            remaining = volumes['todo'] + volumes['running']
+            report += ', ' + str(round(rate, 1)) + ' volumes/s'
+            if remaining > 0:
+                report += ', ETA ' + format_seconds(remaining / rate)
+
+    return report
+
+def run_local(queuedir, processes):
+    ''' Starts processes workers on this host, replaces any that die
+    while there is still work, and reports progress until every shard
+    is done or failed.
+    '''
+
+    queue = FileQueue(queuedir)
+    started = time.time()
+    workers = dict()
+
+    def start_worker():
+        process = Process(target = work, args = (queuedir, ))
+        process.start()
+        workers[socket.gethostname() + '.' + str(process.pid)] = process
+
+    for i in range(processes):
+        start_worker()
+
+    lastreport = started
+    while len(workers) > 0:
+        time.sleep(1)
+
+        for workerid, process in list(workers.items()):
+            if process.is_alive():
+                continue
+            process.join()
+            del workers[workerid]
+            if process.exitcode != 0:
+                queue.release(workerid, workerid + ' exited with code ' + str(process.exitcode))
+                if len(queue.tokens('todo')) > 0:
+                    start_worker()
+
+        if time.time() - lastreport >= reportseconds:
+            print(progress(queue))
+            lastreport = time.time()
+
+    print(progress(queue))
+
+    failed = queue.tokens('failed')
+    if len(failed) > 0:
+        print(str(len(failed)) + ' shards failed: ' + ', '.join(failed))
+
+    return len(failed) == 0
+
+if __name__ == '__main__':
+
+    args = sys.argv
+
+    if len(args) >= 4 and args[1] == 'split':
+        shardsize = int(args[4]) if len(args) > 4 else defaultshardsize
+        count = split_metadata(args[2], args[3], shardsize)
+        print('Queued ' + str(count) + ' shards in ' + args[3])
+
+    elif len(args) >= 3 and args[1] == 'run':
+        processes = int(args[3]) if len(args) > 3 else 1
+        ok = run_local(args[2], processes)
+        if not ok:
+            sys.exit(1)
+
+    elif len(args) >= 3 and args[1] == 'work':
+        work(args[2])
+
+    elif len(args) >= 3 and args[1] == 'status':
+        print(progress(FileQueue(args[2])))
+
+    elif len(args) >= 3 and args[1] == 'requeue':
+        minutes = float(args[3]) if len(args) > 3 else staleminutes
+        stale = FileQueue(args[2]).requeue_stale(minutes * 60)
+        print('Requeued ' + str(len(stale)) + ' shards.')
+
+    else:
+        print('Usage: python runshards.py split metapath queuedir [shardsize]')
+        print('       python runshards.py run queuedir [processes]')
+        print('       python runshards.py work queuedir')
+        print('       python runshards.py status queuedir')
+        print('       python runshards.py requeue queuedir [staleminutes]')
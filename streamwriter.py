@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+# streamwriter.py
+
+# Classifying a few million volumes takes days, and if results are only
+# written at the end, a crash or preemption loses all of them. This
+# module lets implementmodel (and implementsubfic) append rows to their
+# output csv a chunk at a time, and resume an interrupted run.
+
+# Alongside the output, the writer keeps a checkpoint file (outpath
+# plus '.checkpoint'). After each chunk is written and flushed to disk,
+# one line is added to the checkpoint, recording the docids in that
+# chunk and the size of the output file after writing it. On restart,
+# the output is truncated to the last size recorded (discarding any
+# half-written chunk) and the recorded docids are skipped.
+
+# When a run finishes, the checkpoint is removed. Only a checkpoint
+# means there is a run to resume: if the output exists without one, it
+# is either finished or was cut off before its first chunk was
+# recorded, and either way it's discarded and the run starts over.
+
+import os, json
+
+class StreamingWriter:
+
+    def __init__(self, outpath):
+        self.outpath = outpath
+        self.checkpointpath = outpath + '.checkpoint'
+
+    def completed(self):
+        ''' Returns the set of docids already written to outpath, after
+        trimming away anything written since the last checkpoint. With
+        no checkpoint, any existing output is removed and the set is empty.
+        '''
+
+        done = set()
+
+        if os.path.isfile(self.checkpointpath):
+            goodsize = 0
+            with open(self.checkpointpath, encoding = 'utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # the last line may have been cut off mid-write
+                        break
+                    goodsize = record['bytes']
+                    done.update(record['docids'])
+
+            if os.path.isfile(self.outpath) and os.path.getsize(self.outpath) >= goodsize:
+                os.truncate(self.outpath, goodsize)
+            else:
+                # The output has gone missing or been replaced; start over.
+                done = set()
+                os.remove(self.checkpointpath)
+
+        elif os.path.isfile(self.outpath):
+            os.remove(self.outpath)
+
+        return done
+
+    def append(self, frame):
+        ''' Appends the rows of a dataframe (indexed by docid) to the output,
+        writing a header if the output is empty, and then records them in
+        the checkpoint.
+        '''
+
+        if len(frame) < 1:
+            return
+
+        with open(self.outpath, mode = 'a', encoding = 'utf-8', newline = '') as f:
+            needsheader = f.tell() == 0
+            frame.to_csv(f, header = needsheader)
+            f.flush()
+            os.fsync(f.fileno())
+            size = f.tell()
+
+        record = {'bytes': size, 'docids': frame.index.tolist()}
+        with open(self.checkpointpath, mode = 'a', encoding = 'utf-8') as f:
+            f.write(json.dumps(record) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def finish(self):
+        ''' Called when every row has been written.
+        '''
+        if os.path.isfile(self.checkpointpath):
+            os.remove(self.checkpointpath)
@@ -1,14 +1,38 @@
 # concatframes.py
 
+# Gathers the output of implementsubfic (fic*.csv, or fic*.parquet or
+# fic*.feather; see frameio.py) into annotatedfiction, sorted by
+# nonficprob.
+
+# Usage:
+#     python concatframes.py [csv|parquet|feather]
+
+# writes annotatedfiction in the format given, by default csv.
+
 import csv, os, sys, random, glob
 from collections import Counter
 import numpy as np
 import pandas as pd
 
+# modules from the main directory of this repo
+currentdir = os.path.dirname(__file__)
+modulepath = os.path.join(currentdir, '..')
+sys.path.append(modulepath)
+
+import frameio
+
+if len(sys.argv) > 1:
+    outformat = sys.argv[1]
+else:
+    outformat = 'csv'
+
 framepaths = glob.glob('fic*.csv')
+for fileformat in frameio.columnarformats:
+    framepaths.extend(glob.glob('fic*.' + fileformat))
+
 allframes = []
 for path in framepaths:
-    thisframe = pd.read_csv(path, index_col = 'docid', dtype = 'object')
+    thisframe = frameio.read_frame(path)
     allframes.append(thisframe)
 
 masterframe = pd.concat(allframes)
@@ -17,4 +41,4 @@ masterframe.loc[ : , 'nonficprob'] = pd.to_numeric(masterframe.loc[ : , 'nonficp
 
 masterframe = masterframe.sort_values('nonficprob')
 
-masterframe.to_csv('annotatedfiction.csv')
+frameio.write_frame(masterframe, 'annotatedfiction.' + outformat)
@@ -1,21 +1,40 @@
 # filterframe.py
 
+# Reads annotatedfiction in whichever format concatframes wrote it
+# (see frameio.py); the filtered sets are always written as csv.
+
+# Usage:
+#     python filterframes.py [annotatedpath]
+
+# where annotatedpath defaults to annotatedfiction.csv.
+
 import csv, os, sys, random, glob
 from collections import Counter
 import numpy as np
 import pandas as pd
 
+# modules from the main directory of this repo
+currentdir = os.path.dirname(__file__)
+modulepath = os.path.join(currentdir, '..')
+sys.path.append(modulepath)
+
+import frameio
+
+if len(sys.argv) > 1:
+    annotatedpath = sys.argv[1]
+else:
+    annotatedpath = 'annotatedfiction.csv'
 
-allfic = pd.read_csv('annotatedfiction.csv', index_col = 'docid', dtype = 'object')
+allfic = frameio.read_frame(annotatedpath)
 
 makenumeric = ['rawprobability', 'englishtop1000pct', 'nonficprob', 'juvenileprob']
 
 for col in makenumeric:
     allfic.loc[ : , col] = pd.to_numeric(allfic.loc[ : , col], errors = 'coerce')
 
-nonfic = allfic.loc[(allfic.metadatalikely != 'True') & (allfic.nonficprob > 0.9), : ]
+nonfic = allfic.loc[~frameio.is_true(allfic.metadatalikely) & (allfic.nonficprob > 0.9), : ]
 
-allfic = allfic.loc[(allfic.metadatalikely == 'True') | (allfic.nonficprob <= 0.9), : ]
+allfic = allfic.loc[frameio.is_true(allfic.metadatalikely) | (allfic.nonficprob <= 0.9), : ]
 
 juvie = list()
 
@@ -30,14 +49,14 @@ juvenile = allfic.loc[juvie, : ]
 
 allfic = allfic.loc[~allfic.index.isin(juvie), : ]
 
-biography = allfic.loc[(allfic.metadatasuspicious == 'True') & (allfic.metadatalikely != 'True'), : ]
-allfic = allfic.loc[(allfic.metadatasuspicious != 'True') | (allfic.metadatalikely == 'True'), : ]
+biography = allfic.loc[frameio.is_true(allfic.metadatasuspicious) & ~frameio.is_true(allfic.metadatalikely), : ]
+allfic = allfic.loc[~frameio.is_true(allfic.metadatasuspicious) | frameio.is_true(allfic.metadatalikely), : ]
 
-dubious = allfic.loc[(allfic.englishtop1000pct < 0.5) & (allfic.nonficprob > 0.5) & (allfic.metadatalikely != 'True'), : ]
-allfic = allfic.loc[(allfic.englishtop1000pct > 0.5) | (allfic.nonficprob < 0.5) | (allfic.metadatalikely == 'True'), : ]
+dubious = allfic.loc[(allfic.englishtop1000pct < 0.5) & (allfic.nonficprob > 0.5) & ~frameio.is_true(allfic.metadatalikely), : ]
+allfic = allfic.loc[(allfic.englishtop1000pct > 0.5) | (allfic.nonficprob < 0.5) | frameio.is_true(allfic.metadatalikely), : ]
 
-poems = allfic.loc[(allfic.metadatalikely != 'True') & (allfic.title.str.contains('poems')), : ]
-allfic = allfic.loc[(allfic.metadatalikely == 'True') | (~allfic.title.str.contains('poems')), : ]
+poems = allfic.loc[~frameio.is_true(allfic.metadatalikely) & (allfic.title.str.contains('poems')), : ]
+allfic = allfic.loc[frameio.is_true(allfic.metadatalikely) | (~allfic.title.str.contains('poems')), : ]
 
 specialzaps = ['inu.32000007720735', 'mdp.39015010907569', 'mdp.39015063187572', 'mdp.39015063187572', 'uc1.32106017522977', 'uc1.b4430816', 'mdp.39015013800514', 'mdp.39076006905231', 'pst.000015802538', 'uc1.32106012856602', 'uc1.32106012856602', 'pst.000045129537', 'osu.32435050762517', 'wu.89101597433', 'mdp.39015041834386', 'mdp.39015048338365', 'uiug.30112039681736', 'mdp.39015021585230', 'mdp.39015021585230', 'mdp.39015066050181', 'mdp.39015014628948', 'uc1.32106002152475', 'pst.000005752386', 'pst.000005752386', 'uc1.32106000043411', 'mdp.39015013238111', 'mdp.39015013238111', 'uc1.b4967253', 'inu.30000060707829', 'inu.30000103178004', 'mdp.39015009850390', 'uiuo.ark:/13960/t2n59fd04', 'mdp.39015069174368', 'mdp.39015002741166', 'uc1.b3462058', 'uc1.32106002098025', 'mdp.39015069174368', 'inu.30000114424041', 'mdp.39015030299963', 'uiuo.ark:/13960/t7dr40h84']
 
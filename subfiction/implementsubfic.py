@@ -12,8 +12,10 @@
 # models to make predictions about genre.
 
 
-import csv, os, sys, pickle, glob
+import csv, io, os, sys, pickle, glob
 from collections import Counter
+from itertools import chain
+from multiprocessing import Pool
 import numpy as np
 import pandas as pd
 
@@ -31,6 +33,18 @@ sys.path.append(libpath)
 import SonicScrewdriver as utils
 import parsefeaturejsons as parser
 
+# and modules from the main directory of this repo
+modulepath = os.path.join(currentdir, '..')
+sys.path.append(modulepath)
+
+import compilemodels
+import featurecache
+import frameio
+import modelbundle
+import pairtreeindex
+import prefetcher
+import streamwriter
+
 # Establish some global variables:
 
 # Let's create a list of the top 1000 English words so we can check
@@ -138,6 +152,13 @@ def onevolume2frame(vocabulary, counts):
 
 def prediction_for_file(model, counts):
     vocabulary = model['vocabulary']
+
+    if 'compiled' in model:
+        # one dot product instead of scaler + svm
+        onevector = np.array([[counts.get(v, 0) for v in vocabulary]])
+        predictions, probabilities = compilemodels.compiled_predictions(model['compiled'], onevector)
+        return predictions[0], probabilities[0]
+
     df = onevolume2frame(vocabulary, counts)
     scaler = model['scaler']
     scaleddf = scaler.transform(df)
@@ -151,6 +172,35 @@ def prediction_for_file(model, counts):
 
     return prediction, probability
 
+def feature_space(models):
+    '''
+    Returns the union of the models' vocabularies, and for each model
+    the positions of its words in the union, as implementmodel does.
+    '''
+
+    vocabularies = {name: model['vocabulary'] for name, model in models.items()}
+    vocabulary, columns = compilemodels.union_columns(vocabularies)
+
+    return {'vocabulary': vocabulary, 'columns': columns}
+
+def prediction_for_vector(model, vector):
+    '''
+    Applies a model to a one-row matrix of counts whose columns are in
+    the model's vocabulary order.
+    '''
+
+    if 'compiled' in model:
+        predictions, probabilities = compilemodels.compiled_predictions(model['compiled'], vector)
+        return predictions[0], probabilities[0]
+
+    scaledvector = model['scaler'].transform(vector)
+    supportvector = model['svm']
+
+    prediction = supportvector.predict(scaledvector)[0]
+    probability = supportvector.predict_proba(scaledvector)[0][1]
+
+    return prediction, probability
+
 def make_genredict(metadata, docid):
     ''' This converts a row of a pandas dataframe into a
     simpler dictionary representation. We expect all of
@@ -166,16 +216,26 @@ def make_genredict(metadata, docid):
     return genres
 
 
-def volume_classification(models, counts4volume):
+def volume_classification(models, counts4volume, space = None):
+    '''
+    Looks up the volume's counts once, over the union vocabulary of
+    space (see feature_space), and lets each model gather its own
+    columns from that vector.
+    '''
 
     nonfictionprob = 0.5
     juvenileprob = 0.5
 
+    if space is None:
+        space = feature_space(models)
+
+    unionvector = np.array([[counts4volume.get(v, 0) for v in space['vocabulary']]], dtype = np.float64)
+
     for name, model in models.items():
 
         positiveclass = model['positivelabel']
 
-        prediction, probability = prediction_for_file(model, counts4volume)
+        prediction, probability = prediction_for_vector(model, unionvector[ : , space['columns'][name]])
 
         if positiveclass == 'rin':
             nonfictionprob = probability
@@ -215,10 +275,20 @@ def get_pairtree(pairtreeroot, htid):
 
     return wholepath
 
-def counts4json(path, docid):
-    if os.path.isfile(path):
+def counts4json(path, docid, exists = None, data = None):
+    '''
+    data, if supplied, is the file's contents, already read by a
+    prefetcher.Prefetcher, and is parsed from memory instead of
+    opening the file again.
+    '''
+    if exists is None:
+        exists = os.path.isfile(path)
+
+    if exists:
         try:
-            volume = parser.VolumeFromJson(path, docid)
+            # bz2.open, inside VolumeFromJson, accepts a file object
+            # as well as a path.
+            volume = parser.VolumeFromJson(path if data is None else io.BytesIO(data), docid)
             counts, totalwords = volume.get_volume_features()
             flatcounts = Counter()
             for key, value in counts.items():
@@ -230,27 +300,135 @@ def counts4json(path, docid):
 
             return flatcounts, 'success', totalwords
 
+        except FileNotFoundError:
+            # a pairtreeindex can list a volume deleted since it was built
+            return Counter(), 'file not found', 0
         except:
             return Counter(), 'parsing failure', 0
     else:
         return Counter(), 'file not found', 0
 
 
-def main(sourcedir, metapath, modeldir, outpath, pairtree = False):
+def get_counts(sourcedir, alternatesource, docid, pairtree, fetched = None):
+    '''
+    Reads the features for one volume. In a pairtree, we look first
+    in sourcedir and then in alternatesource. Otherwise sourcedir may
+    be a featurecache or a flat directory of csvs.
+
+    fetched, if given, is the (path, data) pair a prefetcher.Prefetcher
+    returned for this volume, which has already looked in both places,
+    or the (path, None) pair a pairtreeindex gave; a path of None means
+    the volume wasn't found.
     '''
-    This function can be called from outside the module; it accepts
-    path information and then iterates through all the files it
-    finds in the metadata at "metapath."
 
-    If the pairtree flag is True, we assume sourcedir is the root
-    of a pairtree structure. Otherwise we assume it's a flat list.
+    if pairtree:
+        path1 = get_pairtree(sourcedir, docid)
+        path2 = get_pairtree(alternatesource, docid)
+
+        data = None
+        if fetched is not None:
+            chosenpath, data = fetched
+        elif os.path.isfile(path1):
+            chosenpath = path1
+        elif os.path.isfile(path2):
+            chosenpath = path2
+        else:
+            chosenpath = None
+
+        if chosenpath is None:
+            print(path1)
+            print(path2)
+            print('file not found')
+            return Counter(), 'file not found', 0
+
+        counts, error, wordcount = counts4json(chosenpath, docid, exists = True, data = data)
+
+    elif featurecache.is_cache(sourcedir):
+        cache = featurecache.open_cache(sourcedir)
+        if docid in cache:
+            counts, error, wordcount = cache.counts(docid), 'success', 0
+        else:
+            counts, error, wordcount = Counter(), 'file not found', 0
+
+    else:
+        path = os.path.join(sourcedir, utils.clean_pairtree(docid) + '.csv')
+        counts, error, wordcount = counts4file(path)
+
+    return counts, error, wordcount
+
+def json_candidates(sourcedir, alternatesource, docid, index = None):
+    '''
+    Returns the paths where docid's json might be, in the order they
+    should be tried: the one in index, if an index (see pairtreeindex.py)
+    is supplied and has it, or else the paths in both pairtrees.
     '''
 
-    global allnames, top1000words
+    if index is None:
+        return [get_pairtree(sourcedir, docid), get_pairtree(alternatesource, docid)]
+    elif docid in index:
+        return [index.path_for(docid)]
+    else:
+        return []
 
-    alternatesource = '/projects/ichass/usesofscale/post23/englishmonographs1980-2016/'
+def fetch_all(fetcher, chunks, sourcedir, alternatesource, pairtree, index = None):
+    '''
+    Starts looking up and reading the files for every volume in chunks,
+    a list of lists of docids, on fetcher's threads, and returns the
+    stream of results that classify_docids takes each chunk's volumes
+    from; or None if there's no fetcher or no pairtree.
+    '''
+    if pairtree and fetcher is not None:
+        requests = ((docid, json_candidates(sourcedir, alternatesource, docid, index)) for docids in chunks for docid in docids)
+        return fetcher.fetch(requests)
+    else:
+        return None
+
+def classify_docids(models, docids, sourcedir, alternatesource, pairtree, space = None, fetches = None, index = None):
+    '''
+    Reads and classifies a list of volumes, returning a list of
+    (nonficprob, juvenileprob, wordcount) tuples in the same order.
+    If fetches (a stream from fetch_all) is supplied, the files for
+    these volumes are the next ones in it, read ahead on a prefetcher's
+    threads. If index (a
+    pairtreeindex.PairtreeIndex) is supplied, paths are looked up
+    there instead of checked on disk.
+    '''
 
-    # We're going to store all the models, by name, in a dictionary:
+    if space is None:
+        space = feature_space(models)
+
+    if pairtree and fetches is not None:
+        sources = prefetcher.take(fetches, docids)
+    elif pairtree and index is not None:
+        sources = [(index.path_for(docid), None) for docid in docids]
+    else:
+        sources = [None] * len(docids)
+
+    results = []
+
+    for docid, fetched in zip(docids, sources):
+        counts, error, wordcount = get_counts(sourcedir, alternatesource, docid, pairtree, fetched)
+
+        if error == 'success':
+            nonficprob, juvenileprob = volume_classification(models, counts, space)
+        else:
+            nonficprob = 0.5
+            juvenileprob = 0.5
+
+        results.append((nonficprob, juvenileprob, wordcount))
+
+    return results
+
+def load_models(modeldir, compiled):
+    '''
+    Loads every pickled model in modeldir into a dictionary keyed by name.
+    modeldir can also be a bundle (see modelbundle.py), in which case
+    the models are already compiled.
+    '''
+
+    if modelbundle.is_bundle(modeldir):
+        models, stack = modelbundle.load_bundle(modeldir)
+        return models
 
     models = dict()
 
@@ -260,68 +438,173 @@ def main(sourcedir, metapath, modeldir, outpath, pairtree = False):
         name = apath.replace(modeldir, '')
         name = name.replace('.p', '')
         models[name] = loadamodel(apath)
+        if compiled:
+            models[name]['compiled'] = compilemodels.compile_model(models[name])
 
-    # Now get metadata.
+    return models
 
-    metadata = get_metadata(metapath)
+# When main runs with more than one worker, each process in the pool
+# loads the models once, into this dictionary.
 
-    nonficprobs = []
-    juvieprobs = []
-    wordcounts = []
+workerstate = dict()
 
-    c = 0
-    for docid in metadata.index:
-        print(c)
-        c += 1
+def initialize_worker(modeldir, compiled, sourcedir, alternatesource, pairtree, prefetch, indexpath):
+    global workerstate
 
-        if pairtree:
-            path1 = get_pairtree(sourcedir, docid)
-            path2 = get_pairtree(alternatesource, docid)
+    # An error raised here would make Pool replace workers forever
+    # (see implementmodel.initialize_worker), so it's kept and raised
+    # by classify_group instead.
 
-            if os.path.isfile(path1):
-                chosenpath = path1
-            elif os.path.isfile(path2):
-                chosenpath = path2
-            else:
-                print(path1)
-                print(path2)
-                print('file not found')
-                error = 'file not found'
-                wordcount = 0
+    try:
+        start_worker(modeldir, compiled, sourcedir, alternatesource, pairtree, prefetch, indexpath)
+    except Exception as error:
+        workerstate['error'] = error
+
+def start_worker(modeldir, compiled, sourcedir, alternatesource, pairtree, prefetch, indexpath):
+    global workerstate
+
+    workerstate['models'] = load_models(modeldir, compiled)
+    workerstate['space'] = feature_space(workerstate['models'])
+    workerstate['sourcedir'] = sourcedir
+    workerstate['alternatesource'] = alternatesource
+    workerstate['pairtree'] = pairtree
+    workerstate['fetcher'] = prefetcher.make_prefetcher(prefetch)
+    workerstate['index'] = None if indexpath is None else pairtreeindex.open_index(indexpath)
+
+def classify_group(group):
+    '''
+    Classifies a group of consecutive chunks of docids, prefetching
+    across all of them (see prefetcher.task_groups), and returns a list
+    of results for each chunk.
+    '''
+    global workerstate
 
-            counts, error, wordcount = counts4json(chosenpath, docid)
+    if 'error' in workerstate:
+        raise workerstate['error']
 
-        else:
-            path = os.path.join(sourcedir, utils.clean_pairtree(docid) + '.csv')
-            counts, error, wordcount = counts4file(path)
+    fetches = fetch_all(workerstate['fetcher'], group, workerstate['sourcedir'], workerstate['alternatesource'], workerstate['pairtree'], workerstate['index'])
 
-        if error == 'success':
-            nonficprob, juvenileprob = volume_classification(models, counts)
-        else:
-            nonficprob = 0.5
-            juvenileprob = 0.5
+    return [classify_docids(workerstate['models'], docids, workerstate['sourcedir'], workerstate['alternatesource'], workerstate['pairtree'], workerstate['space'], fetches, workerstate['index']) for docids in group]
 
-        nonficprobs.append(nonficprob)
-        juvieprobs.append(juvenileprob)
-        wordcounts.append(wordcount)
+def main(sourcedir, metapath, modeldir, outpath, pairtree = False, compiled = False, workers = 1, chunksize = 100, prefetch = 0, indexpath = None):
+    '''
+    This function can be called from outside the module; it accepts
+    path information and then iterates through all the files it
+    finds in the metadata at "metapath."
+
+    If the pairtree flag is True, we assume sourcedir is the root
+    of a pairtree structure. Otherwise we assume it's a flat list.
+
+    If compiled is True, each pickled svm is folded into a linear
+    weight vector (see compilemodels.py), so a volume is scored with
+    one dot product per model.
+
+    If workers is more than 1, the metadata is divided into chunks of
+    chunksize volumes, which are handed out to a pool of that many
+    processes; each process loads the models once. Results are
+    collected in metadata order either way.
+
+    If prefetch is more than 0, that many threads in each process look
+    for and read upcoming files in the pairtrees (see prefetcher.py)
+    while earlier volumes are parsed and classified.
+
+    If indexpath names an index built by pairtreeindex.py over sourcedir
+    and the alternate source (in that order), paths are looked up there
+    rather than checked on disk, and volumes missing from both are
+    counted before the run begins.
+
+    Rows are appended to outpath as each chunk is finished, with a
+    checkpoint (see streamwriter.py), so an interrupted run can be
+    resumed by calling main again with the same outpath; the output of
+    a finished run is replaced. If outpath
+    ends in .parquet or .feather, the finished output is converted to
+    that format (see frameio.py); an interrupted run then resumes from
+    the csv it was streaming to, and a rerun after a finished one
+    replaces it, as it would a csv.
+    '''
+
+    alternatesource = '/projects/ichass/usesofscale/post23/englishmonographs1980-2016/'
+
+    # Now get metadata.
 
+    metadata = get_metadata(metapath)
+
+    streampath = frameio.streaming_path(outpath)
+    writer = streamwriter.StreamingWriter(streampath)
+    done = writer.completed()
+    if len(done) > 0:
+        print('Resuming: ' + str(len(done)) + ' volumes already classified.')
+
+    positions = [idx for idx, docid in enumerate(metadata.index) if docid not in done]
+
+    if pairtree and indexpath is not None:
+        index = pairtreeindex.open_index(indexpath)
+        missing = index.missing(metadata.index[positions])
+        if len(missing) > 0:
+            print(str(len(missing)) + ' volumes are missing from ' + indexpath)
+    else:
+        index = None
+    positionchunks = [positions[floor : floor + chunksize] for floor in range(0, len(positions), chunksize)]
+    chunks = [metadata.index[x].tolist() for x in positionchunks]
+
+    if workers > 1:
+        pool = Pool(processes = workers, initializer = initialize_worker, initargs = (modeldir, compiled, sourcedir, alternatesource, pairtree, prefetch, None if index is None else indexpath))
+        groups = prefetcher.task_groups(chunks, workers, prefetch)
+        allresults = chain.from_iterable(pool.imap(classify_group, groups))
+    else:
+        # We're going to store all the models, by name, in a dictionary:
+        models = load_models(modeldir, compiled)
+        space = feature_space(models)
+        fetcher = prefetcher.make_prefetcher(prefetch)
+        fetches = fetch_all(fetcher, chunks, sourcedir, alternatesource, pairtree, index)
+        allresults = (classify_docids(models, docids, sourcedir, alternatesource, pairtree, space, fetches, index) for docids in chunks)
+
+    c = len(done)
+    finished = False
+    try:
+        for chunkpositions, results in zip(positionchunks, allresults):
+            print(c)
+            c += len(results)
+
+            chunkframe = metadata.iloc[chunkpositions].copy()
+            nonficprobs, juvieprobs, wordcounts = zip(*results)
+
+            chunkframe.loc[ : , 'nonficprob'] = pd.Series(nonficprobs, index = chunkframe.index, dtype = 'float64')
+            chunkframe.loc[ : , 'juvenileprob'] = pd.Series(juvieprobs, index = chunkframe.index, dtype = 'float64')
+            chunkframe.loc[ : , 'wordcount'] = pd.Series(wordcounts, index = chunkframe.index)
 
-    metadata.loc[ : , 'nonficprob'] = pd.Series(nonficprobs, index = metadata.index)
-    metadata.loc[ : , 'juvenileprob'] = pd.Series(juvieprobs, index = metadata.index)
-    metadata.loc[ : , 'wordcount'] = pd.Series(wordcounts, index = metadata.index)
+            writer.append(chunkframe)
 
-    metadata.to_csv(outpath)
+        finished = True
+
+    finally:
+        if workers > 1 and finished:
+            pool.close()
+            pool.join()
+        elif workers > 1:
+            pool.terminate()
+            pool.join()
+        elif fetcher is not None:
+            fetcher.close()
+
+    writer.finish()
+    frameio.finish_stream(streampath, outpath)
 
 if __name__ == '__main__':
 
     args = sys.argv
 
-    if len(args) == 3:
+    if len(args) == 3 or len(args) == 4:
+        # optional third argument is the number of worker processes
+        if len(args) == 4:
+            workers = int(args[3])
+        else:
+            workers = 1
         sourcedir = '/projects/ichass/usesofscale/post23/englishmonographs1920-79/'
         metapath = args[1]
         modeldir = '../ficmodels/'
         outpath = args[2]
-        main(sourcedir, metapath, modeldir, outpath, pairtree = True)
+        main(sourcedir, metapath, modeldir, outpath, pairtree = True, workers = workers)
 
     else:
         main(sourcedir = '/Volumes/TARDIS/work/train20', metapath = 'maintrainingset.csv', modeldir = 'models/', outpath = 'predicted_metadata.csv', pairtree = False)
@@ -12,8 +12,9 @@
 # c is a constant passed to the svm, which needs to be optimized,
 # and k is the number of folds in cross-validation
 
-import csv, os, sys, pickle
+import csv, os, sys, pickle, time
 from collections import Counter
+from multiprocessing import Pool
 import numpy as np
 import pandas as pd
 
@@ -29,12 +30,21 @@ sys.path.append(libpath)
 
 import SonicScrewdriver as utils
 
+import featurecache
+
 def get_metadata(metapath, positivelabel, negativelabel):
     ''' Returns the metadata as a pandas dataframe, and lists of positive and negative
     instance IDs.
     '''
     meta = pd.read_csv(metapath, index_col = 'docid', dtype = 'object')
 
+    return select_classes(meta, positivelabel, negativelabel)
+
+def select_classes(meta, positivelabel, negativelabel):
+    ''' Does the work of get_metadata on a dataframe that has already been
+    loaded, so several models can be defined from one read of the metadata.
+    '''
+
     positiveIDs = meta.loc[meta['volgenre'] == positivelabel, : ].index.tolist()
 
     # The negative label can come in three types. Either a straightforward label for
@@ -71,6 +81,12 @@ def get_vocabulary(metadata, positiveIDs, negativeIDs, sourcedir, n):
 
     allIDs = positiveIDs + negativeIDs
 
+    if featurecache.is_cache(sourcedir):
+        cache = featurecache.open_cache(sourcedir)
+        vocab = cache.top_features(allIDs, n)
+        print('Vocabulary constructed.')
+        return vocab
+
     doc_freq = Counter()
 
     for docid in allIDs:
@@ -98,6 +114,13 @@ def get_vocabulary_and_counts(metadata, positiveIDs, negativeIDs, sourcedir, n):
 
     allIDs = positiveIDs + negativeIDs
 
+    if featurecache.is_cache(sourcedir):
+        cache = featurecache.open_cache(sourcedir)
+        vocab = cache.top_features(allIDs, n)
+        counts = {docid: cache.counts(docid) for docid in allIDs}
+        print('Vocabulary constructed.')
+        return vocab, counts
+
     doc_freq = Counter()
     counts = dict()
 
@@ -134,12 +157,24 @@ def get_vocabulary_and_counts(metadata, positiveIDs, negativeIDs, sourcedir, n):
 def get_featureframe(vocabulary, positiveIDs, negativeIDs, sourcedir):
     ''' Returns a pandas dataframe with feature counts for all the volumes
     to be used in this model.
+
+    If sourcedir is a featurecache, counts for a feature that appears
+    both in the header and the body are summed, as they are in
+    get_vocabulary_and_counts.
     '''
 
+    allIDs = positiveIDs + negativeIDs
+
+    if featurecache.is_cache(sourcedir):
+        cache = featurecache.open_cache(sourcedir)
+        df = pd.DataFrame(cache.matrix(allIDs, vocabulary), index = allIDs, columns = vocabulary)
+        stdscaler = StandardScaler()
+        scaleddf = pd.DataFrame(stdscaler.fit_transform(df), index = allIDs)
+        return scaleddf
+
     df = dict()
     # We initially construct the data frame as a dictionary of Series.
     vocabset = set(vocabulary)
-    allIDs = positiveIDs + negativeIDs
 
     for v in vocabulary:
         df[v] = pd.Series(np.zeros(len(allIDs)), index = allIDs)
@@ -167,6 +202,36 @@ def get_featureframe(vocabulary, positiveIDs, negativeIDs, sourcedir):
 
     return scaleddf
 
+def countdict2matrix(vocabulary, allIDs, counts):
+    ''' Fills a numpy array with a row for each docid in allIDs and
+    a column for each feature in vocabulary, reading from the dictionary
+    of Counters produced by get_vocabulary_and_counts.
+
+    This replaces building a dictionary of Series one cell at a time,
+    which meant len(vocabulary) x len(allIDs) label-indexed writes.
+    '''
+
+    matrix = np.zeros((len(allIDs), len(vocabulary)))
+    colindex = {v: i for i, v in enumerate(vocabulary)}
+
+    for row, docid in enumerate(allIDs):
+        doccounts = counts[docid]
+
+        # Walk whichever is shorter: the volume's counts or the vocabulary.
+
+        if len(doccounts) < len(vocabulary):
+            cols = []
+            values = []
+            for feature, count in doccounts.items():
+                if feature in colindex:
+                    cols.append(colindex[feature])
+                    values.append(count)
+            matrix[row, cols] = values
+        else:
+            matrix[row, : ] = [doccounts[v] if v in doccounts else 0 for v in vocabulary]
+
+    return matrix
+
 def countdict2featureframe(vocabulary, positiveIDs, negativeIDs, counts):
     ''' Returns a pandas dataframe with feature counts for all the volumes
     to be used in this model. Is a version of the previous function, except that
@@ -175,23 +240,8 @@ def countdict2featureframe(vocabulary, positiveIDs, negativeIDs, counts):
     Returns a scaled frame.
     '''
 
-    df = dict()
-    # We initially construct the data frame as a dictionary of Series.
-    vocabset = set(vocabulary)
     allIDs = positiveIDs + negativeIDs
-
-    for v in vocabulary:
-        df[v] = pd.Series(np.zeros(len(allIDs)), index = allIDs)
-
-    for docid in allIDs:
-        for feature, count in counts[docid].items():
-            if feature in vocabset:
-                df[feature].loc[docid] = count
-
-    # Now let's refashion the dictionary as an actual dataframe.
-    df = pd.DataFrame(df, index = allIDs)
-    df = df[vocabulary]
-    # This reorders the columns to be in vocab order
+    df = pd.DataFrame(countdict2matrix(vocabulary, allIDs, counts), index = allIDs, columns = vocabulary)
 
     stdscaler = StandardScaler()
     scaleddf = pd.DataFrame(stdscaler.fit_transform(df), index = allIDs)
@@ -236,21 +286,8 @@ def counts2frame_notscaled(vocabulary, positiveIDs, negativeIDs, counts):
     a model to export, and need to export the scaler itself.
     '''
 
-    df = dict()
-    # We initially construct the data frame as a dictionary of Series.
-    vocabset = set(vocabulary)
     allIDs = positiveIDs + negativeIDs
-
-    for v in vocabulary:
-        df[v] = pd.Series(np.zeros(len(allIDs)), index = allIDs)
-        for docid in allIDs:
-            if v in counts[docid]:
-                df[v].loc[docid] = counts[docid][v]
-
-    # Now let's refashion the dictionary as an actual dataframe.
-    df = pd.DataFrame(df, index = allIDs)
-    df = df[vocabulary]
-    # This reorders the columns to be in vocab order
+    df = pd.DataFrame(countdict2matrix(vocabulary, allIDs, counts), index = allIDs, columns = vocabulary)
 
     return df
 
@@ -290,8 +327,13 @@ def svm_model_one_fold(metadata, fold, scaleddf, c, featurecount):
     trainingyvals = metadata.loc[~metadata.index.isin(fold), 'class']
     realyvals = metadata.loc[fold, 'class']
 
+    # Only labels are needed here, so we skip the Platt calibration
+    # that probability = True would add (an internal five-fold
+    # cross-validation on every fit). It doesn't change the fitted
+    # svm or its predictions.
+
     # supportvector = svm.LinearSVC(C = c)
-    supportvector = svm.SVC(C = c, kernel = 'linear', probability = True)
+    supportvector = svm.SVC(C = c, kernel = 'linear', probability = False)
     supportvector.fit(data.loc[ : , 0: featurecount], trainingyvals)
 
     prediction = supportvector.predict(testdata.loc[ : , 0: featurecount])
@@ -321,6 +363,32 @@ def svm_probabilistic_one_fold(metadata, fold, scaleddf, c, featurecount):
 
     return predictions, probabilities, realyvals
 
+def warm_path_one_fold(metadata, fold, scaleddf, cs, featurecount):
+    ''' Like svm_model_one_fold, but sweeps a whole list of c values for
+    one fold. Instead of an SVC, it fits a linear logistic regression,
+    warm-starting each fit from the coefficients for the previous c (the
+    list is visited in ascending order), so a path of c values costs not
+    much more than a single fit.
+
+    Returns a list of predictions, one per value in cs (in the order
+    given), and the real class labels.
+    '''
+
+    data = scaleddf.drop(fold)
+    testdata = scaleddf.loc[fold, : ]
+    trainingyvals = metadata.loc[~metadata.index.isin(fold), 'class']
+    realyvals = metadata.loc[fold, 'class']
+
+    model = LogisticRegression(C = min(cs), solver = 'lbfgs', warm_start = True, max_iter = 1000)
+
+    predictions = dict()
+    for c in sorted(cs):
+        model.set_params(C = c)
+        model.fit(data.loc[ : , 0: featurecount], trainingyvals)
+        predictions[c] = model.predict(testdata.loc[ : , 0: featurecount])
+
+    return [predictions[c] for c in cs], realyvals
+
 def calculate_accuracy(prediction, realyvals):
     assert len(prediction) == len(realyvals)
 
@@ -342,20 +410,63 @@ def calculate_accuracy(prediction, realyvals):
 
     return accuracy, precision, recall
 
-def cross_validate_svm(metadata, positiveIDs, negativeIDs, scaleddf, c, k, featurecount):
+# When cross_validate_svm runs folds in parallel, each worker receives
+# the metadata and scaled features once, here.
+
+foldstate = dict()
+
+def initialize_folds(metadata, scaleddf):
+    global foldstate
+
+    foldstate['metadata'] = metadata
+    foldstate['scaleddf'] = scaleddf
+
+def timed_fold(foldtuple):
+    ''' Runs svm_model_one_fold on the data in foldstate and times it.
+    Designed to be mapped across a Pool, so input is packed as a tuple.
+    '''
+
+    global foldstate
+
+    fold, c, featurecount = foldtuple
+
+    start = time.perf_counter()
+    prediction, realclasslabels = svm_model_one_fold(foldstate['metadata'], fold, foldstate['scaleddf'], c, featurecount)
+
+    return prediction, realclasslabels, time.perf_counter() - start
+
+def cross_validate_svm(metadata, positiveIDs, negativeIDs, scaleddf, c, k, featurecount, workers = 1, foldtimes = None):
     ''' K-fold cross-validation of the model, using parameter c, and features
     up to featurecount.
+
+    If workers is more than 1, folds are fit in parallel by a pool of that
+    many processes. (Don't ask for this inside a worker that's already part
+    of a pool, as in parallelmodel.) If foldtimes is a list, the seconds
+    spent fitting and predicting each fold are appended to it, in fold order.
     '''
 
     folds = break_into_folds(positiveIDs, negativeIDs, k)
+    foldtuples = [(fold, c, featurecount) for fold in folds]
+
+    if workers > 1:
+        pool = Pool(processes = min(workers, len(folds)), initializer = initialize_folds, initargs = (metadata, scaleddf))
+        foldresults = pool.map(timed_fold, foldtuples)
+        pool.close()
+        pool.join()
+    else:
+        initialize_folds(metadata, scaleddf)
+        foldresults = [timed_fold(x) for x in foldtuples]
+        foldstate.clear()
 
     allrealclasslabels = []
     allpredictions = []
     allfolds = []
 
-    for fold in folds:
+    for fold, (prediction, realclasslabels, seconds) in zip(folds, foldresults):
+
+        if foldtimes is not None:
+            foldtimes.append(seconds)
 
-        prediction, realclasslabels = svm_model_one_fold(metadata, fold, scaleddf, c, featurecount)
         allrealclasslabels.extend(realclasslabels)
         allpredictions.extend(prediction)
         allfolds.extend(fold)
@@ -370,21 +481,24 @@ def cross_validate_svm(metadata, positiveIDs, negativeIDs, scaleddf, c, k, featu
 
     return accuracy, precision, recall, allpredictions, allrealclasslabels
 
-def basic_cross_validation(metapath, sourcedir, positivelabel, negativelabel, n, k, c):
+def basic_cross_validation(metapath, sourcedir, positivelabel, negativelabel, n, k, c, workers = 1):
     ''' Trains a model of positivelabel against negativelabel, where
     n = number of features to use in the model (top n words)
     c = constant to be passed to the svm, and
     k = number of folds in the cross-validation.
+    If workers is more than 1, that many folds are fit at once.
     '''
 
     metadata, positiveIDs, negativeIDs = get_metadata(metapath, positivelabel, negativelabel)
     vocabulary = get_vocabulary(metadata, positiveIDs, negativeIDs, sourcedir, n)
     scaleddf = get_featureframe(vocabulary, positiveIDs, negativeIDs, sourcedir)
-    accuracy, precision, recall, predictions, reallabels = cross_validate_svm(metadata, positiveIDs, negativeIDs, scaleddf, c, k, n)
+    foldtimes = []
+    accuracy, precision, recall, predictions, reallabels = cross_validate_svm(metadata, positiveIDs, negativeIDs, scaleddf, c, k, n, workers, foldtimes)
 
     print()
     print("Modeling " + positivelabel + " against " + negativelabel)
     print(accuracy, precision, recall)
+    print('Seconds per fold: ' + ', '.join([str(round(x, 2)) for x in foldtimes]))
 
     return predictions, reallabels
 
@@ -426,6 +540,14 @@ def export_svm_model(metapath, sourcedir, positivelabel, negativelabel, ftcount,
     metadata, positiveIDs, negativeIDs = get_metadata(metapath, positivelabel, negativelabel)
     print('Loading wordcounts and getting features ...')
     vocabulary, countdict = get_vocabulary_and_counts(metadata, positiveIDs, negativeIDs, sourcedir, ftcount)
+
+    fit_svm_model(metadata, positiveIDs, negativeIDs, vocabulary, countdict, positivelabel, negativelabel, ftcount, c, outpath4model)
+
+def fit_svm_model(metadata, positiveIDs, negativeIDs, vocabulary, countdict, positivelabel, negativelabel, ftcount, c, outpath4model):
+    ''' The second half of export_svm_model: given metadata, a vocabulary,
+    and a dictionary of counts, fits the model and pickles it.
+    '''
+
     print('Building the data frame ...')
     df = counts2frame_notscaled(vocabulary, positiveIDs, negativeIDs, countdict)
     allIDs = df.index.tolist()
@@ -489,6 +611,131 @@ def export_svm_model(metapath, sourcedir, positivelabel, negativelabel, ftcount,
     #         writer.writerow(row)
 
 
+def load_shared_counts(sourcedir, docids):
+    ''' Reads counts for every volume in docids, once. Returns a dictionary
+    of Counters (like get_vocabulary_and_counts) and a parallel dictionary
+    recording how many feature rows contributed to each word, which is
+    what document frequency counts in get_vocabulary_and_counts.
+    '''
+
+    counts = dict()
+    docrows = dict()
+
+    if featurecache.is_cache(sourcedir):
+        cache = featurecache.open_cache(sourcedir)
+        for docid in docids:
+            counts[docid] = cache.counts(docid)
+            start, end = cache.span(docid)
+            words = [cache.vocabulary[x] for x in cache.indices[start : end]]
+            docrows[docid] = Counter(dict(zip(words, cache.rows[start : end].tolist())))
+
+        return counts, docrows
+
+    for docid in docids:
+        counts[docid] = Counter()
+        docrows[docid] = Counter()
+        path = os.path.join(sourcedir, utils.clean_pairtree(docid) + '.csv')
+        with open(path, encoding = 'utf-8') as f:
+            reader = csv.DictReader(f)
+            for row in reader:
+                word = row['feature']
+                if len(word) < 1:
+                    continue
+
+                ct = float(row['count'])
+
+                if word.startswith('#header'):
+                    word = word.replace('#header', '')
+
+                docrows[docid][word] += 1
+                counts[docid][word] += ct
+
+    return counts, docrows
+
+def vocabulary_from_rows(docrows, positiveIDs, negativeIDs, n):
+    ''' Gets the top n words by docfrequency in positiveIDs + negativeIDs,
+    from rows loaded by load_shared_counts. Produces the same list, in the
+    same order, as get_vocabulary_and_counts would.
+    '''
+
+    doc_freq = Counter()
+
+    for docid in positiveIDs + negativeIDs:
+        for word, rowcount in docrows[docid].items():
+            doc_freq[word] += rowcount
+
+    return [x[0] for x in doc_freq.most_common(n)]
+
+# Models trained in parallel share one copy of the counts, which each
+# worker receives once when the pool starts.
+
+sharedstate = dict()
+
+def initialize_shared(meta, countdict, docrows):
+    global sharedstate
+
+    sharedstate['meta'] = meta
+    sharedstate['countdict'] = countdict
+    sharedstate['docrows'] = docrows
+
+def export_from_shared(spec):
+    ''' Trains and exports one model, described by a spec tuple
+    (positivelabel, negativelabel, ftcount, c, outpath4model), using
+    the counts in sharedstate.
+    '''
+
+    global sharedstate
+
+    positivelabel, negativelabel, ftcount, c, outpath4model = spec
+
+    print()
+    print('Calculating a model of ' + positivelabel + ' versus ' + negativelabel)
+    metadata, positiveIDs, negativeIDs = select_classes(sharedstate['meta'], positivelabel, negativelabel)
+    vocabulary = vocabulary_from_rows(sharedstate['docrows'], positiveIDs, negativeIDs, ftcount)
+    countdict = {docid: sharedstate['countdict'][docid] for docid in positiveIDs + negativeIDs}
+
+    fit_svm_model(metadata, positiveIDs, negativeIDs, vocabulary, countdict, positivelabel, negativelabel, ftcount, c, outpath4model)
+
+    return outpath4model
+
+def export_svm_models(metapath, sourcedir, specs, workers = 1):
+    ''' Trains and exports several models from the same metadata. Each spec
+    is a tuple (positivelabel, negativelabel, ftcount, c, outpath4model),
+    with the same meaning as the arguments to export_svm_model.
+
+    Unlike calling export_svm_model repeatedly, this reads the metadata and
+    every volume's counts only once; each model's vocabulary is then
+    calculated in memory. If workers is more than 1, the models are fit
+    in parallel by a pool of that many processes.
+    '''
+
+    meta = pd.read_csv(metapath, index_col = 'docid', dtype = 'object')
+
+    alldocids = []
+    seen = set()
+    for positivelabel, negativelabel, ftcount, c, outpath4model in specs:
+        metadata, positiveIDs, negativeIDs = select_classes(meta, positivelabel, negativelabel)
+        for docid in positiveIDs + negativeIDs:
+            if docid not in seen:
+                seen.add(docid)
+                alldocids.append(docid)
+
+    print('Loading wordcounts for ' + str(len(alldocids)) + ' volumes ...')
+    countdict, docrows = load_shared_counts(sourcedir, alldocids)
+
+    if workers > 1:
+        pool = Pool(processes = workers, initializer = initialize_shared, initargs = (meta, countdict, docrows))
+        res = pool.map_async(export_from_shared, specs)
+        res.wait()
+        outpaths = res.get()
+        pool.close()
+        pool.join()
+    else:
+        initialize_shared(meta, countdict, docrows)
+        outpaths = [export_from_shared(spec) for spec in specs]
+
+    return outpaths
+
 def onevolume2frame(vocabulary, counts):
     '''
     This version of countdict2featureframe is designed to